@@ -2,35 +2,100 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import numpy as np
+import hashlib
+import hmac
+import io
+import json
 import os
+import pickle
+import secrets
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager
 from pathlib import Path
+from pandas.io.parsers import TextParser
+
+from periodos import calcular_dias_periodo, calcular_dias_periodos, format_ano_mes
+from tendencias import ajustar_tendencias, calcular_tendencia
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    from openpyxl import Workbook, load_workbook
+except ImportError:
+    Workbook = None
+    load_workbook = None
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Trava de arquivo do repositório: fcntl (Linux/macOS) ou msvcrt (Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 # Configuração da página
 st.set_page_config(page_title="Análise de Balanço Hídrico", page_icon="💧", layout="wide")
 
-# Função para formatar ano_mes no padrão mmm/aa
-def format_ano_mes(ano_mes):
-    """Converte ano_mes (formato YYYYMM) para mmm/aa (formato brasileiro)"""
-    try:
-        ano_mes_str = str(int(ano_mes))
-        if len(ano_mes_str) != 6:
-            return ano_mes_str
-        
-        ano = ano_mes_str[:4]
-        mes = ano_mes_str[4:6]
-        
-        meses_pt = {
-            '01': 'Jan', '02': 'Fev', '03': 'Mar', '04': 'Abr',
-            '05': 'Mai', '06': 'Jun', '07': 'Jul', '08': 'Ago',
-            '09': 'Set', '10': 'Out', '11': 'Nov', '12': 'Dez'
-        }
-        
-        mes_abrev = meses_pt.get(mes, mes)
-        ano_abrev = ano[-2:]  # Últimos 2 dígitos do ano
-        
-        return f"{mes_abrev}/{ano_abrev}"
-    except:
-        return str(ano_mes)
+# Modo de diagnóstico (exibe telemetria e visões de depuração): BALANCO_DEBUG=1
+MODO_DEBUG = os.environ.get('BALANCO_DEBUG', '0') == '1'
+
+# Armazenar o SIGIS tipado em arquivo Arrow/Feather mapeado em memória: BALANCO_SIGIS_ARROW=1
+USAR_SIGIS_ARROW = os.environ.get('BALANCO_SIGIS_ARROW', '0') == '1'
+# Executar a tabela de análise no motor SQL (requer duckdb): BALANCO_MOTOR_SQL=1
+USAR_MOTOR_SQL = os.environ.get('BALANCO_MOTOR_SQL', '0') == '1'
+# Diretório privado (0700, do usuário do servidor) dos caches, arquivos mapeados e exportações:
+# BALANCO_CACHE_DIR; por padrão no diretório de cache do usuário, não no /tmp compartilhado
+DIRETORIO_CACHE = Path(os.environ.get('BALANCO_CACHE_DIR') or
+                       Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'balanco_hidrico')
+
+# Cache persistente de resultados, compartilhado pelos processos do servidor:
+# BALANCO_CACHE_RESULTADOS=disco (padrão) ou desligado; validade e limite de espaço configuráveis.
+# Entradas assinadas com HMAC: chave em BALANCO_CACHE_CHAVE (servidores com diretório compartilhado)
+# ou gerada no próprio diretório do cache
+BACKEND_CACHE_RESULTADOS = os.environ.get('BALANCO_CACHE_RESULTADOS', 'disco')
+VALIDADE_CACHE_RESULTADOS = float(os.environ.get('BALANCO_CACHE_VALIDADE_HORAS', 72)) * 3600
+LIMITE_CACHE_RESULTADOS = float(os.environ.get('BALANCO_CACHE_LIMITE_MB', 2048)) * 1024 ** 2
+
+# Orçamento de memória do conjunto de dados carregado (BALANCO_LIMITE_MEMORIA_MB): acima da
+# estimativa, a leitura passa a blocos e o SIGIS fica tipado em arquivo mapeado em memória.
+# BALANCO_MEDIR_MEMORIA=1 (ou o modo de diagnóstico) mede o pico de memória de cada etapa
+LIMITE_MEMORIA_DADOS = float(os.environ.get('BALANCO_LIMITE_MEMORIA_MB', 1024)) * 1024 ** 2
+MEDIR_MEMORIA = os.environ.get('BALANCO_MEDIR_MEMORIA', '0') == '1' or MODO_DEBUG
+
+# Repositório colunar incremental (Parquet particionado, uma planilha anexada por mês)
+DIRETORIO_REPOSITORIO = Path(os.environ.get('BALANCO_REPOSITORIO', DIRETORIO_CACHE / 'repositorio'))
+# Pacotes compilados (python main.py compilar arquivo.xlsx), abertos direto pelo app
+DIRETORIO_PACOTES = Path(os.environ.get('BALANCO_PACOTES', DIRETORIO_CACHE / 'pacotes'))
+
+# Dispersão Volume × % Perdas: acima deste número de localidades o gráfico passa a WebGL
+# e rotula só as localidades mais atípicas (BALANCO_LIMITE_DISPERSAO)
+LIMITE_PONTOS_DISPERSAO = int(os.environ.get('BALANCO_LIMITE_DISPERSAO', 1000))
+ROTULOS_DISPERSAO = 25
+
+# Parâmetros do PRAI: padrão para localidades sem pressão/TMA informados, e códigos
+# SIGIS opcionais de onde lê-los (BALANCO_SIGIS_COD_PRESSAO, BALANCO_SIGIS_COD_TMA)
+PRESSAO_MEDIA_PADRAO = 30  # m.c.a.
+TMA_PADRAO = 24  # horas/dia
+CODIGO_SIGIS_PRESSAO = int(os.environ['BALANCO_SIGIS_COD_PRESSAO']) if os.environ.get('BALANCO_SIGIS_COD_PRESSAO') else None
+CODIGO_SIGIS_TMA = int(os.environ['BALANCO_SIGIS_COD_TMA']) if os.environ.get('BALANCO_SIGIS_COD_TMA') else None
 
 # Função para formatar números no padrão brasileiro
 def format_number_br(value, decimals=0):
@@ -50,6 +115,26 @@ def format_number_br(value, decimals=0):
         formatted = formatted.replace("TEMP", ".")
         return formatted
 
+# Eixo de meses: só valores YYYYMM válidos (nada de 201913 a 202000)
+def deslocar_meses(ano_mes, deslocamento):
+    """Soma meses a YYYYMM (escalar ou array), virando o ano quando necessário"""
+    ano_mes = np.asarray(ano_mes, dtype=np.int64)
+    indice_mes = ano_mes // 100 * 12 + ano_mes % 100 - 1 + np.asarray(deslocamento, dtype=np.int64)
+    return indice_mes // 12 * 100 + indice_mes % 12 + 1
+
+def gerar_eixo_meses(inicio, fim):
+    """Meses YYYYMM consecutivos de inicio a fim (inclusive)"""
+    quantidade = (fim // 100 - inicio // 100) * 12 + (fim % 100 - inicio % 100) + 1
+    return deslocar_meses(inicio, np.arange(max(quantidade, 0))).tolist()
+
+def gerar_meses_futuros(mes_base, qtd_meses):
+    """Os qtd_meses meses seguintes a mes_base"""
+    return gerar_eixo_meses(*deslocar_meses(mes_base, [1, qtd_meses]).tolist()) if qtd_meses > 0 else []
+
+def rotular_meses(meses):
+    """Rótulos mmm/aa dos meses do eixo (montados uma vez por conjunto de dados)"""
+    return {int(m): format_ano_mes(int(m)) for m in meses}
+
 # Cores e dados
 CORES_PERSONALIZADAS = {
     'Volume de Entrada': 'rgba(255, 255, 255, 0.7)', 'Consumo Autorizado': 'rgba(16, 72, 97, 0.7)',
@@ -293,15 +378,338 @@ def get_matriz_banco_mundial():
         }
     }
 
-def buscar_dados_sigis(df_sigis, codigo_sigis, data_range, localidades_filtradas):
+# CLASSIFICAÇÃO PELA MATRIZ DO BANCO MUNDIAL (IVI × IPL × pressão)
+LIMITES_IVI = np.array([4, 8, 16])
+CATEGORIAS_MATRIZ = np.array(['A', 'B', 'C', 'D'])
+
+def extrair_faixas_pressao(matriz=None):
+    """Pressões de referência (m) e limites superiores de IPL das categorias A, B e C
+    em cada uma, lidos de get_matriz_banco_mundial()['perdas_por_pressao']"""
+    perdas_por_pressao = (matriz or get_matriz_banco_mundial())['perdas_por_pressao']
+    pressoes, limites = [], []
+    for coluna, faixas in sorted(perdas_por_pressao.items(), key=lambda item: float(item[0].rstrip('m'))):
+        pressoes.append(float(coluna.rstrip('m')))
+        limites.append([float(faixas[cat].split('-')[-1].strip('< ').replace('.', '')) for cat in ['A', 'B', 'C']])
+    return np.array(pressoes), np.array(limites)
+
+PRESSOES_MATRIZ, LIMITES_IPL_PRESSAO = extrair_faixas_pressao()
+
+def classificar_matriz_banco_mundial(ivi, ipl, pressao=30):
+    """Classifica arrays de IVI, IPL e pressão (m) em uma passada.
+    1. O IVI define a linha (categoria base: ≤4 A, ≤8 B, ≤16 C, acima D)
+    2. A pressão define a coluna (referência mais próxima entre 10 e 50 m)
+    3. Se o IPL está na faixa da célula, vale a categoria do IVI; senão, a faixa do IPL.
+    IPL negativo ou ausente fica em D."""
+    ivi, ipl, pressao = np.broadcast_arrays(
+        np.asarray(ivi, dtype=np.float64), np.asarray(ipl, dtype=np.float64), np.asarray(pressao, dtype=np.float64)
+    )
+    categoria_ivi = np.searchsorted(LIMITES_IVI, ivi, side='left')
+    
+    pontos_medios = (PRESSOES_MATRIZ[1:] + PRESSOES_MATRIZ[:-1]) / 2
+    limites = LIMITES_IPL_PRESSAO[np.searchsorted(pontos_medios, pressao, side='right')]
+    categoria_ipl = (ipl[..., None] >= limites).sum(axis=-1)
+    
+    indice = np.select(
+        [~(ipl >= 0), categoria_ipl == categoria_ivi],
+        [3, categoria_ivi],
+        default=categoria_ipl
+    )
+    return CATEGORIAS_MATRIZ[indice]
+
+# TELEMETRIA DAS CONSULTAS AO SIGIS
+# O script é reexecutado a cada interação, então os contadores valem para um rerun
+telemetria_sigis = {'consultas': {}, 'assinaturas': {}, 'secao': None}
+
+def definir_secao_telemetria(secao):
+    """Define a seção da interface à qual as próximas consultas ao SIGIS (e o pico de memória) serão atribuídos"""
+    telemetria_sigis['secao'] = secao
+    marcar_etapa_memoria(secao)
+
+def registrar_consulta_sigis(codigo_sigis, origem, linhas_varridas, duracao, data_range=None, localidades_filtradas=None, cache_hit=None):
+    """Acumula contagem, linhas varridas, tempo e acertos de cache por (código, origem)"""
+    secao = telemetria_sigis['secao']
+    chamador = f"{secao}/{origem}" if secao else origem
+    chave = (codigo_sigis, chamador)
+    
+    registro = telemetria_sigis['consultas'].setdefault(chave, {
+        'chamadas': 0, 'linhas_varridas': 0, 'tempo_s': 0.0,
+        'cache_hits': 0, 'cache_misses': 0, 'repetidas': 0
+    })
+    registro['chamadas'] += 1
+    registro['linhas_varridas'] += int(linhas_varridas)
+    registro['tempo_s'] += duracao
+    if cache_hit is True:
+        registro['cache_hits'] += 1
+    elif cache_hit is False:
+        registro['cache_misses'] += 1
+    
+    # Mesma consulta (código, período, localidades) já feita neste rerun = trabalho redundante
+    try:
+        assinatura = (codigo_sigis, tuple(data_range) if data_range is not None else None,
+                      frozenset(localidades_filtradas) if localidades_filtradas else None)
+    except TypeError:
+        return
+    if assinatura in telemetria_sigis['assinaturas']:
+        registro['repetidas'] += 1
+    telemetria_sigis['assinaturas'][assinatura] = telemetria_sigis['assinaturas'].get(assinatura, 0) + 1
+
+def resumir_telemetria_sigis():
+    """Retorna os agregados da telemetria como DataFrame (uma linha por código e origem)"""
+    linhas = []
+    for (codigo_sigis, chamador), registro in telemetria_sigis['consultas'].items():
+        linhas.append({'codigo_sigis': codigo_sigis, 'origem': chamador, **registro})
+    
+    colunas = ['codigo_sigis', 'origem', 'chamadas', 'linhas_varridas', 'tempo_s', 'cache_hits', 'cache_misses', 'repetidas']
+    if not linhas:
+        return pd.DataFrame(columns=colunas)
+    
+    df_telemetria = pd.DataFrame(linhas, columns=colunas)
+    df_telemetria['tempo_medio_ms'] = df_telemetria['tempo_s'] / df_telemetria['chamadas'] * 1000
+    return df_telemetria.sort_values('tempo_s', ascending=False).reset_index(drop=True)
+
+# MEMÓRIA POR ETAPA
+# Com MEDIR_MEMORIA, o tracemalloc acompanha as alocações; cada etapa do rerun registra o pico
+# e o quanto ficou retido desde o seu início. O pico é do processo: inclui as threads em segundo plano
+memoria_etapas = {'etapa': None, 'inicio': 0, 'picos': {}}
+
+def marcar_etapa_memoria(etapa):
+    """Fecha a etapa em curso, registrando seu pico de memória, e inicia `etapa` (None só fecha)"""
+    if not MEDIR_MEMORIA:
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    atual, pico = tracemalloc.get_traced_memory()
+    if memoria_etapas['etapa'] is not None:
+        memoria_etapas['picos'][memoria_etapas['etapa']] = {
+            'pico_mb': (pico - memoria_etapas['inicio']) / 1024 ** 2,
+            'retido_mb': (atual - memoria_etapas['inicio']) / 1024 ** 2
+        }
+    tracemalloc.reset_peak()
+    memoria_etapas.update(etapa=etapa, inicio=atual)
+
+def resumir_memoria_etapas():
+    """Picos de memória por etapa deste rerun como DataFrame"""
+    return pd.DataFrame(
+        [{'etapa': etapa, **registro} for etapa, registro in memoria_etapas['picos'].items()],
+        columns=['etapa', 'pico_mb', 'retido_mb']
+    )
+
+def estimar_memoria_planilha(amostra, linhas_planilha):
+    """Tamanho estimado em memória da planilha inteira, a partir das primeiras linhas já lidas"""
+    return amostra.memory_usage(index=False, deep=True).sum() / max(len(amostra), 1) * linhas_planilha
+
+# SIGIS TIPADO
+# Colunas tipadas (código, localidade, ano_mes, valor) ordenadas por código/localidade/mês,
+# com índice código -> fatia: as consultas recortam arrays sem copiar o frame inteiro
+def converter_coluna_inteira(serie):
+    """Converte uma coluna para int32 (valores ausentes/não numéricos viram -1)"""
+    return pd.to_numeric(serie, errors='coerce').fillna(-1).astype(np.int32).to_numpy()
+
+def calcular_hash_dataframe(df):
+    """Hash do conteúdo de um DataFrame (chave estável entre processos)"""
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()).hexdigest()
+
+def calcular_chave_dados(df, df_sigis):
+    """Chave do conjunto de dados carregado (balanço + SIGIS), usada pelos caches compartilhados"""
+    # Nomes das colunas entram na chave: o SIGIS muda de sentido com ou sem colunas de localidade
+    partes = [calcular_hash_dataframe(df), repr(list(df.columns))]
+    if isinstance(df_sigis, dict):
+        # SIGIS já tipado na leitura (acima do orçamento de memória): hash das colunas tipadas
+        colunas = {coluna: df_sigis[coluna] for coluna in ['codigo', 'localidade', 'ano_mes', 'valor'] if df_sigis[coluna] is not None}
+        partes += [calcular_hash_dataframe(pd.DataFrame(colunas)), str(df_sigis['chave_localidade'])]
+    elif df_sigis is not None:
+        partes += [calcular_hash_dataframe(df_sigis), repr(list(df_sigis.columns))]
+    return hashlib.sha1("|".join(partes).encode()).hexdigest()
+
+def preparar_sigis_tipado(df_sigis, mapear_arrow=USAR_SIGIS_ARROW):
+    """Converte a planilha SIGIS em colunas tipadas ordenadas e indexadas por código"""
+    if df_sigis is None:
+        return None
+    if isinstance(df_sigis, dict):
+        return df_sigis
+    
+    codigo = converter_coluna_inteira(df_sigis.iloc[:, 0])
+    ano_mes = converter_coluna_inteira(df_sigis['ano_mes']) if 'ano_mes' in df_sigis.columns else np.full(len(df_sigis), -1, dtype=np.int32)
+    
+    # Coluna I (índice 8): valores não numéricos viram NaN e são ignorados nas somas
+    if len(df_sigis.columns) > 8:
+        valor = pd.to_numeric(df_sigis.iloc[:, 8], errors='coerce').astype(np.float64).to_numpy()
+    else:
+        valor = np.full(len(df_sigis), np.nan)
+    
+    # Mesma prioridade das consultas originais: cod_localidade, depois nome_localidade
+    chave_localidade = None
+    localidade = None
+    if 'cod_localidade' in df_sigis.columns:
+        chave_localidade = 'cod_localidade'
+        localidade_numerica = pd.to_numeric(df_sigis['cod_localidade'], errors='coerce')
+        if localidade_numerica.notna().all() and (localidade_numerica % 1 == 0).all():
+            localidade = localidade_numerica.astype(np.int32).to_numpy()
+        else:
+            localidade = df_sigis['cod_localidade'].to_numpy(dtype=object)
+    elif 'nome_localidade' in df_sigis.columns:
+        chave_localidade = 'nome_localidade'
+        localidade = df_sigis['nome_localidade'].to_numpy(dtype=object)
+    
+    ordem_localidade = pd.factorize(localidade, sort=True)[0] if localidade is not None else np.zeros(len(df_sigis), dtype=np.int64)
+    ordem = np.lexsort((ano_mes, ordem_localidade, codigo))
+    
+    colunas = {
+        'codigo': codigo[ordem],
+        'localidade': localidade[ordem] if localidade is not None else None,
+        'ano_mes': ano_mes[ordem],
+        'valor': valor[ordem]
+    }
+    
+    if mapear_arrow and pa is not None and localidade is not None and localidade.dtype == np.int32:
+        try:
+            colunas = mapear_sigis_arrow(colunas, calcular_hash_dataframe(df_sigis))
+        except Exception as e:
+            print(f"Erro ao mapear SIGIS em Arrow, mantendo em memória: {e}")
+    
+    return montar_indice_sigis(colunas, chave_localidade)
+
+def mapear_sigis_arrow(colunas, chave):
+    """Grava as colunas tipadas em Feather (sem compressão) e as relê mapeadas em memória.
+    Processos que carregam o mesmo conteúdo compartilham o arquivo pelo cache de páginas do SO."""
+    garantir_diretorio_privado(DIRETORIO_CACHE)
+    caminho = DIRETORIO_CACHE / f"sigis_{chave}.feather"
+    
+    if not caminho.exists():
+        tabela = pa.table({
+            'codigo': pa.array(colunas['codigo'], type=pa.int32()),
+            'cod_localidade': pa.array(colunas['localidade'], type=pa.int32()),
+            'ano_mes': pa.array(colunas['ano_mes'], type=pa.int32()),
+            'valor': pa.array(colunas['valor'], type=pa.float64())
+        })
+        caminho_tmp = caminho.with_suffix(f".{os.getpid()}.tmp")
+        # Um único lote, para que cada coluna seja um buffer contíguo no arquivo
+        feather.write_feather(tabela, caminho_tmp, compression='uncompressed', chunksize=max(1, tabela.num_rows))
+        os.replace(caminho_tmp, caminho)
+    
+    return abrir_sigis_arrow(caminho)
+
+def abrir_sigis_arrow(caminho):
+    """Colunas do SIGIS tipado lidas do Feather mapeado em memória (o do cache ou o de um pacote)"""
+    tabela = feather.read_table(pa.memory_map(str(caminho), 'r'), memory_map=True)
+    localidade = next((nome for nome in ['cod_localidade', 'localidade'] if nome in tabela.column_names), None)
+    
+    return {
+        'codigo': coluna_arrow_numpy(tabela, 'codigo'),
+        'localidade': coluna_arrow_numpy(tabela, localidade) if localidade else None,
+        'ano_mes': coluna_arrow_numpy(tabela, 'ano_mes'),
+        'valor': coluna_arrow_numpy(tabela, 'valor'),
+        'arquivo': str(caminho)
+    }
+
+def coluna_arrow_numpy(tabela, nome):
+    """Coluna de uma tabela Arrow como array numpy; numéricas em um só bloco e sem nulos
+    apontam para o arquivo mapeado, sem cópia"""
+    coluna = tabela.column(nome)
+    if coluna.num_chunks == 0:
+        return np.array([], dtype=coluna.type.to_pandas_dtype())
+    if coluna.num_chunks == 1 and coluna.null_count == 0 and pa.types.is_primitive(coluna.type):
+        return coluna.chunk(0).to_numpy(zero_copy_only=True)
+    return coluna.to_numpy()
+
+def montar_indice_sigis(colunas, chave_localidade):
+    """Monta o índice código -> (início, fim) sobre colunas já ordenadas por código"""
+    codigos_unicos, inicios = np.unique(colunas['codigo'], return_index=True)
+    fins = np.append(inicios[1:], len(colunas['codigo']))
+    
+    return {
+        **colunas,
+        'chave_localidade': chave_localidade,
+        'indice': {int(c): (int(i), int(f)) for c, i, f in zip(codigos_unicos, inicios, fins)},
+        'num_linhas': len(colunas['codigo']),
+        'arquivo': colunas.get('arquivo')
+    }
+
+def sigis_para_cache(sigis_tipado):
+    """SIGIS mapeado em arquivo vai para o cache de resultados só com a referência ao Feather e o
+    índice: gravar as colunas no pickle as carregaria inteiras na memória a cada leitura do cache"""
+    if not isinstance(sigis_tipado, dict) or not sigis_tipado.get('arquivo'):
+        return sigis_tipado
+    return {
+        'arquivo_sigis': sigis_tipado['arquivo'],
+        'chave_localidade': sigis_tipado['chave_localidade'],
+        'indice': sigis_tipado['indice'],
+        'num_linhas': sigis_tipado['num_linhas']
+    }
+
+def sigis_do_cache(guardado):
+    """Inverso de sigis_para_cache: remapeia o Feather (erro se o arquivo sumiu ou mudou)"""
+    if not isinstance(guardado, dict) or 'arquivo_sigis' not in guardado:
+        return guardado
+    colunas = abrir_sigis_arrow(guardado['arquivo_sigis'])
+    if len(colunas['codigo']) != guardado['num_linhas']:
+        raise ValueError(f"arquivo do SIGIS alterado: {guardado['arquivo_sigis']}")
+    return {
+        **colunas,
+        'chave_localidade': guardado['chave_localidade'],
+        'indice': guardado['indice'],
+        'num_linhas': guardado['num_linhas']
+    }
+
+def selecionar_linhas_sigis(sigis_tipado, codigo_sigis, data_range, localidades_filtradas):
+    """Recorta as linhas de um código pelo índice e aplica período e localidades.
+    Retorna (localidade, ano_mes, valor) e o número de linhas varridas."""
+    try:
+        inicio, fim = sigis_tipado['indice'].get(int(codigo_sigis), (0, 0))
+    except (ValueError, TypeError):
+        inicio, fim = 0, 0
+    
+    # Fatias de arrays NumPy são views: nenhuma cópia até aplicar os filtros
+    localidade = sigis_tipado['localidade'][inicio:fim] if sigis_tipado['localidade'] is not None else None
+    ano_mes = sigis_tipado['ano_mes'][inicio:fim]
+    valor = sigis_tipado['valor'][inicio:fim]
+    
+    mascara = (ano_mes >= data_range[0]) & (ano_mes <= data_range[1])
+    if localidades_filtradas and localidade is not None:
+        mascara &= np.isin(localidade, list(localidades_filtradas))
+    
+    localidade = localidade[mascara] if localidade is not None else None
+    return localidade, ano_mes[mascara], valor[mascara], fim - inicio
+
+def somar_ultimos_valores_por_localidade(localidade, ano_mes, valor):
+    """Soma, por localidade, o valor positivo do mês mais recente (linhas ordenadas por localidade/mês)"""
+    positivos = valor > 0
+    if not positivos.any():
+        return 0
+    
+    localidade = localidade[positivos]
+    valor = valor[positivos]
+    # Última linha de cada localidade (a de maior ano_mes, pois as linhas estão ordenadas)
+    ultima = np.append(localidade[1:] != localidade[:-1], True)
+    return float(valor[ultima].sum())
+
+def ultimo_valor_positivo(ano_mes, valor):
+    """Valor positivo do mês mais recente entre todas as linhas"""
+    positivos = valor > 0
+    if not positivos.any():
+        return 0
+    
+    ano_mes = ano_mes[positivos]
+    valor = valor[positivos]
+    return float(valor[np.argmax(ano_mes)])
+
+def buscar_dados_sigis(df_sigis, codigo_sigis, data_range, localidades_filtradas, origem='buscar_dados_sigis'):
     """Busca dados específicos do SIGIS para um código"""
     if df_sigis is None:
         return 0
     
+    inicio_consulta = time.perf_counter()
+    linhas_varridas = len(df_sigis) if not isinstance(df_sigis, dict) else 0
     try:
+        # SIGIS tipado: recorte pelo índice de códigos
+        if isinstance(df_sigis, dict):
+            _, _, valores, linhas_varridas = selecionar_linhas_sigis(df_sigis, codigo_sigis, data_range, localidades_filtradas)
+            valores = valores[valores > 0]
+            return float(valores.sum()) if len(valores) > 0 else 0
+        
         # Filtrar pelo código SIGIS (coluna A)
         mask_codigo = df_sigis.iloc[:, 0] == codigo_sigis
-        resultados = df_sigis[mask_codigo].copy()
+        resultados = df_sigis[mask_codigo]
         
         if resultados.empty:
             return 0
@@ -343,11 +751,143 @@ def buscar_dados_sigis(df_sigis, codigo_sigis, data_range, localidades_filtradas
     except Exception as e:
         print(f"Erro ao buscar dados SIGIS para código {codigo_sigis}: {e}")
         return 0
+    
+    finally:
+        registrar_consulta_sigis(codigo_sigis, origem, linhas_varridas, time.perf_counter() - inicio_consulta, data_range, localidades_filtradas)
+
+# PARÂMETROS OPERACIONAIS POR LOCALIDADE (pressão média e TMA para o PRAI)
+# Fontes: planilha 3 opcional (cod_localidade, [ano_mes], pressao_media, tma) e códigos do SIGIS configurados
+parametros_operacionais_ativos = {'tabela': None}
+
+def definir_parametros_operacionais(parametros):
+    """Define os parâmetros usados por calcular_ivi neste rerun (None = 30 m e 24 h para todas)"""
+    parametros_operacionais_ativos['tabela'] = parametros
 
-def calcular_ivi(perdas_reais_valor, volume_entrada, df_sigis=None, data_range=None, localidades_filtradas=None):
+def preparar_parametros_lidos(df_parametros):
+    """Valida a planilha 3 (pressão média e TMA por localidade) recém-lida. Retorna (df_parametros ou None, aviso)"""
+    df_parametros.columns = [str(c).strip().lower() for c in df_parametros.columns]
+    if 'cod_localidade' not in df_parametros.columns or not {'pressao_media', 'tma'} & set(df_parametros.columns):
+        return None, "⚠️ A planilha 3 (parâmetros operacionais) deve ter cod_localidade e pressao_media e/ou tma."
+    return df_parametros, None
+
+def carregar_parametros_operacionais(arquivo):
+    """Lê a planilha 3 (opcional) do arquivo. Retorna (df_parametros ou None, aviso); sem a planilha, (None, None)"""
+    try:
+        df_parametros = pd.read_excel(arquivo, sheet_name=2)
+    except Exception:
+        return None, None
+    return preparar_parametros_lidos(df_parametros)
+
+def montar_parametros_operacionais(df_parametros, sigis_tipado):
+    """Junta planilha 3 e SIGIS em arrays ordenados por (localidade, ano_mes); ano_mes 0 vale
+    para todos os meses. A planilha prevalece sobre o SIGIS. Retorna None sem nenhuma fonte."""
+    partes = []
+    sigis_por_localidade = (isinstance(sigis_tipado, dict) and sigis_tipado['chave_localidade'] == 'cod_localidade'
+                            and sigis_tipado['localidade'].dtype == np.int32)
+    if sigis_por_localidade:
+        for coluna, codigo in [('pressao_media', CODIGO_SIGIS_PRESSAO), ('tma', CODIGO_SIGIS_TMA)]:
+            if codigo is None:
+                continue
+            inicio, fim = sigis_tipado['indice'].get(codigo, (0, 0))
+            valor = sigis_tipado['valor'][inicio:fim]
+            positivos = valor > 0
+            partes.append(pd.DataFrame({
+                'cod_localidade': sigis_tipado['localidade'][inicio:fim][positivos].astype(np.int64),
+                'ano_mes': sigis_tipado['ano_mes'][inicio:fim][positivos].astype(np.int64),
+                coluna: valor[positivos]
+            }).groupby(['cod_localidade', 'ano_mes']).last())
+    
+    if partes:
+        partes = [pd.concat(partes, axis=1).reset_index()]
+    if df_parametros is not None:
+        planilha = pd.DataFrame({
+            'cod_localidade': pd.to_numeric(df_parametros['cod_localidade'], errors='coerce'),
+            'ano_mes': pd.to_numeric(df_parametros['ano_mes'], errors='coerce') if 'ano_mes' in df_parametros.columns else 0,
+            'pressao_media': pd.to_numeric(df_parametros.get('pressao_media'), errors='coerce'),
+            'tma': pd.to_numeric(df_parametros.get('tma'), errors='coerce')
+        }).dropna(subset=['cod_localidade'])
+        partes.append(planilha.fillna({'ano_mes': 0}))
+    
+    if not partes:
+        return None
+    
+    tabela = pd.concat(partes, ignore_index=True).reindex(columns=['cod_localidade', 'ano_mes', 'pressao_media', 'tma'])
+    tabela = tabela.astype({'cod_localidade': np.int64, 'ano_mes': np.int64})
+    tabela = tabela.groupby(['cod_localidade', 'ano_mes'], sort=True).last().reset_index()
+    return {
+        'localidade': tabela['cod_localidade'].to_numpy(),
+        'ano_mes': tabela['ano_mes'].to_numpy(),
+        'pressao_media': tabela['pressao_media'].to_numpy(dtype=np.float64),
+        'tma': tabela['tma'].to_numpy(dtype=np.float64)
+    }
+
+def parametros_por_localidade(parametros, localidades, data_range):
+    """Pressão média e TMA de cada localidade no período (média das linhas que valem no
+    período, inclusive as de ano_mes 0; padrão de 30 m e 24 h onde não houver valor)"""
+    localidades = np.asarray(localidades, dtype=np.int64)
+    mascara = ((parametros['ano_mes'] == 0) | ((parametros['ano_mes'] >= data_range[0]) & (parametros['ano_mes'] <= data_range[1])))
+    mascara &= np.isin(parametros['localidade'], localidades)
+    
+    posicao = np.searchsorted(localidades, parametros['localidade'][mascara])
+    resultado = []
+    for coluna, padrao in [('pressao_media', PRESSAO_MEDIA_PADRAO), ('tma', TMA_PADRAO)]:
+        valores = parametros[coluna][mascara]
+        informado = ~np.isnan(valores)
+        soma = np.bincount(posicao[informado], weights=valores[informado], minlength=len(localidades))
+        contagem = np.bincount(posicao[informado], minlength=len(localidades))
+        resultado.append(np.where(contagem > 0, soma / np.maximum(contagem, 1), padrao))
+    return resultado[0], resultado[1]
+
+def calcular_prai_localidades(num_ligacoes, extensao_rede_km, pressao_media, tma):
+    """PRAI (m³/dia) de arrays de localidades: (0,8 × Lig + 18 × Ext) × P × TMA / 24 / 1000"""
+    return (0.8 * np.asarray(num_ligacoes) + 18 * np.asarray(extensao_rede_km)) * np.asarray(pressao_media) * np.asarray(tma) / 24 / 1000
+
+def ultimos_valores_por_localidade(localidade, valor):
+    """Localidades e o valor positivo do mês mais recente de cada uma (linhas ordenadas por localidade/mês)"""
+    positivos = valor > 0
+    localidade = localidade[positivos]
+    valor = valor[positivos]
+    ultima = np.append(localidade[1:] != localidade[:-1], True) if len(localidade) else np.zeros(0, dtype=bool)
+    return localidade[ultima], valor[ultima]
+
+def calcular_prai_parametros(df_sigis, data_range, localidades_filtradas, parametros=None):
+    """PRAI somado das localidades filtradas com a pressão e o TMA de cada uma, e a pressão
+    média ponderada pelo peso de cada localidade no PRAI. None quando não se aplica (sem
+    parâmetros, SIGIS não tipado ou sem filtro de localidades)."""
+    parametros = parametros if parametros is not None else parametros_operacionais_ativos['tabela']
+    if parametros is None or not isinstance(df_sigis, dict) or not localidades_filtradas or df_sigis['localidade'] is None:
+        return None
+    if df_sigis['localidade'].dtype != np.int32:
+        return None
+    
+    localidade_lig, _, valor_lig, _ = selecionar_linhas_sigis(df_sigis, 9603, data_range, localidades_filtradas)
+    localidade_ext, _, valor_ext, _ = selecionar_linhas_sigis(df_sigis, 33, data_range, localidades_filtradas)
+    localidade_lig, valor_lig = ultimos_valores_por_localidade(localidade_lig, valor_lig)
+    localidade_ext, valor_ext = ultimos_valores_por_localidade(localidade_ext, valor_ext)
+    
+    localidades = np.union1d(localidade_lig, localidade_ext).astype(np.int64)
+    if len(localidades) == 0:
+        return None
+    num_ligacoes = np.zeros(len(localidades))
+    extensao_rede_km = np.zeros(len(localidades))
+    num_ligacoes[np.searchsorted(localidades, localidade_lig)] = valor_lig
+    extensao_rede_km[np.searchsorted(localidades, localidade_ext)] = valor_ext
+    
+    pressao_media, tma = parametros_por_localidade(parametros, localidades, data_range)
+    peso = calcular_prai_localidades(num_ligacoes, extensao_rede_km, 1, 1)
+    return {
+        'prai': float(calcular_prai_localidades(num_ligacoes, extensao_rede_km, pressao_media, tma).sum()),
+        'pressao_media': float((peso * pressao_media).sum() / peso.sum()) if peso.sum() > 0 else PRESSAO_MEDIA_PADRAO
+    }
+
+# calcular_ivi sem o PRAI por parâmetros já calculado (None significa "não se aplica")
+PRAI_A_CALCULAR = object()
+
+def calcular_ivi(perdas_reais_valor, volume_entrada, df_sigis=None, data_range=None, localidades_filtradas=None, prai_parametros=PRAI_A_CALCULAR):
     """
     Calcula o IVI (Índice de Vazamento da Infraestrutura) e categoria segundo Banco Mundial
     Classificação baseada na matriz de localização IVI x IPL
+    prai_parametros: resultado de calcular_prai_parametros, quando quem chama já o tem
     """
     
     # Converter para float
@@ -365,8 +905,8 @@ def calcular_ivi(perdas_reais_valor, volume_entrada, df_sigis=None, data_range=N
     extensao_rede_km = 0
     
     if df_sigis is not None and data_range is not None:
-        num_ligacoes = buscar_ultimo_valor_nao_zerado_simples(df_sigis, 9603, data_range, localidades_filtradas)
-        extensao_rede_km = buscar_ultimo_valor_nao_zerado_simples(df_sigis, 33, data_range, localidades_filtradas)
+        num_ligacoes = buscar_ultimo_valor_nao_zerado_simples(df_sigis, 9603, data_range, localidades_filtradas, origem='calcular_ivi')
+        extensao_rede_km = buscar_ultimo_valor_nao_zerado_simples(df_sigis, 33, data_range, localidades_filtradas, origem='calcular_ivi')
     
     if num_ligacoes == 0 or extensao_rede_km == 0:
         return 'N/A', 'N/A', 0, 0
@@ -375,34 +915,15 @@ def calcular_ivi(perdas_reais_valor, volume_entrada, df_sigis=None, data_range=N
     if data_range is None:
         dias_periodo = 30
     else:
-        from datetime import datetime
-        import calendar
-        
         data_inicio, data_fim = data_range
-        
-        if data_inicio == data_fim:
-            ano = data_inicio // 100
-            mes = data_inicio % 100
-            dias_periodo = calendar.monthrange(ano, mes)[1]
-        else:
-            ano_inicio = data_inicio // 100
-            mes_inicio = data_inicio % 100
-            ano_fim = data_fim // 100
-            mes_fim = data_fim % 100
-            
-            dt_inicio = datetime(ano_inicio, mes_inicio, 1)
-            ultimo_dia_mes_fim = calendar.monthrange(ano_fim, mes_fim)[1]
-            dt_fim = datetime(ano_fim, mes_fim, ultimo_dia_mes_fim)
-            
-            diferenca = dt_fim - dt_inicio
-            dias_periodo = diferenca.days + 1
+        dias_periodo = calcular_dias_periodo(data_inicio, data_fim)
     
     # PRAC = Perdas Reais do período ÷ dias (converter para base diária)
     prac = perdas_reais_valor / dias_periodo
     
     # PRAI = Perdas Reais Anuais Inevitáveis (m³/dia)
-    pressao_media = 30
-    tma = 24
+    pressao_media = PRESSAO_MEDIA_PADRAO
+    tma = TMA_PADRAO
     
     perdas_ligacoes = 0.8 * num_ligacoes
     perdas_rede = 18 * extensao_rede_km
@@ -410,6 +931,13 @@ def calcular_ivi(perdas_reais_valor, volume_entrada, df_sigis=None, data_range=N
     prai_litros_dia = (perdas_ligacoes + perdas_rede) * pressao_media * tma / 24
     prai = prai_litros_dia / 1000
     
+    # Pressão e TMA por localidade, quando informados (planilha 3 ou SIGIS)
+    if prai_parametros is PRAI_A_CALCULAR:
+        prai_parametros = calcular_prai_parametros(df_sigis, data_range, localidades_filtradas)
+    if prai_parametros is not None:
+        prai = prai_parametros['prai']
+        pressao_media = prai_parametros['pressao_media']
+    
     # IVI = PRAC (m³/dia) ÷ PRAI (m³/dia)
     ivi = prac / prai if prai > 0 else 0
     
@@ -417,49 +945,7 @@ def calcular_ivi(perdas_reais_valor, volume_entrada, df_sigis=None, data_range=N
     ipl = calcular_ipl(df_sigis, data_range, localidades_filtradas) if df_sigis is not None else 0
     
     # CLASSIFICAÇÃO BASEADA NA MATRIZ DE LOCALIZAÇÃO
-    def classificar_por_matriz(ivi_valor, ipl_valor, pressao=30):
-        """
-        Classifica baseado na matriz de localização:
-        1. IVI determina a linha (categoria base)
-        2. Pressão determina a coluna (30m)
-        3. IPL deve estar dentro da faixa da célula correspondente
-        """
-        
-        # PASSO 1: Determinar categoria base pelo IVI
-        if ivi_valor <= 4:
-            categoria_ivi = 'A'
-        elif ivi_valor <= 8:
-            categoria_ivi = 'B'
-        elif ivi_valor <= 16:
-            categoria_ivi = 'C'
-        else:
-            categoria_ivi = 'D'
-        
-        # PASSO 2: Definir faixas IPL para pressão 30m
-        faixas_ipl_30m = {
-            'A': (0, 150),      # < 150
-            'B': (150, 300),    # 150-300
-            'C': (300, 600),    # 300-600
-            'D': (600, float('inf'))  # > 600
-        }
-        
-        # PASSO 3: Verificar se IPL está na faixa esperada para a categoria IVI
-        faixa_esperada = faixas_ipl_30m[categoria_ivi]
-        
-        if faixa_esperada[0] <= ipl_valor < faixa_esperada[1]:
-            # IPL está na faixa correta para a categoria IVI
-            return categoria_ivi
-        else:
-            # IPL não está na faixa esperada, determinar categoria real pelo IPL
-            for cat, (min_ipl, max_ipl) in faixas_ipl_30m.items():
-                if min_ipl <= ipl_valor < max_ipl:
-                    return cat
-            
-            # Se IPL for muito alto, retornar D
-            return 'D'
-    
-    # Aplicar classificação por matriz
-    categoria_final = classificar_por_matriz(ivi, ipl, pressao_media)
+    categoria_final = str(classificar_matriz_banco_mundial(ivi, ipl, pressao_media))
     
     return categoria_final, ivi, prac, prai
 
@@ -477,9 +963,6 @@ def calcular_ipl(df_sigis=None, data_range=None, localidades_filtradas=None):
         return 0
     
     try:
-        from datetime import datetime
-        import calendar
-        
         # Códigos SIGIS conforme documentação oficial
         codigo_producao = 1      # Volume Produzido de Água
         codigo_importado = 67    # Volume Importado
@@ -492,17 +975,17 @@ def calcular_ipl(df_sigis=None, data_range=None, localidades_filtradas=None):
         codigo_ligacoes = 9603   # Ligações reais de água faturadas
         
         # Buscar volumes do período (soma) - funciona igual para 1 ou N localidades
-        volume_producao = buscar_dados_sigis(df_sigis, codigo_producao, data_range, localidades_filtradas)
-        volume_importado = buscar_dados_sigis(df_sigis, codigo_importado, data_range, localidades_filtradas)
-        volume_exportado = buscar_dados_sigis(df_sigis, codigo_exportado, data_range, localidades_filtradas)
-        volume_uso_op_1 = buscar_dados_sigis(df_sigis, codigo_uso_op_1, data_range, localidades_filtradas)
-        volume_uso_op_2 = buscar_dados_sigis(df_sigis, codigo_uso_op_2, data_range, localidades_filtradas)
-        volume_uso_op_3 = buscar_dados_sigis(df_sigis, codigo_uso_op_3, data_range, localidades_filtradas)
-        volume_uso_op_4 = buscar_dados_sigis(df_sigis, codigo_uso_op_4, data_range, localidades_filtradas)
-        volume_consumido = buscar_dados_sigis(df_sigis, codigo_consumido, data_range, localidades_filtradas)
+        volume_producao = buscar_dados_sigis(df_sigis, codigo_producao, data_range, localidades_filtradas, origem='calcular_ipl')
+        volume_importado = buscar_dados_sigis(df_sigis, codigo_importado, data_range, localidades_filtradas, origem='calcular_ipl')
+        volume_exportado = buscar_dados_sigis(df_sigis, codigo_exportado, data_range, localidades_filtradas, origem='calcular_ipl')
+        volume_uso_op_1 = buscar_dados_sigis(df_sigis, codigo_uso_op_1, data_range, localidades_filtradas, origem='calcular_ipl')
+        volume_uso_op_2 = buscar_dados_sigis(df_sigis, codigo_uso_op_2, data_range, localidades_filtradas, origem='calcular_ipl')
+        volume_uso_op_3 = buscar_dados_sigis(df_sigis, codigo_uso_op_3, data_range, localidades_filtradas, origem='calcular_ipl')
+        volume_uso_op_4 = buscar_dados_sigis(df_sigis, codigo_uso_op_4, data_range, localidades_filtradas, origem='calcular_ipl')
+        volume_consumido = buscar_dados_sigis(df_sigis, codigo_consumido, data_range, localidades_filtradas, origem='calcular_ipl')
         
         # Buscar ligações - a função já detecta se é 1 ou N localidades automaticamente
-        ligacoes_reais = buscar_ultimo_valor_nao_zerado_simples(df_sigis, codigo_ligacoes, data_range, localidades_filtradas)
+        ligacoes_reais = buscar_ultimo_valor_nao_zerado_simples(df_sigis, codigo_ligacoes, data_range, localidades_filtradas, origem='calcular_ipl')
         
         # Verificar se há dados suficientes
         if ligacoes_reais == 0:
@@ -513,29 +996,7 @@ def calcular_ipl(df_sigis=None, data_range=None, localidades_filtradas=None):
             dias_periodo = 30  # Default
         else:
             data_inicio, data_fim = data_range
-            
-            if data_inicio == data_fim:
-                # Mesmo mês - calcular dias do mês
-                ano = data_inicio // 100
-                mes = data_inicio % 100
-                dias_periodo = calendar.monthrange(ano, mes)[1]
-            else:
-                # Períodos diferentes - calcular dias totais
-                ano_inicio = data_inicio // 100
-                mes_inicio = data_inicio % 100
-                ano_fim = data_fim // 100
-                mes_fim = data_fim % 100
-                
-                # Data de início (primeiro dia do mês inicial)
-                dt_inicio = datetime(ano_inicio, mes_inicio, 1)
-                
-                # Data de fim (último dia do mês final)
-                ultimo_dia_mes_fim = calendar.monthrange(ano_fim, mes_fim)[1]
-                dt_fim = datetime(ano_fim, mes_fim, ultimo_dia_mes_fim)
-                
-                # Calcular diferença em dias
-                diferenca = dt_fim - dt_inicio
-                dias_periodo = diferenca.days + 1  # +1 para incluir o último dia
+            dias_periodo = calcular_dias_periodo(data_inicio, data_fim)
         
         # Somar volumes operacionais
         volume_operacional_total = volume_uso_op_1 + volume_uso_op_2 + volume_uso_op_3 + volume_uso_op_4
@@ -555,19 +1016,30 @@ def calcular_ipl(df_sigis=None, data_range=None, localidades_filtradas=None):
         print(f"Erro ao calcular IPL: {e}")
         return 0
 
-def buscar_ultimo_valor_nao_zerado_simples(df_sigis, codigo_sigis, data_range, localidades_filtradas):
+def buscar_ultimo_valor_nao_zerado_simples(df_sigis, codigo_sigis, data_range, localidades_filtradas, origem='buscar_ultimo_valor_nao_zerado_simples'):
     """Busca o último valor não zerado para dados de estoque (como ligações)"""
     if df_sigis is None:
         return 0
     
+    inicio_consulta = time.perf_counter()
+    linhas_varridas = len(df_sigis) if not isinstance(df_sigis, dict) else 0
     try:
+        # SIGIS tipado: recorte pelo índice de códigos
+        if isinstance(df_sigis, dict):
+            localidade, ano_mes, valores, linhas_varridas = selecionar_linhas_sigis(df_sigis, codigo_sigis, data_range, localidades_filtradas)
+            if localidades_filtradas and len(localidades_filtradas) > 1:
+                if localidade is None:
+                    return 0
+                return somar_ultimos_valores_por_localidade(localidade, ano_mes, valores)
+            return ultimo_valor_positivo(ano_mes, valores)
+        
         # Filtrar pelo código SIGIS
         mask_codigo = df_sigis.iloc[:, 0] == codigo_sigis
-        resultados = df_sigis[mask_codigo].copy()
+        resultados = df_sigis[mask_codigo]
         
         if resultados.empty:
             mask_codigo_str = df_sigis.iloc[:, 0].astype(str) == str(codigo_sigis)
-            resultados = df_sigis[mask_codigo_str].copy()
+            resultados = df_sigis[mask_codigo_str]
         
         if resultados.empty:
             return 0
@@ -642,144 +1114,1456 @@ def buscar_ultimo_valor_nao_zerado_simples(df_sigis, codigo_sigis, data_range, l
     except Exception as e:
         print(f"Erro ao buscar último valor não zerado para código {codigo_sigis}: {e}")
         return 0
-
-# FUNÇÃO PARA CRIAR DADOS DE EXEMPLO
-def create_sample_data():
-    """Cria dados de exemplo para demonstração"""
-    import numpy as np
     
-    # Dados de exemplo para o balanço hídrico
-    sample_data = []
+    finally:
+        registrar_consulta_sigis(codigo_sigis, origem, linhas_varridas, time.perf_counter() - inicio_consulta, data_range, localidades_filtradas)
+
+# MOTOR SQL OPCIONAL (DuckDB)
+# Expõe o SIGIS tipado e o balanço como tabelas e as fórmulas de calcular_ipl/calcular_ivi como macros SQL
+
+# Conexões sem acesso externo: consultas ad hoc não leem arquivos, não instalam extensões nem mudam a configuração
+CONFIGURACAO_DUCKDB = {
+    'enable_external_access': False,
+    'autoinstall_known_extensions': False,
+    'autoload_known_extensions': False,
+    'lock_configuration': True
+}
+
+SQL_MACROS_INDICADORES = """
+CREATE OR REPLACE MACRO dias_periodo(inicio, fim) AS
+    date_diff('day',
+              make_date(CAST(inicio // 100 AS BIGINT), CAST(inicio % 100 AS BIGINT), 1),
+              make_date(CAST(fim // 100 AS BIGINT), CAST(fim % 100 AS BIGINT), 1) + INTERVAL 1 MONTH);
+
+-- IPL = 1000 × (Prod + Imp - Exp - ∑Oper - Cons) / (Lig × Dias)
+CREATE OR REPLACE MACRO formula_ipl(numerador, ligacoes, dias) AS
+    CASE WHEN coalesce(ligacoes, 0) > 0 THEN greatest(0, 1000 * coalesce(numerador, 0) / (ligacoes * dias)) ELSE 0 END;
+
+-- IVI = PRAC ÷ PRAI, com pressão média 30 m e TMA 24 h
+CREATE OR REPLACE MACRO formula_ivi(perdas_reais, volume_entrada, ligacoes, extensao_rede_km, dias) AS
+    CASE WHEN coalesce(volume_entrada, 0) = 0 OR coalesce(ligacoes, 0) = 0 OR coalesce(extensao_rede_km, 0) = 0 THEN NULL
+         ELSE (coalesce(perdas_reais, 0) / dias) / ((0.8 * ligacoes + 18 * extensao_rede_km) * 30 * 24 / 24 / 1000) END;
+
+-- Matriz do Banco Mundial (30 m): a categoria final segue a faixa de IPL
+CREATE OR REPLACE MACRO categoria_ipl(ipl) AS
+    CASE WHEN ipl >= 0 AND ipl < 150 THEN 'A' WHEN ipl >= 150 AND ipl < 300 THEN 'B'
+         WHEN ipl >= 300 AND ipl < 600 THEN 'C' ELSE 'D' END;
+
+CREATE OR REPLACE VIEW sigis_positivo AS
+    SELECT codigo, cod_localidade, ano_mes, valor FROM sigis WHERE valor > 0;
+
+CREATE OR REPLACE VIEW localidades AS
+    SELECT cod_localidade,
+           first(cod_regional) AS cod_regional, first(nome_regional) AS nome_regional,
+           first(cod_municipio) AS cod_municipio, first(nome_municipio) AS nome_municipio,
+           first(nome_localidade) AS nome_localidade
+    FROM balanco GROUP BY cod_localidade;
+
+-- Colunas aditivas por localidade: somar linhas e aplicar as fórmulas reproduz o cálculo agregado
+CREATE OR REPLACE MACRO indicadores_localidade(inicio, fim) AS TABLE
+    WITH volumes AS (
+        SELECT cod_localidade,
+               sum(valor) FILTER (WHERE codigo = 1) AS volume_producao,
+               sum(valor) FILTER (WHERE codigo = 67) AS volume_importado,
+               sum(valor) FILTER (WHERE codigo = 68) AS volume_exportado,
+               sum(valor) FILTER (WHERE codigo IN (29, 30, 31, 32)) AS volume_operacional,
+               sum(valor) FILTER (WHERE codigo = 9642) AS volume_consumido,
+               arg_max(valor, ano_mes) FILTER (WHERE codigo = 9603) AS ligacoes,
+               arg_max(valor, ano_mes) FILTER (WHERE codigo = 33) AS extensao_rede_km
+        FROM sigis_positivo
+        WHERE ano_mes BETWEEN inicio AND fim AND codigo IN (1, 67, 68, 29, 30, 31, 32, 9642, 9603, 33)
+        GROUP BY cod_localidade
+    ), balanco_periodo AS (
+        SELECT cod_localidade,
+               sum(valor) FILTER (WHERE nome_info = 'Volume de Entrada') AS volume_entrada,
+               sum(valor) FILTER (WHERE nome_info = 'Volume de Perdas') AS perdas_totais,
+               sum(valor) FILTER (WHERE nome_info = 'Perdas Reais') AS perdas_reais
+        FROM balanco WHERE ano_mes BETWEEN inicio AND fim GROUP BY cod_localidade
+    )
+    SELECT l.*,
+           coalesce(b.volume_entrada, 0) AS volume_entrada, coalesce(b.perdas_totais, 0) AS perdas_totais,
+           coalesce(b.perdas_reais, 0) AS perdas_reais,
+           coalesce(v.volume_producao, 0) + coalesce(v.volume_importado, 0) - coalesce(v.volume_exportado, 0)
+               - coalesce(v.volume_operacional, 0) - coalesce(v.volume_consumido, 0) AS numerador_ipl,
+           coalesce(v.ligacoes, 0) AS ligacoes, coalesce(v.extensao_rede_km, 0) AS extensao_rede_km,
+           dias_periodo(inicio, fim) AS dias,
+           formula_ipl(numerador_ipl, ligacoes, dias) AS ipl,
+           formula_ivi(perdas_reais, volume_entrada, ligacoes, extensao_rede_km, dias) AS ivi,
+           CASE WHEN ivi IS NULL THEN 'N/A' ELSE categoria_ipl(ipl) END AS categoria
+    FROM localidades l
+    LEFT JOIN volumes v USING (cod_localidade)
+    LEFT JOIN balanco_periodo b USING (cod_localidade);
+
+-- IPL por município em janelas móveis de 12 meses terminando em cada mês com dados
+CREATE OR REPLACE VIEW ipl_municipio_12m AS
+    WITH meses AS (
+        SELECT DISTINCT ano_mes AS fim, (ano_mes // 100) * 12 + ano_mes % 100 - 12 AS mes_inicio
+        FROM sigis WHERE ano_mes > 0
+    ), janelas AS (
+        SELECT fim, (mes_inicio // 12) * 100 + mes_inicio % 12 + 1 AS inicio FROM meses
+    ), por_localidade AS (
+        SELECT j.inicio, j.fim, s.cod_localidade,
+               sum(CASE WHEN s.codigo IN (1, 67) THEN s.valor
+                        WHEN s.codigo IN (68, 29, 30, 31, 32, 9642) THEN -s.valor ELSE 0 END) AS numerador_ipl,
+               coalesce(arg_max(s.valor, s.ano_mes) FILTER (WHERE s.codigo = 9603), 0) AS ligacoes
+        FROM janelas j
+        JOIN sigis_positivo s ON s.ano_mes BETWEEN j.inicio AND j.fim
+        WHERE s.codigo IN (1, 67, 68, 29, 30, 31, 32, 9642, 9603)
+        GROUP BY j.inicio, j.fim, s.cod_localidade
+    )
+    SELECT l.cod_regional, l.nome_regional, l.cod_municipio, l.nome_municipio, p.inicio, p.fim,
+           sum(p.numerador_ipl) AS numerador_ipl, sum(p.ligacoes) AS ligacoes,
+           dias_periodo(p.inicio, p.fim) AS dias,
+           formula_ipl(sum(p.numerador_ipl), sum(p.ligacoes), dias_periodo(p.inicio, p.fim)) AS ipl
+    FROM por_localidade p JOIN localidades l USING (cod_localidade)
+    GROUP BY l.cod_regional, l.nome_regional, l.cod_municipio, l.nome_municipio, p.inicio, p.fim;
+"""
+
+def criar_conexao_sql(sigis_tipado, df):
+    """Cria uma conexão DuckDB em memória com as tabelas sigis e balanco e as macros de indicadores.
+    Retorna {'conexao', 'trava'} ou None quando o motor não está disponível para os dados."""
+    if duckdb is None or sigis_tipado is None or df is None:
+        return None
+    # As fórmulas agregam por cod_localidade: exige a chave numérica no SIGIS
+    if sigis_tipado['chave_localidade'] != 'cod_localidade' or sigis_tipado['localidade'].dtype != np.int32:
+        return None
     
-    # Estrutura hierárquica de exemplo
-    hierarchy = {
-        '1': {'parent': '', 'nome': 'Volume de Entrada', 'valor': 1000000},
-        '2': {'parent': '1', 'nome': 'Consumo Autorizado', 'valor': 750000},
-        '2.1': {'parent': '2', 'nome': 'Consumo Autorizado Faturado', 'valor': 650000},
-        '2.1.1': {'parent': '2.1', 'nome': 'Volume Medido', 'valor': 600000},
-        '2.2': {'parent': '2', 'nome': 'Autorizado não Faturado', 'valor': 100000},
-        '2.2.1': {'parent': '2.2', 'nome': 'Uso Operacional', 'valor': 60000},
-        '2.2.2': {'parent': '2.2', 'nome': 'Uso Emergencial', 'valor': 20000},
-        '2.2.3': {'parent': '2.2', 'nome': 'Uso Social', 'valor': 20000},
-        '3': {'parent': '1', 'nome': 'Volume de Perdas', 'valor': 250000},
-        '3.1': {'parent': '3', 'nome': 'Perdas Aparentes', 'valor': 100000},
-        '3.1.1': {'parent': '3.1', 'nome': 'Clandestinos', 'valor': 30000},
-        '3.1.2': {'parent': '3.1', 'nome': 'Fraudes', 'valor': 20000},
-        '3.1.3': {'parent': '3.1', 'nome': 'Submedição', 'valor': 50000},
-        '3.2': {'parent': '3', 'nome': 'Perdas Reais', 'valor': 150000},
-        '3.2.1': {'parent': '3.2', 'nome': 'Vazamento em Ramais', 'valor': 80000},
-        '3.2.2': {'parent': '3.2', 'nome': 'Outros Vazamentos', 'valor': 70000}
-    }
+    conexao = duckdb.connect(database=':memory:', config=CONFIGURACAO_DUCKDB)
     
-    # Criar dados para 3 localidades e 6 meses
-    localidades = [
-        {'cod': 1001, 'nome': 'Centro', 'municipio': 'Cidade A', 'regional': 'Regional Norte'},
-        {'cod': 1002, 'nome': 'Bairro Sul', 'municipio': 'Cidade A', 'regional': 'Regional Norte'},
-        {'cod': 2001, 'nome': 'Industrial', 'municipio': 'Cidade B', 'regional': 'Regional Sul'}
-    ]
+    # Arrays do SIGIS tipado (ou do arquivo mapeado) entram como tabela Arrow, sem cópia
+    tabela_sigis = pa.table({
+        'codigo': sigis_tipado['codigo'],
+        'cod_localidade': sigis_tipado['localidade'],
+        'ano_mes': sigis_tipado['ano_mes'],
+        'valor': sigis_tipado['valor']
+    })
+    conexao.register('sigis', tabela_sigis)
     
-    meses = [202401, 202402, 202403, 202404, 202405, 202406]
+    colunas_balanco = ['cod_regional', 'nome_regional', 'cod_municipio', 'nome_municipio', 'cod_localidade', 'nome_localidade', 'ano_mes', 'nome_info', 'valor']
+    conexao.register('balanco', df[[c for c in colunas_balanco if c in df.columns]])
     
-    for localidade in localidades:
-        for mes in meses:
-            for item_id, item_data in hierarchy.items():
-                # Adicionar variação aleatória nos valores
-                variacao = np.random.uniform(0.8, 1.2)
-                valor = int(item_data['valor'] * variacao / 3)  # Dividir por 3 localidades
-                
-                nivel_info = f"Nível {len(item_id.split('.'))}"
-                
-                sample_data.append({
-                    'cod_regional': localidade['regional'][:3].upper(),
-                    'nome_regional': localidade['regional'],
-                    'cod_municipio': localidade['cod'] // 1000,
-                    'nome_municipio': localidade['municipio'],
-                    'cod_localidade': localidade['cod'],
-                    'nome_localidade': localidade['nome'],
-                    'ano_mes': mes,
-                    'id': item_id,
-                    'parent': item_data['parent'],
-                    'nivel_info': nivel_info,
-                    'nome_info': item_data['nome'],
-                    'valor': valor,
-                    'valor_acum': valor
-                })
+    conexao.execute(SQL_MACROS_INDICADORES)
     
-    return pd.DataFrame(sample_data)
+    # Tabelas registradas só existem nesta conexão: o acesso entre sessões é serializado
+    return {'conexao': conexao, 'trava': threading.Lock()}
 
-def create_sample_sigis_data():
-    """Cria dados de exemplo do SIGIS"""
-    import numpy as np
+@st.cache_resource(show_spinner=False, max_entries=4)
+def obter_conexao_sql(chave_dados, _sigis_tipado, _df):
+    """Conexão DuckDB compartilhada por conjunto de dados (chave = hash do conteúdo)"""
+    return criar_conexao_sql(_sigis_tipado, _df)
+
+def consultar_sql(conexao, sql, parametros=None):
+    """Executa uma consulta no motor SQL e retorna DataFrame"""
+    with conexao['trava']:
+        return conexao['conexao'].execute(sql, parametros or []).df()
+
+def consultar_sql_isolada(sigis_tipado, df, sql):
+    """Executa uma consulta ad hoc numa conexão própria, descartada ao final:
+    comandos digitados não alteram macros nem tabelas da conexão compartilhada entre sessões"""
+    conexao = criar_conexao_sql(sigis_tipado, df)
+    try:
+        return conexao['conexao'].execute(sql).df()
+    finally:
+        conexao['conexao'].close()
+
+def create_analysis_table_sql(conexao, df_filtered, data_range):
+    """Versão da create_analysis_table com filtro e agrupamento executados no DuckDB"""
+    if df_filtered.empty:
+        return pd.DataFrame()
     
-    # Códigos SIGIS importantes
-    codigos = [1, 67, 68, 29, 30, 31, 32, 9642, 9603, 33]
-    localidades = [1001, 1002, 2001]
-    meses = [202401, 202402, 202403, 202404, 202405, 202406]
+    # Localidades na ordem em que aparecem no recorte, como na versão pandas
+    ordem_localidades = {nome: i for i, nome in enumerate(df_filtered['nome_localidade'].unique())}
+    codigos = [int(c) for c in df_filtered['cod_localidade'].unique()]
     
-    sigis_data = []
+    df_sql = consultar_sql(conexao, """
+        WITH recorte AS (
+            SELECT * FROM indicadores_localidade(?, ?) WHERE cod_localidade IN (SELECT unnest(?))
+        ), grupos AS (
+            SELECT nome_localidade AS Localidade,
+                   first(nome_regional) AS Regional, first(nome_municipio) AS Municipio,
+                   sum(volume_entrada) AS volume_entrada, sum(perdas_totais) AS perdas_totais,
+                   sum(perdas_reais) AS perdas_reais, sum(numerador_ipl) AS numerador_ipl,
+                   sum(ligacoes) AS ligacoes, sum(extensao_rede_km) AS extensao_rede_km,
+                   any_value(dias) AS dias
+            FROM recorte GROUP BY nome_localidade
+        )
+        SELECT Regional, Municipio, Localidade, volume_entrada,
+               100 * volume_entrada / sum(volume_entrada) OVER () AS impacto,
+               100 * perdas_totais / volume_entrada AS perc_perdas,
+               formula_ipl(numerador_ipl, ligacoes, dias) AS ipl,
+               formula_ivi(perdas_reais, volume_entrada, ligacoes, extensao_rede_km, dias) AS ivi
+        FROM grupos WHERE volume_entrada > 0
+    """, [int(data_range[0]), int(data_range[1]), codigos])
     
-    for codigo in codigos:
-        for localidade in localidades:
-            for mes in meses:
-                if codigo == 9603:  # Ligações
-                    valor = np.random.randint(800, 1200)
-                elif codigo == 33:  # Extensão de rede
-                    valor = np.random.uniform(15, 25)
-                elif codigo in [1, 9642]:  # Volumes principais
-                    valor = np.random.uniform(80000, 120000)
-                else:  # Outros volumes
-                    valor = np.random.uniform(1000, 5000)
-                
-                sigis_data.append([
-                    codigo, 'Descrição', localidade, f'Localidade {localidade}',
-                    mes, 'Unidade', 'Tipo', 'Fonte', valor
-                ])
+    if df_sql.empty:
+        return pd.DataFrame()
     
-    columns = ['A', 'B', 'C', 'D', 'ano_mes', 'F', 'G', 'H', 'I']
-    return pd.DataFrame(sigis_data, columns=columns)
+    df_sql['categoria'] = np.where(df_sql['ivi'].isna(), 'N/A', classificar_matriz_banco_mundial(df_sql['ivi'], df_sql['ipl']))
+    df_sql = df_sql.iloc[df_sql['Localidade'].map(ordem_localidades).argsort()]
+    
+    return pd.DataFrame({
+        'Regional': df_sql['Regional'].to_numpy(),
+        'Municipio': df_sql['Municipio'].to_numpy(),
+        'Localidade': df_sql['Localidade'].to_numpy(),
+        'Categoria': df_sql['categoria'].to_numpy(),
+        'Volume Total de entrada': df_sql['volume_entrada'].astype(float).to_numpy(),
+        '% de Impacto': df_sql['impacto'].to_numpy(),
+        '% de perdas': df_sql['perc_perdas'].to_numpy(),
+        'IPL': df_sql['ipl'].to_numpy(),
+        'IVI': df_sql['ivi'].astype(object).where(df_sql['ivi'].notna(), 'N/A').to_numpy()
+    })
 
-# FUNÇÃO PRINCIPAL DE CARREGAMENTO DE DADOS
-@st.cache_data
-def load_data(uploaded_file):
-    """Carrega dados do arquivo enviado"""
+# CUBO MENSAL (agregados por localidade × mês)
+# Base dos cálculos em lote: volumes do SIGIS e itens do balanço somados por localidade e mês
+MEDIDAS_SIGIS_CUBO = {
+    'volume_producao': [1], 'volume_importado': [67], 'volume_exportado': [68],
+    'volume_operacional': [29, 30, 31, 32], 'volume_consumido': [9642],
+    'ligacoes': [9603], 'extensao_rede_km': [33]
+}
+ITENS_BALANCO_CUBO = {'volume_entrada': 'Volume de Entrada', 'perdas_totais': 'Volume de Perdas', 'perdas_reais': 'Perdas Reais'}
+COLUNAS_HIERARQUIA = ['cod_regional', 'nome_regional', 'cod_municipio', 'nome_municipio', 'cod_localidade', 'nome_localidade']
+
+def montar_cubo_mensal(df, sigis_tipado):
+    """Agrega balanço e SIGIS por (cod_localidade, ano_mes), uma coluna por medida.
+    Valores do SIGIS entram só se positivos, como nas consultas; ligações e extensão
+    ficam mensais para que o 'último valor não zerado' seja aplicado na janela desejada."""
+    # Itens do balanço hídrico
+    df_itens = df[df['nome_info'].isin(ITENS_BALANCO_CUBO.values())]
+    balanco = df_itens.pivot_table(
+        index=['cod_localidade', 'ano_mes'], columns='nome_info',
+        values='valor', aggfunc='sum', fill_value=0
+    )
+    balanco = balanco.rename(columns={v: k for k, v in ITENS_BALANCO_CUBO.items()})
+    balanco = balanco.reindex(columns=list(ITENS_BALANCO_CUBO.keys()), fill_value=0)
     
-    if uploaded_file is not None:
-        try:
-            # Carregar planilha 1 (Balanço Hídrico)
-            df = pd.read_excel(uploaded_file, sheet_name=0)  # Primeira planilha
-            
-            if df.empty:
-                st.error("❌ A planilha de Balanço Hídrico (Planilha 1) está vazia!")
-                return None, None
-            
-            expected_columns = ['cod_regional', 'nome_regional', 'cod_municipio', 'nome_municipio', 'cod_localidade', 'nome_localidade', 'ano_mes', 'id', 'parent', 'nivel_info', 'nome_info', 'valor', 'valor_acum']
-            
-            if len(df.columns) >= len(expected_columns):
-                df.columns = expected_columns[:len(df.columns)]
-            else:
-                st.error(f"❌ A planilha de Balanço Hídrico deve ter pelo menos {len(expected_columns)} colunas.")
-                return None, None
-            
-            df['parent'] = df['parent'].fillna("").astype(str).replace('nan', '')
-            
-            # Aplicar formatação de data na coluna ano_mes
-            df['ano_mes_formatted'] = df['ano_mes'].apply(format_ano_mes)
-            
-            required_cols = ['nome_info', 'valor', 'id', 'parent', 'nivel_info']
-            missing_cols = [col for col in required_cols if col not in df.columns]
-            if missing_cols:
-                st.error(f"❌ Colunas obrigatórias faltando na planilha de Balanço Hídrico: {missing_cols}")
+    # Medidas do SIGIS (recortes pelo índice de códigos)
+    partes = []
+    if sigis_por_localidade(sigis_tipado):
+        for medida, codigos in MEDIDAS_SIGIS_CUBO.items():
+            for codigo in codigos:
+                inicio, fim = sigis_tipado['indice'].get(codigo, (0, 0))
+                valor = sigis_tipado['valor'][inicio:fim]
+                positivos = valor > 0
+                partes.append(pd.DataFrame({
+                    'cod_localidade': sigis_tipado['localidade'][inicio:fim][positivos].astype(np.int64),
+                    'ano_mes': sigis_tipado['ano_mes'][inicio:fim][positivos].astype(np.int64),
+                    'medida': medida,
+                    'valor': valor[positivos]
+                }))
+    
+    if partes:
+        sigis = pd.concat(partes, ignore_index=True).pivot_table(
+            index=['cod_localidade', 'ano_mes'], columns='medida',
+            values='valor', aggfunc='sum', fill_value=0
+        )
+    else:
+        sigis = pd.DataFrame(index=balanco.index)
+    sigis = sigis.reindex(columns=list(MEDIDAS_SIGIS_CUBO.keys()), fill_value=0)
+    
+    cubo = balanco.join(sigis, how='outer').fillna(0).reset_index()
+    return juntar_hierarquia_cubo(cubo, df)
+
+def sigis_por_localidade(sigis_tipado):
+    """SIGIS tipado com código de localidade inteiro: só assim suas medidas entram no cubo"""
+    return (sigis_tipado is not None and sigis_tipado['chave_localidade'] == 'cod_localidade'
+            and sigis_tipado['localidade'].dtype == np.int32)
+
+def juntar_hierarquia_cubo(cubo, df):
+    """Junta às medidas do cubo a hierarquia (regional, município, nomes) do balanço, ordenando por localidade e mês"""
+    hierarquia = df.drop_duplicates('cod_localidade')[[c for c in COLUNAS_HIERARQUIA if c in df.columns]]
+    cubo = cubo.merge(hierarquia, on='cod_localidade', how='left')
+    return cubo.sort_values(['cod_localidade', 'ano_mes']).reset_index(drop=True)
+
+def montar_cubo_carregado(df, sigis_tipado, medidas_repositorio=None):
+    """Cubo mensal do conjunto carregado. Aberto do repositório, parte das medidas já somadas em cada
+    partição (carregar_cubo_repositorio), sem reagregar o balanço e o SIGIS inteiros; senão monta do zero"""
+    if medidas_repositorio is None or not sigis_por_localidade(sigis_tipado):
+        return montar_cubo_mensal(df, sigis_tipado)
+    return juntar_hierarquia_cubo(medidas_repositorio, df)
+
+# TENDÊNCIAS E PROJEÇÕES
+# O ajuste das séries (ajustar_tendencias, calcular_tendencia) fica em tendencias.py, coberto por tests/
+def indicadores_mensais_cubo(cubo):
+    """IPL e % de perdas de cada localidade em cada mês, a partir do cubo mensal"""
+    dias = calcular_dias_periodos(cubo['ano_mes'], cubo['ano_mes'])
+    numerador = (cubo['volume_producao'] + cubo['volume_importado'] - cubo['volume_exportado']
+                 - cubo['volume_operacional'] - cubo['volume_consumido'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ipl = np.where(cubo['ligacoes'] > 0, 1000 * numerador / (cubo['ligacoes'] * dias), np.nan)
+        perc_perdas = np.where(cubo['volume_entrada'] > 0, cubo['perdas_totais'] / cubo['volume_entrada'] * 100, np.nan)
+    return cubo[['cod_localidade', 'nome_localidade', 'ano_mes']].assign(ipl=np.maximum(ipl, 0), perc_perdas=perc_perdas)
+
+def ranquear_deterioracao(indicadores, indicador='ipl', periodos_futuros=6, metodo='linear'):
+    """Projeta o indicador de todas as localidades de uma vez e ordena pela piora projetada
+    (valor projetado ao fim do horizonte menos o último valor observado)"""
+    matriz = indicadores.pivot_table(index='cod_localidade', columns='ano_mes', values=indicador, aggfunc='sum')
+    if matriz.empty:
+        return pd.DataFrame(columns=['cod_localidade', 'nome_localidade', 'ultimo_valor', 'valor_projetado', 'inclinacao', 'variacao'])
+    # Eixo contínuo de meses: um mês sem dados em nenhuma localidade não encurta a série
+    matriz = matriz.reindex(columns=gerar_eixo_meses(int(matriz.columns.min()), int(matriz.columns.max())))
+    
+    ajuste = ajustar_tendencias(matriz.to_numpy(), periodos_futuros, metodo)
+    ultimo_valor = matriz.where(matriz != 0).ffill(axis=1).iloc[:, -1].to_numpy()
+    nomes = indicadores.drop_duplicates('cod_localidade').set_index('cod_localidade')['nome_localidade']
+    
+    ranking = pd.DataFrame({
+        'cod_localidade': matriz.index,
+        'nome_localidade': matriz.index.map(nomes),
+        'ultimo_valor': ultimo_valor,
+        'valor_projetado': ajuste['projecao'][:, -1],
+        'inclinacao': ajuste['inclinacao']
+    })[ajuste['valido']]
+    ranking['variacao'] = ranking['valor_projetado'] - ranking['ultimo_valor']
+    return ranking.sort_values('variacao', ascending=False).reset_index(drop=True)
+
+NIVEIS_SERIES = {'regional': ('cod_regional', 'nome_regional'), 'municipio': ('cod_municipio', 'nome_municipio')}
+
+def series_mensais_niveis(cubo):
+    """Medidas do cubo somadas por mês em cada nível (regional, município e total), com
+    IPL e % de perdas mensais de cada série"""
+    medidas = list(ITENS_BALANCO_CUBO) + list(MEDIDAS_SIGIS_CUBO)
+    partes = []
+    for nivel, (coluna_codigo, coluna_nome) in NIVEIS_SERIES.items():
+        if coluna_codigo in cubo.columns and coluna_nome in cubo.columns:
+            agregado = cubo.groupby([coluna_codigo, coluna_nome, 'ano_mes'], as_index=False, dropna=False)[medidas].sum()
+            partes.append(agregado.rename(columns={coluna_codigo: 'codigo', coluna_nome: 'nome'}).assign(nivel=nivel))
+    partes.append(cubo.groupby('ano_mes', as_index=False)[medidas].sum().assign(nivel='total', codigo=np.nan, nome='Total'))
+    
+    series = pd.concat(partes, ignore_index=True)
+    indicadores = indicadores_mensais_cubo(series.rename(columns={'codigo': 'cod_localidade', 'nome': 'nome_localidade'}))
+    return series[['nivel', 'codigo', 'nome', 'ano_mes']].assign(
+        ipl=indicadores['ipl'].to_numpy(), perc_perdas=indicadores['perc_perdas'].to_numpy()
+    )
+
+# SIMULAÇÃO DE CENÁRIOS
+# A base por localidade é montada uma vez por recorte (filtros + período); cada cenário
+# é um delta vetorizado sobre ela, sem nova leitura do SIGIS
+IDM_POR_IDADE = np.array([95.00, 93.50, 92.00, 90.30, 88.50, 86.80, 85.00, 83.00, 80.00, 77.00, 74.00, 71.00, 71.00, 71.00, 71.00, 71.00])
+CODIGOS_HIDROMETROS = list(range(7380, 7441, 4))
+CODIGOS_VOLUME_HIDROMETROS = list(range(7444, 7505, 4))
+EFICIENCIA_TROCA_HIDROMETROS = 0.7  # redução da submedição após a troca (premissa da Economia Potencial)
+SEM_TROCA = len(IDM_POR_IDADE)  # idade mínima que não troca nenhum hidrômetro
+
+def somar_por_localidade(sigis_tipado, codigos, data_range, localidades):
+    """Soma dos valores positivos de cada localidade (alinhada a `localidades`, ordenadas) nos códigos"""
+    total = np.zeros(len(localidades))
+    for codigo in codigos:
+        localidade, _, valor, _ = selecionar_linhas_sigis(sigis_tipado, codigo, data_range, localidades.tolist())
+        positivos = valor > 0
+        posicao = np.searchsorted(localidades, localidade[positivos])
+        total += np.bincount(posicao, weights=valor[positivos], minlength=len(localidades))
+    return total
+
+def ultimo_por_localidade(sigis_tipado, codigo, data_range, localidades):
+    """Valor positivo do mês mais recente de cada localidade (alinhado a `localidades`; 0 se não houver)"""
+    localidade, _, valor, _ = selecionar_linhas_sigis(sigis_tipado, codigo, data_range, localidades.tolist())
+    localidade, valor = ultimos_valores_por_localidade(localidade, valor)
+    resultado = np.zeros(len(localidades))
+    resultado[np.searchsorted(localidades, localidade)] = valor
+    return resultado
+
+def montar_tabela_hidrometros(sigis_tipado):
+    """Hidrômetros e volume micromedido por idade (valores positivos do SIGIS), por localidade e mês.
+    Retorna None se o SIGIS não tiver cod_localidade numérico."""
+    if (sigis_tipado is None or sigis_tipado['chave_localidade'] != 'cod_localidade'
+            or sigis_tipado['localidade'].dtype != np.int32):
+        return None
+
+    partes = []
+    for prefixo, codigos in [('hidrometros', CODIGOS_HIDROMETROS), ('volume', CODIGOS_VOLUME_HIDROMETROS)]:
+        for idade, codigo in enumerate(codigos):
+            inicio, fim = sigis_tipado['indice'].get(codigo, (0, 0))
+            valor = sigis_tipado['valor'][inicio:fim]
+            positivos = valor > 0
+            partes.append(pd.DataFrame({
+                'cod_localidade': sigis_tipado['localidade'][inicio:fim][positivos].astype(np.int64),
+                'ano_mes': sigis_tipado['ano_mes'][inicio:fim][positivos].astype(np.int64),
+                'medida': f"{prefixo}_idade_{idade}",
+                'valor': valor[positivos]
+            }))
+
+    linhas = pd.concat(partes, ignore_index=True)
+    if linhas.empty:
+        return None
+    medidas = [f"{prefixo}_idade_{idade}" for prefixo in ['hidrometros', 'volume'] for idade in range(len(CODIGOS_HIDROMETROS))]
+    tabela = linhas.pivot_table(index=['cod_localidade', 'ano_mes'], columns='medida', values='valor', aggfunc='sum', fill_value=0)
+    return tabela.reindex(columns=medidas, fill_value=0).reset_index().rename_axis(columns=None)
+
+def montar_base_cenarios(df_filtered, sigis_tipado, data_range, parametros=None):
+    """Agregados por localidade do recorte: balanço, numerador do IPL, ligações, extensão,
+    pressão/TMA e, por idade, quantidade de hidrômetros e volume submedido"""
+    localidades = np.unique(df_filtered['cod_localidade'].to_numpy(dtype=np.int64))
+    
+    itens = df_filtered[df_filtered['nome_info'].isin(ITENS_BALANCO_CUBO.values())].pivot_table(
+        index='cod_localidade', columns='nome_info', values='valor', aggfunc='sum'
+    ).reindex(index=localidades, columns=list(ITENS_BALANCO_CUBO.values())).fillna(0)
+    itens.columns = list(ITENS_BALANCO_CUBO.keys())
+    
+    volumes = {medida: somar_por_localidade(sigis_tipado, codigos, data_range, localidades)
+               for medida, codigos in MEDIDAS_SIGIS_CUBO.items() if medida not in ('ligacoes', 'extensao_rede_km')}
+    
+    if parametros is not None:
+        pressao_media, tma = parametros_por_localidade(parametros, localidades, data_range)
+    else:
+        pressao_media = np.full(len(localidades), float(PRESSAO_MEDIA_PADRAO))
+        tma = np.full(len(localidades), float(TMA_PADRAO))
+    
+    volume_micromedido = np.column_stack([ultimo_por_localidade(sigis_tipado, c, data_range, localidades) for c in CODIGOS_VOLUME_HIDROMETROS])
+    
+    return {
+        'localidades': localidades,
+        'nomes': df_filtered.drop_duplicates('cod_localidade').set_index('cod_localidade')['nome_localidade'].reindex(localidades).to_numpy(),
+        'dias': calcular_dias_periodo(*data_range),
+        'volume_entrada': itens['volume_entrada'].to_numpy(dtype=np.float64),
+        'perdas_totais': itens['perdas_totais'].to_numpy(dtype=np.float64),
+        'perdas_reais': itens['perdas_reais'].to_numpy(dtype=np.float64),
+        'numerador_ipl': (volumes['volume_producao'] + volumes['volume_importado'] - volumes['volume_exportado']
+                          - volumes['volume_operacional'] - volumes['volume_consumido']),
+        'ligacoes': ultimo_por_localidade(sigis_tipado, 9603, data_range, localidades),
+        'extensao_rede_km': ultimo_por_localidade(sigis_tipado, 33, data_range, localidades),
+        'pressao_media': pressao_media,
+        'tma': tma,
+        'hidrometros': np.column_stack([ultimo_por_localidade(sigis_tipado, c, data_range, localidades) for c in CODIGOS_HIDROMETROS]),
+        'volume_submedido': volume_micromedido / (IDM_POR_IDADE / 100) - volume_micromedido
+    }
+
+def avaliar_cenarios(base, reducao_perdas_reais=0, idade_minima_troca=SEM_TROCA, localidades_alvo=None,
+                     eficiencia_troca=EFICIENCIA_TROCA_HIDROMETROS):
+    """Avalia todos os cenários de uma vez (listas de mesmo tamanho ou escalares):
+    - reducao_perdas_reais: % de redução das perdas reais nas localidades alvo
+    - idade_minima_troca: troca dos hidrômetros com essa idade ou mais (SEM_TROCA = nenhum)
+    A redução de perdas reais diminui a produção necessária; a troca converte parte do
+    volume submedido em consumo medido. Retorna um DataFrame com os indicadores de cada cenário."""
+    reducao, idade = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(reducao_perdas_reais, dtype=np.float64)),
+        np.atleast_1d(np.asarray(idade_minima_troca, dtype=np.int64))
+    )
+    alvo = np.ones(len(base['localidades']), dtype=bool) if localidades_alvo is None else np.isin(base['localidades'], list(localidades_alvo))
+    
+    # Volume submedido das idades ≥ N para cada N (a última coluna corresponde a nenhuma troca)
+    submedido_acumulado = np.column_stack([base['volume_submedido'][:, ::-1].cumsum(axis=1)[:, ::-1], np.zeros(len(alvo))])
+    recuperado = eficiencia_troca * submedido_acumulado[:, np.clip(idade, 0, SEM_TROCA)].T * alvo
+    reducao_reais = reducao[:, None] / 100 * base['perdas_reais'] * alvo
+    
+    dias = base['dias']
+    volume_entrada = (base['volume_entrada'] - reducao_reais).sum(axis=1)
+    perdas_totais = (base['perdas_totais'] - reducao_reais - recuperado).sum(axis=1)
+    perdas_reais = (base['perdas_reais'] - reducao_reais).sum(axis=1)
+    numerador = (base['numerador_ipl'] - reducao_reais - recuperado).sum(axis=1)
+    ligacoes = base['ligacoes'].sum()
+    extensao = base['extensao_rede_km'].sum()
+    
+    prai_localidades = calcular_prai_localidades(base['ligacoes'], base['extensao_rede_km'], base['pressao_media'], base['tma'])
+    peso = calcular_prai_localidades(base['ligacoes'], base['extensao_rede_km'], 1, 1)
+    pressao = (peso * base['pressao_media']).sum() / peso.sum() if peso.sum() > 0 else PRESSAO_MEDIA_PADRAO
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ipl = np.maximum(0, 1000 * numerador / (ligacoes * dias)) if ligacoes > 0 else np.zeros(len(reducao))
+        ivi = (perdas_reais / dias) / prai_localidades.sum() if prai_localidades.sum() > 0 else np.zeros(len(reducao))
+        perc_perdas = np.where(volume_entrada > 0, perdas_totais / volume_entrada * 100, 0)
+    
+    calculavel = (volume_entrada > 0) & (ligacoes > 0) & (extensao > 0)
+    return pd.DataFrame({
+        'reducao_perdas_reais': reducao,
+        'idade_minima_troca': idade,
+        'volume_entrada': volume_entrada,
+        'perdas_totais': perdas_totais,
+        'perc_perdas': perc_perdas,
+        'volume_recuperado': recuperado.sum(axis=1),
+        'ipl': ipl,
+        'ivi': np.where(calculavel, ivi, np.nan),
+        'categoria': np.where(calculavel, classificar_matriz_banco_mundial(ivi, ipl, pressao), 'N/A')
+    })
+
+def otimizar_troca_hidrometros(base, orcamento, custo_unitario, modo='fracionado', idade_minima=0,
+                               eficiencia_troca=EFICIENCIA_TROCA_HIDROMETROS):
+    """Escolhe quais faixas de idade em quais localidades trocar para maximizar o volume
+    submedido recuperado dentro do orçamento. Cada item (localidade, idade) rende
+    eficiência × submedido / quantidade por hidrômetro; a ordenação por esse rendimento
+    resolve a mochila fracionada ('fracionado': o último item é trocado em parte, em
+    hidrômetros inteiros). Em 'lotes' cada faixa é trocada inteira ou não (guloso pela
+    mesma ordem, pulando os lotes que não cabem). Retorna os itens escolhidos."""
+    quantidade = base['hidrometros'].copy()
+    quantidade[:, :idade_minima] = 0
+    localidade_item, idade_item = np.nonzero(quantidade > 0)
+    quantidade = quantidade[localidade_item, idade_item]
+    recuperavel = eficiencia_troca * base['volume_submedido'][localidade_item, idade_item]
+    
+    rendimento = recuperavel / quantidade
+    ordem = np.argsort(-rendimento, kind='stable')
+    localidade_item, idade_item = localidade_item[ordem], idade_item[ordem]
+    quantidade, recuperavel, rendimento = quantidade[ordem], recuperavel[ordem], rendimento[ordem]
+    custo = quantidade * custo_unitario
+    
+    if modo == 'lotes':
+        # Guloso 0/1: percorre em ordem de rendimento; um lote entra se ainda couber
+        escolhido = np.zeros(len(custo), dtype=bool)
+        saldo = orcamento
+        for posicao in np.flatnonzero(custo <= orcamento):
+            if custo[posicao] <= saldo:
+                escolhido[posicao] = True
+                saldo -= custo[posicao]
+        trocados = np.where(escolhido, quantidade, 0)
+    else:
+        custo_acumulado_antes = np.cumsum(custo) - custo
+        saldo = np.clip(orcamento - custo_acumulado_antes, 0, None)
+        trocados = np.minimum(quantidade, np.floor(saldo / custo_unitario)) if custo_unitario > 0 else quantidade
+    
+    selecionado = trocados > 0
+    return pd.DataFrame({
+        'cod_localidade': base['localidades'][localidade_item[selecionado]],
+        'nome_localidade': base['nomes'][localidade_item[selecionado]],
+        'idade': idade_item[selecionado],
+        'hidrometros_trocados': trocados[selecionado],
+        'hidrometros_faixa': quantidade[selecionado],
+        'custo': trocados[selecionado] * custo_unitario,
+        'volume_recuperado': trocados[selecionado] * rendimento[selecionado],
+        'recuperado_por_hidrometro': rendimento[selecionado]
+    })
+
+# QUALIDADE DOS DADOS DO SIGIS
+# Varredura única por conjunto de dados sobre as colunas tipadas (séries = código × localidade)
+LIMITE_SALTO_SIGIS = 3.0  # razão entre meses consecutivos acima da qual o salto é sinalizado
+CODIGOS_SIGIS_ESSENCIAIS = [1, 9603, 9642]  # produção, ligações e consumo: devem existir em todo mês do balanço
+CODIGOS_SIGIS_IPL = [1, 67, 68, 29, 30, 31, 32, 9642, 9603]
+TIPOS_OCORRENCIA = {
+    'nao_numerico': 'Valor não numérico',
+    'negativo': 'Valor negativo',
+    'zero': 'Zero em série com valores',
+    'salto': 'Salto entre meses',
+    'mes_ausente': 'Meses ausentes',
+    'duplicado': 'Mês duplicado',
+    'sem_sigis': 'Mês do balanço sem SIGIS',
+    'fora_balanco': 'Localidade fora do balanço'
+}
+
+def varrer_qualidade_sigis(sigis_tipado, df=None, limite_salto=LIMITE_SALTO_SIGIS):
+    """Sinaliza, em uma passada vetorizada, valores não numéricos, negativos, zeros em séries
+    com valores, saltos entre meses consecutivos, meses ausentes ou duplicados e, com o
+    balanço, meses sem os códigos essenciais e localidades do SIGIS fora do balanço.
+    Retorna uma linha por ocorrência (codigo, localidade, ano_mes, tipo, valor, detalhe)."""
+    colunas = ['codigo', 'localidade', 'ano_mes', 'tipo', 'valor', 'detalhe']
+    if sigis_tipado is None or sigis_tipado['num_linhas'] == 0:
+        return pd.DataFrame(columns=colunas)
+    
+    codigo = np.asarray(sigis_tipado['codigo'])
+    ano_mes = np.asarray(sigis_tipado['ano_mes']).astype(np.int64)
+    valor = np.asarray(sigis_tipado['valor'])
+    localidade = sigis_tipado['localidade'] if sigis_tipado['localidade'] is not None else np.zeros(len(codigo), dtype=np.int32)
+    localidade = np.asarray(localidade)
+    
+    # Início de cada série (código × localidade): as linhas já estão ordenadas por código, localidade e mês
+    mesma_serie = np.append(False, (codigo[1:] == codigo[:-1]) & (localidade[1:] == localidade[:-1]))
+    serie = np.cumsum(~mesma_serie) - 1
+    positivo = valor > 0
+    serie_com_valores = np.bincount(serie, weights=positivo)[serie] > 0
+    
+    indice_mes = ano_mes // 100 * 12 + ano_mes % 100
+    intervalo = np.append(0, np.diff(indice_mes))
+    anterior = np.append(np.nan, valor[:-1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        razao = valor / anterior
+    
+    marcadores = {
+        'nao_numerico': np.isnan(valor),
+        'negativo': valor < 0,
+        'zero': (valor == 0) & serie_com_valores,
+        'salto': mesma_serie & positivo & (anterior > 0) & ((razao > limite_salto) | (razao < 1 / limite_salto)),
+        'mes_ausente': mesma_serie & (intervalo > 1),
+        'duplicado': mesma_serie & (intervalo == 0)
+    }
+    if sigis_tipado['localidade'] is None:
+        # Sem coluna de localidade as séries misturam localidades: só valem as checagens de valor
+        marcadores = {tipo: marcadores[tipo] for tipo in ['nao_numerico', 'negativo']}
+    detalhes = {
+        'salto': lambda linhas: [f"{r:.1f}× o mês anterior".replace(".", ",") for r in razao[linhas]],
+        'mes_ausente': lambda linhas: [f"{int(n) - 1} mês(es) sem dados antes deste" for n in intervalo[linhas]]
+    }
+    
+    partes = []
+    for tipo, marcador in marcadores.items():
+        linhas = np.flatnonzero(marcador)
+        if len(linhas) == 0:
+            continue
+        partes.append(pd.DataFrame({
+            'codigo': codigo[linhas], 'localidade': localidade[linhas], 'ano_mes': ano_mes[linhas],
+            'tipo': tipo, 'valor': valor[linhas],
+            'detalhe': detalhes[tipo](linhas) if tipo in detalhes else ''
+        }))
+    
+    # Consistência com o balanço: chaves (localidade, mês) de um lado e do outro
+    chave = sigis_tipado['chave_localidade']
+    if df is not None and chave in df.columns and sigis_tipado['localidade'] is not None:
+        localidades_balanco = df[chave].to_numpy()
+        if localidade.dtype != object:
+            localidades_balanco = pd.to_numeric(df[chave], errors='coerce').to_numpy()
+        # Linhas sem ano_mes numérico não têm mês a conferir
+        meses_balanco = pd.to_numeric(df['ano_mes'], errors='coerce').to_numpy()
+        com_mes = ~np.isnan(meses_balanco)
+        pares_balanco = pd.MultiIndex.from_arrays([localidades_balanco[com_mes], meses_balanco[com_mes].astype(np.int64)]).unique()
+        
+        for codigo_essencial in CODIGOS_SIGIS_ESSENCIAIS:
+            inicio, fim = sigis_tipado['indice'].get(codigo_essencial, (0, 0))
+            pares_sigis = pd.MultiIndex.from_arrays([localidade[inicio:fim], ano_mes[inicio:fim]])
+            faltando = pares_balanco[~pares_balanco.isin(pares_sigis)]
+            if len(faltando):
+                partes.append(pd.DataFrame({
+                    'codigo': codigo_essencial, 'localidade': faltando.get_level_values(0), 'ano_mes': faltando.get_level_values(1),
+                    'tipo': 'sem_sigis', 'valor': np.nan, 'detalhe': 'código ausente no SIGIS para este mês'
+                }))
+        
+        fora = ~pd.Index(localidade).isin(pd.Index(localidades_balanco).unique())
+        if fora.any():
+            _, primeira = np.unique(localidade[fora], return_index=True)
+            linhas = np.flatnonzero(fora)[primeira]
+            partes.append(pd.DataFrame({
+                'codigo': codigo[linhas], 'localidade': localidade[linhas], 'ano_mes': ano_mes[linhas],
+                'tipo': 'fora_balanco', 'valor': valor[linhas], 'detalhe': 'localidade presente só no SIGIS'
+            }))
+    
+    if not partes:
+        return pd.DataFrame(columns=colunas)
+    return pd.concat(partes, ignore_index=True)[colunas]
+
+def filtrar_ocorrencias(ocorrencias, data_range, localidades=None, codigos=None):
+    """Ocorrências do período, das localidades e dos códigos pedidos"""
+    mascara = ocorrencias['ano_mes'].between(data_range[0], data_range[1])
+    if localidades:
+        mascara &= ocorrencias['localidade'].isin(list(localidades))
+    if codigos is not None:
+        mascara &= ocorrencias['codigo'].isin(codigos)
+    return ocorrencias[mascara]
+
+# CONCILIAÇÃO BALANÇO × SIGIS
+# As duas fontes descrevem os mesmos volumes: entrada = produção + importado − exportado;
+# perdas = entrada − operacional − consumido
+LIMITE_CONCILIACAO = 0.05  # diferença relativa tolerada entre balanço e SIGIS
+
+def conciliar_balanco_sigis(cubo, limite=LIMITE_CONCILIACAO):
+    """Compara, por localidade × mês do cubo, o Volume de Entrada e o Volume de Perdas do
+    balanço com os volumes equivalentes do SIGIS. Diferença relativa = |balanço − SIGIS| /
+    maior dos dois. Retorna (meses, localidades): o detalhe mensal e o resumo por localidade,
+    com a sinalização onde a diferença passa do limite."""
+    entrada_sigis = cubo['volume_producao'] + cubo['volume_importado'] - cubo['volume_exportado']
+    perdas_sigis = entrada_sigis - cubo['volume_operacional'] - cubo['volume_consumido']
+    
+    meses = cubo[['cod_localidade', 'nome_localidade', 'ano_mes', 'volume_entrada', 'perdas_totais']].assign(
+        entrada_sigis=entrada_sigis, perdas_sigis=perdas_sigis
+    )
+    
+    def diferenca_relativa(balanco, sigis):
+        escala = np.maximum(np.abs(balanco), np.abs(sigis))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(escala > 0, np.abs(balanco - sigis) / escala, 0.0)
+    
+    meses['dif_entrada'] = meses['volume_entrada'] - meses['entrada_sigis']
+    meses['dif_perdas'] = meses['perdas_totais'] - meses['perdas_sigis']
+    meses['dif_rel_entrada'] = diferenca_relativa(meses['volume_entrada'], meses['entrada_sigis'])
+    meses['dif_rel_perdas'] = diferenca_relativa(meses['perdas_totais'], meses['perdas_sigis'])
+    meses['divergente'] = (meses['dif_rel_entrada'] > limite) | (meses['dif_rel_perdas'] > limite)
+    
+    localidades = meses.groupby(['cod_localidade', 'nome_localidade'], as_index=False, dropna=False).agg(
+        volume_entrada=('volume_entrada', 'sum'), entrada_sigis=('entrada_sigis', 'sum'),
+        perdas_totais=('perdas_totais', 'sum'), perdas_sigis=('perdas_sigis', 'sum'),
+        meses=('ano_mes', 'size'), meses_divergentes=('divergente', 'sum')
+    )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        localidades['razao_entrada'] = np.where(localidades['entrada_sigis'] != 0, localidades['volume_entrada'] / localidades['entrada_sigis'], np.nan)
+        localidades['razao_perdas'] = np.where(localidades['perdas_sigis'] != 0, localidades['perdas_totais'] / localidades['perdas_sigis'], np.nan)
+    localidades['dif_rel_entrada'] = diferenca_relativa(localidades['volume_entrada'], localidades['entrada_sigis'])
+    localidades['dif_rel_perdas'] = diferenca_relativa(localidades['perdas_totais'], localidades['perdas_sigis'])
+    localidades['divergente'] = (localidades['dif_rel_entrada'] > limite) | (localidades['dif_rel_perdas'] > limite)
+    localidades = localidades.sort_values(['divergente', 'dif_rel_entrada'], ascending=False).reset_index(drop=True)
+    return meses, localidades
+
+# CACHE DE FIGURAS
+# Figuras Plotly guardadas na sessão e chaveadas pelo hash das entradas: um gráfico cujas
+# entradas não mudaram é reaproveitado no rerun; os gráficos de evolução partem de modelos
+# com as faixas e linhas de referência já montadas e só recebem os traços novos
+def calcular_hash_entradas(*entradas):
+    """Hash das entradas de uma figura (DataFrames, séries, arrays e valores simples)"""
+    hash_entradas = hashlib.sha1()
+    for entrada in entradas:
+        if isinstance(entrada, pd.DataFrame):
+            hash_entradas.update(repr(list(entrada.columns)).encode())
+            hash_entradas.update(calcular_hash_dataframe(entrada).encode())
+        elif isinstance(entrada, (pd.Series, np.ndarray)):
+            hash_entradas.update(pd.util.hash_pandas_object(pd.Series(entrada), index=False).to_numpy().tobytes())
+        else:
+            hash_entradas.update(repr(entrada).encode())
+        hash_entradas.update(b'|')
+    return hash_entradas.hexdigest()
+
+def obter_figura_cache(nome, chave):
+    """Retorna a figura guardada para o gráfico se a chave das entradas for a mesma"""
+    registro = st.session_state.get('figuras', {}).get(nome)
+    if registro is not None and registro[0] == chave:
+        return registro[1]
+    return None
+
+def guardar_figura_cache(nome, chave, figura):
+    """Guarda a figura do gráfico (uma por nome: a versão anterior é descartada)"""
+    if 'figuras' not in st.session_state:
+        st.session_state.figuras = {}
+    st.session_state.figuras[nome] = (chave, figura)
+
+@st.cache_resource(show_spinner=False)
+def modelo_grafico_ipl():
+    """Figura base da evolução do IPL: linhas de referência das categorias e layout.
+    Compartilhada entre reruns e sessões: quem usa copia com go.Figure(modelo_grafico_ipl())"""
+    figura = go.Figure()
+    figura.add_hline(y=150, line_dash="dot", line_color="#83CCEB", annotation_text="Cat. A (150)")
+    figura.add_hline(y=300, line_dash="dot", line_color="#FFE07D", annotation_text="Cat. B (300)")
+    figura.add_hline(y=600, line_dash="dot", line_color="#ED9283", annotation_text="Cat. C (600)")
+    figura.update_layout(
+        height=450,
+        xaxis_title="Período",
+        yaxis_title="IPL (Litros/ligação/dia)",
+        hovermode='x unified',
+        margin=dict(t=10, b=40, l=50, r=20)
+    )
+    return figura
+
+@st.cache_resource(show_spinner=False)
+def modelo_grafico_perdas():
+    """Figura base da evolução das perdas: faixas coloridas, linhas de referência e layout.
+    Compartilhada entre reruns e sessões: quem usa copia com go.Figure(modelo_grafico_perdas())"""
+    figura = go.Figure()
+    
+    # Faixas coloridas de fundo
+    figura.add_hrect(y0=0, y1=15, fillcolor="rgba(131, 204, 235, 0.05)", layer="below", line_width=0)
+    figura.add_hrect(y0=15, y1=25, fillcolor="rgba(255, 224, 125, 0.1)", layer="below", line_width=0)
+    figura.add_hrect(y0=25, y1=50, fillcolor="rgba(237, 146, 131, 0.05)", layer="below", line_width=0)
+    figura.add_hrect(y0=50, y1=100, fillcolor="rgba(139, 0, 0, 0.07)", layer="below", line_width=0)
+    
+    # Linhas de referência (a de 35% só posiciona o rótulo da faixa não aceitável)
+    referencias = [
+        (15, "rgba(131, 204, 235, 0.8)", 2, "Desejável (≤15%)", "#104861"),
+        (25, "rgba(255, 224, 125, 0.8)", 2, "Aceitável (15-25%)", "#B8860B"),
+        (35, "rgba(237, 146, 131, 0.0)", 0, "Não Aceitável (25-50%)", "#8B0000"),
+        (50, "rgba(139, 0, 0, 0.8)", 2, "Crítico (>50%)", "#720505")
+    ]
+    for y, cor_linha, largura, rotulo, cor_rotulo in referencias:
+        figura.add_hline(
+            y=y,
+            line_dash="dot",
+            line_color=cor_linha,
+            line_width=largura,
+            annotation_text=rotulo,
+            annotation_position="right",
+            annotation_font_color=cor_rotulo,
+            annotation_font_size=12,
+            annotation_font_family="Arial"
+        )
+    
+    figura.update_layout(
+        height=450,
+        xaxis_title="Período",
+        yaxis_title="Percentual de Perdas (%)",
+        hovermode='x unified',
+        margin=dict(t=10, b=40, l=50, r=20),
+        yaxis=dict(tickformat='.1f')
+    )
+    return figura
+
+def destacar_localidades(df_analysis, quantidade):
+    """Posições das localidades mais atípicas em % de perdas ou IPL (z-score robusto pela mediana)"""
+    pontuacao = np.zeros(len(df_analysis))
+    for coluna in ['% de perdas', 'IPL']:
+        valores = np.nan_to_num(pd.to_numeric(df_analysis[coluna], errors='coerce').to_numpy(dtype=float))
+        mediana = np.median(valores)
+        desvio = np.median(np.abs(valores - mediana)) * 1.4826
+        if desvio > 0:
+            pontuacao = np.maximum(pontuacao, np.abs(valores - mediana) / desvio)
+    return np.argsort(-pontuacao, kind='stable')[:quantidade]
+
+def criar_grafico_volume_perdas(df_analysis, limite=LIMITE_PONTOS_DISPERSAO, rotulos=ROTULOS_DISPERSAO):
+    """Dispersão Volume × % Perdas por categoria; acima do limite usa WebGL e rotula só os destaques"""
+    fig_scatter = go.Figure()
+    
+    if len(df_analysis) <= limite:
+        df_analysis_scatter = df_analysis.copy()
+        df_analysis_scatter['IPL_size'] = df_analysis_scatter['IPL'].apply(lambda x: max(8, min(50, abs(x)/10)) if x > 0 else 8)
+        
+        for categoria in df_analysis_scatter['Categoria'].unique():
+            df_cat = df_analysis_scatter[df_analysis_scatter['Categoria'] == categoria]
+        
+            fig_scatter.add_trace(go.Scatter(
+                x=df_cat['Volume Total de entrada'],
+                y=df_cat['% de perdas'],
+                mode='markers+text',
+                name=f'Categoria {categoria}',
+                marker=dict(
+                    size=df_cat['IPL_size'],
+                    color=cores_classificacao.get(categoria, "rgba(128, 128, 128, 0.5)"),
+                    line=dict(width=1, color='white'),
+                    sizemode='diameter'
+                ),
+                text=df_cat['Localidade'],
+                textposition='top center',
+                textfont=dict(size=10, color='black'),
+                hovertemplate=(
+                    '<b>%{text}</b><br>' +
+                    'Regional: %{customdata[0]}<br>' +
+                    'Município: %{customdata[1]}<br>' +
+                    'Volume Total: %{x:,.0f} m³<br>' +
+                    '% Perdas: %{y:.1f}%<br>' +
+                    'IPL: %{customdata[2]:.0f}<br>' +
+                    'IVI: %{customdata[3]}<br>' +
+                    'Categoria: %{customdata[4]}<br>' +
+                    '<extra></extra>'
+                ),
+                customdata=list(zip(
+                    df_cat['Regional'],
+                    df_cat['Municipio'],
+                    df_cat['IPL'],
+                    df_cat['IVI'],
+                    df_cat['Categoria']
+                ))
+            ))
+    else:
+        # Alto volume: Scattergl sem texto por ponto, valores arredondados e nome da
+        # localidade só no hover; os rótulos ficam num traço SVG com as mais atípicas
+        ipl = pd.to_numeric(df_analysis['IPL'], errors='coerce').fillna(0).to_numpy(dtype=float)
+        tamanhos = np.where(ipl > 0, np.clip(np.abs(ipl) / 10, 8, 50), 8).round(1)
+        volume = pd.to_numeric(df_analysis['Volume Total de entrada'], errors='coerce').to_numpy(dtype=float).round(0)
+        perdas = pd.to_numeric(df_analysis['% de perdas'], errors='coerce').to_numpy(dtype=float).round(2)
+        ivi = df_analysis['IVI'].map(lambda x: f"{x:.2f}" if isinstance(x, (int, float)) and not pd.isna(x) else str(x)).to_numpy(dtype=object)
+        dados_hover = np.column_stack([
+            df_analysis['Localidade'].to_numpy(dtype=object), df_analysis['Regional'].to_numpy(dtype=object),
+            df_analysis['Municipio'].to_numpy(dtype=object), ipl.round(0), ivi
+        ])
+        categorias = df_analysis['Categoria'].to_numpy(dtype=object)
+        
+        for categoria in pd.unique(categorias):
+            mascara = categorias == categoria
+            fig_scatter.add_trace(go.Scattergl(
+                x=volume[mascara],
+                y=perdas[mascara],
+                mode='markers',
+                name=f'Categoria {categoria}',
+                marker=dict(
+                    size=tamanhos[mascara],
+                    color=cores_classificacao.get(categoria, "rgba(128, 128, 128, 0.5)"),
+                    line=dict(width=1, color='white'),
+                    sizemode='diameter'
+                ),
+                customdata=dados_hover[mascara],
+                hovertemplate=(
+                    '<b>%{customdata[0]}</b><br>' +
+                    'Regional: %{customdata[1]}<br>' +
+                    'Município: %{customdata[2]}<br>' +
+                    'Volume Total: %{x:,.0f} m³<br>' +
+                    '% Perdas: %{y:.1f}%<br>' +
+                    'IPL: %{customdata[3]:.0f}<br>' +
+                    'IVI: %{customdata[4]}<br>' +
+                    f'Categoria: {categoria}<br>' +
+                    '<extra></extra>'
+                )
+            ))
+        
+        destaques = destacar_localidades(df_analysis, rotulos)
+        fig_scatter.add_trace(go.Scatter(
+            x=volume[destaques],
+            y=perdas[destaques],
+            mode='text',
+            text=df_analysis['Localidade'].to_numpy(dtype=object)[destaques],
+            textposition='top center',
+            textfont=dict(size=10, color='black'),
+            hoverinfo='skip',
+            showlegend=False
+        ))
+    
+    fig_scatter.update_layout(
+        title="Volume vs % Perdas",
+        xaxis_title="Volume Total de Entrada (m³)",
+        yaxis_title="% de Perdas",
+        height=350,
+        showlegend=True,
+        legend=dict(
+            orientation="h",
+            yanchor="bottom",
+            y=1.02,
+            xanchor="right",
+            x=1
+        ),
+        xaxis=dict(tickformat=','),
+        yaxis=dict(tickformat='.1f')
+    )
+    return fig_scatter
+
+# MAPA DE CALOR (localidade × mês)
+# Uma única pivotagem dos indicadores mensais do cubo; a figura leva a matriz inteira e a
+# janela de linhas só define o trecho visível do eixo (zoom e rolagem ficam no navegador)
+LINHAS_JANELA_CALOR = 50
+
+def montar_matriz_calor(indicadores, indicador='ipl'):
+    """Matriz localidade × mês do indicador, com eixo de meses contínuo e localidades
+    ordenadas da pior para a melhor média no período (sem dados por último)"""
+    if indicadores.empty:
+        return pd.DataFrame()
+    matriz = indicadores.pivot(index='cod_localidade', columns='ano_mes', values=indicador)
+    matriz = matriz.reindex(columns=gerar_eixo_meses(int(matriz.columns.min()), int(matriz.columns.max())))
+    media = matriz.mean(axis=1)
+    return matriz.loc[media.sort_values(ascending=False, na_position='last').index]
+
+def criar_mapa_calor(matriz, nomes, indicador='ipl'):
+    """Heatmap da matriz localidade × mês (piores localidades no topo)"""
+    z = matriz.to_numpy(dtype=np.float64).round(1)
+    rotulos = [f"{nomes.get(codigo, codigo)} ({codigo})" for codigo in matriz.index]
+    titulo = {'ipl': 'IPL (L/lig/dia)', 'perc_perdas': '% de Perdas'}[indicador]
+    valores = z[np.isfinite(z)]
+    limite_superior = np.percentile(valores, 95) if valores.size else 1
+    
+    figura = go.Figure(go.Heatmap(
+        z=z,
+        x=[format_ano_mes(mes) for mes in matriz.columns],
+        y=rotulos,
+        colorscale='YlOrRd',
+        zmin=0,
+        zmax=max(float(limite_superior), 1),
+        colorbar=dict(title=titulo),
+        hovertemplate='<b>%{y}</b><br>%{x}<br>' + titulo + ': %{z:.1f}<extra></extra>',
+        hoverongaps=False
+    ))
+    figura.update_layout(
+        xaxis=dict(title="Período", side='top'),
+        yaxis=dict(range=[len(rotulos) - 0.5, -0.5], tickfont=dict(size=10)),
+        margin=dict(t=40, b=20, l=20, r=20),
+        dragmode='pan'
+    )
+    return figura
+
+# EXPORTAÇÃO
+# O arquivo é escrito numa thread em segundo plano, em blocos de linhas e direto no disco
+# (planilha openpyxl write-only, CSV e Parquet por partes); a página só acompanha o andamento
+DIRETORIO_EXPORTACAO = DIRETORIO_CACHE / 'exportacoes'
+LINHAS_BLOCO_EXPORTACAO = 50000
+# Arquivos gerados (e restos de exportações interrompidas) mais antigos que isto são apagados: BALANCO_EXPORTACAO_VALIDADE_HORAS
+VALIDADE_EXPORTACAO = float(os.environ.get('BALANCO_EXPORTACAO_VALIDADE_HORAS', 24)) * 3600
+FORMATOS_EXPORTACAO = {
+    'xlsx': ('Excel (.xlsx)', 'xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': ('CSV (.zip, um arquivo por tabela)', 'zip', 'application/zip'),
+    'parquet': ('Parquet (.zip, um arquivo por tabela)', 'zip', 'application/zip')
+}
+
+def formatos_exportacao_disponiveis():
+    """Formatos cujas dependências estão instaladas"""
+    return [formato for formato in FORMATOS_EXPORTACAO
+            if not (formato == 'xlsx' and Workbook is None) and not (formato == 'parquet' and pa is None)]
+
+def blocos_dataframe(df, tamanho=LINHAS_BLOCO_EXPORTACAO):
+    """Fatias consecutivas do DataFrame com até `tamanho` linhas (sem cópia)"""
+    for inicio in range(0, len(df), tamanho):
+        yield df.iloc[inicio:inicio + tamanho]
+
+def valor_celula(valor):
+    """Valor aceito pela planilha (ausentes viram célula vazia)"""
+    return None if pd.isna(valor) else valor
+
+def normalizar_tabela_exportacao(df):
+    """Colunas de texto com tipos misturados (ex.: IVI numérico ou 'N/A') viram texto.
+    Aplicada à tabela inteira, para que todos os blocos sigam o mesmo esquema."""
+    colunas_mistas = [coluna for coluna in df.columns if df[coluna].dtype == object
+                      and pd.api.types.infer_dtype(df[coluna], skipna=True).startswith('mixed')]
+    if not colunas_mistas:
+        return df
+    return df.assign(**{coluna: df[coluna].astype(str) for coluna in colunas_mistas})
+
+def escrever_exportacao(tabelas, formato, caminho, progresso=None):
+    """Escreve as tabelas ({nome: DataFrame}) em `caminho`, um bloco de linhas por vez;
+    `progresso` recebe o total de linhas já escritas ao fim de cada bloco"""
+    linhas_escritas = 0
+    
+    def avancar(linhas):
+        nonlocal linhas_escritas
+        linhas_escritas += linhas
+        if progresso is not None:
+            progresso(linhas_escritas)
+    
+    if formato == 'xlsx':
+        livro = Workbook(write_only=True)
+        for nome, df in tabelas.items():
+            planilha = livro.create_sheet(title=nome[:31])
+            planilha.append([str(coluna) for coluna in df.columns])
+            for bloco in blocos_dataframe(df):
+                for linha in bloco.itertuples(index=False, name=None):
+                    planilha.append([valor_celula(valor) for valor in linha])
+                avancar(len(bloco))
+        livro.save(caminho)
+    
+    elif formato == 'csv':
+        with zipfile.ZipFile(caminho, 'w', compression=zipfile.ZIP_DEFLATED) as arquivo_zip:
+            for nome, df in tabelas.items():
+                with arquivo_zip.open(f"{nome}.csv", 'w') as destino:
+                    texto = io.TextIOWrapper(destino, encoding='utf-8-sig', newline='')
+                    df.head(0).to_csv(texto, index=False, sep=';', decimal=',')
+                    for bloco in blocos_dataframe(df):
+                        bloco.to_csv(texto, index=False, header=False, sep=';', decimal=',')
+                        avancar(len(bloco))
+                    texto.flush()
+                    texto.detach()
+    
+    elif formato == 'parquet':
+        with zipfile.ZipFile(caminho, 'w', compression=zipfile.ZIP_STORED) as arquivo_zip:
+            for nome, df in tabelas.items():
+                caminho_tabela = Path(caminho).with_suffix(f".{nome}.parquet")
+                # Tipos e esquema decididos uma vez sobre a tabela inteira, não pelo primeiro bloco
+                df = normalizar_tabela_exportacao(df)
+                esquema = pa.Schema.from_pandas(df, preserve_index=False)
+                with pq.ParquetWriter(caminho_tabela, esquema) as escritor:
+                    for bloco in blocos_dataframe(df):
+                        escritor.write_table(pa.Table.from_pandas(bloco, schema=esquema, preserve_index=False))
+                        avancar(len(bloco))
+                arquivo_zip.write(caminho_tabela, arcname=f"{nome}.parquet")
+                caminho_tabela.unlink()
+    else:
+        raise ValueError(f"Formato de exportação desconhecido: {formato}")
+
+def descartar_exportacoes_antigas():
+    """Apaga arquivos de exportação mais antigos que VALIDADE_EXPORTACAO (sessões encerradas
+    sem descartar o arquivo, exportações interrompidas pelo fim do processo)"""
+    limite_validade = time.time() - VALIDADE_EXPORTACAO
+    for arquivo in DIRETORIO_EXPORTACAO.glob('balanco_hidrico_*'):
+        try:
+            if arquivo.stat().st_mtime < limite_validade:
+                arquivo.unlink()
+        except OSError:
+            pass  # já removido por outro processo
+
+def iniciar_exportacao(tabelas, formato, descricao=''):
+    """Dispara a escrita numa thread em segundo plano e retorna o registro de acompanhamento"""
+    _, extensao, mime = FORMATOS_EXPORTACAO[formato]
+    DIRETORIO_EXPORTACAO.mkdir(parents=True, exist_ok=True)
+    descartar_exportacoes_antigas()
+    descritor, caminho = tempfile.mkstemp(prefix='balanco_hidrico_', suffix=f".{extensao}", dir=DIRETORIO_EXPORTACAO)
+    os.close(descritor)
+    
+    tarefa = {
+        'formato': formato,
+        'caminho': Path(caminho),
+        'nome_arquivo': f"balanco_hidrico_{time.strftime('%Y%m%d_%H%M')}.{extensao}",
+        'mime': mime,
+        'descricao': descricao,
+        'tabelas': list(tabelas),
+        'total_linhas': sum(len(df) for df in tabelas.values()),
+        'linhas_escritas': 0,
+        'erro': None,
+        'concluida': False
+    }
+    
+    def executar():
+        try:
+            escrever_exportacao(tabelas, formato, tarefa['caminho'],
+                                lambda linhas: tarefa.__setitem__('linhas_escritas', linhas))
+        except Exception as e:
+            tarefa['erro'] = str(e)
+        finally:
+            tarefa['concluida'] = True
+    
+    threading.Thread(target=executar, name='exportacao', daemon=True).start()
+    return tarefa
+
+def descartar_exportacao(tarefa):
+    """Remove o arquivo de uma exportação concluída"""
+    if tarefa is not None and tarefa['concluida']:
+        tarefa['caminho'].unlink(missing_ok=True)
+
+# CACHE PERSISTENTE DE RESULTADOS
+# Compartilhado por todos os processos do servidor e mantido entre reinícios: cada resultado
+# é um arquivo pickle nomeado pelo hash da chave (derivada do conteúdo de origem), gravado de
+# forma atômica e precedido da assinatura HMAC (chave + conteúdo), conferida antes do unpickle;
+# o índice SQLite guarda tamanho e datas, e o travamento do próprio SQLite
+# serializa a expiração (validade) e o descarte dos menos acessados acima do limite de espaço
+DIRETORIO_CACHE_RESULTADOS = DIRETORIO_CACHE / 'resultados'
+VERSAO_CACHE_RESULTADOS = 2  # mudar quando o formato dos resultados mudar
+TAMANHO_ASSINATURA = hashlib.sha256().digest_size
+
+# Versão do código (main.py e módulos locais): resultados de outra versão do app não são reaproveitados
+VERSAO_CODIGO = hashlib.sha1(b''.join(
+    (Path(__file__).parent / nome).read_bytes() for nome in [Path(__file__).name, 'periodos.py', 'tendencias.py']
+)).hexdigest()[:12]
+
+def garantir_diretorio_privado(caminho):
+    """Cria o diretório só para o usuário do processo (0700). Recusa (PermissionError) um
+    diretório de outro usuário; se for do próprio usuário, restringe as permissões."""
+    caminho = Path(caminho)
+    caminho.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if not hasattr(os, 'getuid'):
+        return caminho  # Windows: o perfil do usuário já é privado
+    estado = caminho.stat()
+    if estado.st_uid != os.getuid():
+        raise PermissionError(f"{caminho} pertence a outro usuário (uid {estado.st_uid})")
+    if estado.st_mode & 0o077:
+        caminho.chmod(0o700)
+    return caminho
+
+def chave_assinatura_cache():
+    """Chave HMAC das entradas do cache: BALANCO_CACHE_CHAVE ou o arquivo 'chave' do
+    diretório privado (criado na primeira vez, 0600)"""
+    if os.environ.get('BALANCO_CACHE_CHAVE'):
+        return os.environ['BALANCO_CACHE_CHAVE'].encode()
+    caminho = garantir_diretorio_privado(DIRETORIO_CACHE) / 'chave'
+    if not caminho.exists():
+        # Gravada à parte e ligada ao nome final: processos concorrentes nunca leem uma chave incompleta
+        caminho_tmp = caminho.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with os.fdopen(os.open(caminho_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as arquivo:
+            arquivo.write(secrets.token_bytes(32))
+        try:
+            os.link(caminho_tmp, caminho)
+        except FileExistsError:
+            pass  # outro processo criou primeiro
+        finally:
+            caminho_tmp.unlink()
+    return caminho.read_bytes()
+
+def assinar_arquivo_cache(arquivo, chave):
+    """HMAC-SHA256 da chave do resultado e do conteúdo do arquivo após a assinatura"""
+    assinatura = hmac.new(chave_assinatura_cache(), chave.encode() + b'\0', hashlib.sha256)
+    arquivo.seek(TAMANHO_ASSINATURA)
+    for bloco in iter(lambda: arquivo.read(1024 ** 2), b''):
+        assinatura.update(bloco)
+    return assinatura.digest()
+
+def chave_cache_resultado(tipo, chave_origem):
+    """Chave de um resultado: versão do formato e do código, tipo do resultado e hash do conteúdo de origem"""
+    return f"v{VERSAO_CACHE_RESULTADOS}:{VERSAO_CODIGO}:{tipo}:{chave_origem}"
+
+def caminho_cache_resultado(chave):
+    """Arquivo do resultado no diretório do cache"""
+    return DIRETORIO_CACHE_RESULTADOS / f"{hashlib.sha1(chave.encode()).hexdigest()}.pkl"
+
+def conectar_indice_cache():
+    """Abre o índice SQLite do cache (criando-o se preciso, no diretório privado)"""
+    garantir_diretorio_privado(DIRETORIO_CACHE)
+    DIRETORIO_CACHE_RESULTADOS.mkdir(mode=0o700, exist_ok=True)
+    conexao = sqlite3.connect(DIRETORIO_CACHE_RESULTADOS / 'indice.sqlite', timeout=30, isolation_level=None)
+    conexao.execute("PRAGMA journal_mode=WAL")
+    conexao.execute("CREATE TABLE IF NOT EXISTS resultados (chave TEXT PRIMARY KEY, tamanho INTEGER, criado_em REAL, acessado_em REAL)")
+    return conexao
+
+def ler_cache_resultado(chave):
+    """Resultado guardado para a chave, ou None se ausente, expirado ou ilegível"""
+    if BACKEND_CACHE_RESULTADOS != 'disco':
+        return None
+    try:
+        with closing(conectar_indice_cache()) as conexao:
+            registro = conexao.execute("SELECT criado_em FROM resultados WHERE chave = ?", (chave,)).fetchone()
+            if registro is None or time.time() - registro[0] > VALIDADE_CACHE_RESULTADOS:
+                return None
+            with open(caminho_cache_resultado(chave), 'rb') as arquivo:
+                if not hmac.compare_digest(arquivo.read(TAMANHO_ASSINATURA), assinar_arquivo_cache(arquivo, chave)):
+                    raise ValueError("assinatura inválida, entrada ignorada")
+                arquivo.seek(TAMANHO_ASSINATURA)
+                resultado = pickle.load(arquivo)
+            conexao.execute("UPDATE resultados SET acessado_em = ? WHERE chave = ?", (time.time(), chave))
+            return resultado
+    except Exception as e:
+        print(f"Erro ao ler o cache de resultados ({chave}): {e}")
+        return None
+
+def gravar_cache_resultado(chave, resultado):
+    """Grava o resultado (arquivo temporário substituído de uma vez) e aplica validade e limite"""
+    if BACKEND_CACHE_RESULTADOS != 'disco':
+        return
+    try:
+        garantir_diretorio_privado(DIRETORIO_CACHE)
+        DIRETORIO_CACHE_RESULTADOS.mkdir(mode=0o700, exist_ok=True)
+        caminho = caminho_cache_resultado(chave)
+        caminho_tmp = caminho.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(caminho_tmp, 'w+b') as arquivo:
+            arquivo.write(bytes(TAMANHO_ASSINATURA))
+            pickle.dump(resultado, arquivo, protocol=pickle.HIGHEST_PROTOCOL)
+            arquivo.flush()
+            assinatura = assinar_arquivo_cache(arquivo, chave)
+            arquivo.seek(0)
+            arquivo.write(assinatura)
+        os.replace(caminho_tmp, caminho)
+        
+        agora = time.time()
+        with closing(conectar_indice_cache()) as conexao:
+            conexao.execute("INSERT OR REPLACE INTO resultados VALUES (?, ?, ?, ?)", (chave, caminho.stat().st_size, agora, agora))
+            descartar_resultados_cache(conexao, agora)
+    except Exception as e:
+        print(f"Erro ao gravar o cache de resultados ({chave}): {e}")
+
+def descartar_resultados_cache(conexao, agora):
+    """Remove os resultados expirados e, acima do limite de espaço, os acessados há mais tempo"""
+    conexao.execute("BEGIN IMMEDIATE")
+    try:
+        limite_validade = agora - VALIDADE_CACHE_RESULTADOS
+        removidos = [chave for (chave,) in conexao.execute("SELECT chave FROM resultados WHERE criado_em < ?", (limite_validade,))]
+        espaco_usado = 0
+        for chave, tamanho in conexao.execute(
+            "SELECT chave, tamanho FROM resultados WHERE criado_em >= ? ORDER BY acessado_em DESC", (limite_validade,)
+        ).fetchall():
+            espaco_usado += tamanho
+            if espaco_usado > LIMITE_CACHE_RESULTADOS:
+                removidos.append(chave)
+        for chave in removidos:
+            conexao.execute("DELETE FROM resultados WHERE chave = ?", (chave,))
+            caminho_cache_resultado(chave).unlink(missing_ok=True)
+        conexao.execute("COMMIT")
+    except Exception:
+        conexao.execute("ROLLBACK")
+        raise
+
+def resultado_em_cache(tipo, chave_origem, calcular):
+    """Resultado do cache persistente; na falta, calcula e grava (resultados None não são guardados)"""
+    chave = chave_cache_resultado(tipo, chave_origem)
+    resultado = ler_cache_resultado(chave)
+    try:
+        resultado = sigis_do_cache(resultado)
+    except Exception as e:
+        print(f"Erro ao remapear o SIGIS do cache ({chave}): {e}")
+        resultado = None
+    if resultado is None:
+        resultado = calcular()
+        if resultado is not None:
+            gravar_cache_resultado(chave, sigis_para_cache(resultado))
+    return resultado
+
+# PRÉ-CÁLCULO EM SEGUNDO PLANO
+# Logo após a carga, uma thread monta os caches do conjunto de dados, uma etapa por vez.
+# Cada etapa é um Future: a página usa o resultado se já estiver pronto, aguarda se a etapa
+# estiver em andamento e só calcula na hora se não houver pré-cálculo
+ETAPAS_AQUECIMENTO = {
+    'rollup_regional': 'Balanço por regional e mês',
+    'sigis_tipado': 'Índice do SIGIS',
+    'cubo_mensal': 'Cubo mensal',
+    'indicadores_localidades': 'Indicadores por localidade',
+    'series_niveis': 'Séries por regional, município e total',
+    'qualidade_sigis': 'Qualidade do SIGIS',
+    'hidrometros_mensais': 'Hidrômetros por localidade e mês'
+}
+
+def iniciar_aquecimento(df, df_sigis, chave_dados, cubo_repositorio=None):
+    """Agenda as etapas numa thread dedicada (executadas em ordem; cada uma usa as anteriores).
+    Cada etapa passa pelo cache persistente, pela chave do conjunto de dados. Com o cubo
+    persistido do repositório, o cubo mensal parte dele."""
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='aquecimento')
+    futuros = {}
+    
+    def agendar(etapa, calcular):
+        futuros[etapa] = executor.submit(resultado_em_cache, etapa, chave_dados, calcular)
+    
+    def com_sigis(calcular):
+        sigis_tipado = futuros['sigis_tipado'].result()
+        return calcular(sigis_tipado) if isinstance(sigis_tipado, dict) else None
+    
+    def com_cubo(calcular):
+        cubo = futuros['cubo_mensal'].result()
+        return calcular(cubo) if cubo is not None else None
+    
+    agendar('rollup_regional', lambda: montar_rollup_regional(df))
+    agendar('sigis_tipado', lambda: preparar_sigis_tipado(df_sigis))
+    agendar('cubo_mensal', lambda: com_sigis(lambda sigis_tipado: montar_cubo_carregado(df, sigis_tipado, cubo_repositorio)))
+    agendar('indicadores_localidades', lambda: com_cubo(indicadores_mensais_cubo))
+    agendar('series_niveis', lambda: com_cubo(series_mensais_niveis))
+    agendar('qualidade_sigis', lambda: com_sigis(lambda sigis_tipado: varrer_qualidade_sigis(sigis_tipado, df)))
+    agendar('hidrometros_mensais', lambda: com_sigis(montar_tabela_hidrometros))
+    executor.shutdown(wait=False)
+    return futuros
+
+def resultado_aquecimento(etapa, calcular):
+    """Resultado pré-calculado da etapa (aguardando-a se preciso); sem pré-cálculo, ou se
+    a etapa foi cancelada ou falhou, calcula na hora"""
+    futuros = st.session_state.get('aquecimento')
+    if futuros is not None and etapa in futuros and not futuros[etapa].cancelled():
+        try:
+            return futuros[etapa].result()
+        except Exception as e:
+            print(f"Erro no pré-cálculo ({ETAPAS_AQUECIMENTO[etapa]}), calculando na hora: {e}")
+    return calcular()
+
+def resultado_aquecimento_pronto(etapa):
+    """Resultado da etapa só se já estiver pronto, sem aguardar (None se em andamento, cancelada ou com erro)"""
+    futuro = (st.session_state.get('aquecimento') or {}).get(etapa)
+    if futuro is None or not futuro.done() or futuro.cancelled() or futuro.exception() is not None:
+        return None
+    return futuro.result()
+
+def cancelar_aquecimento(futuros):
+    """Cancela as etapas ainda não iniciadas (a etapa em andamento termina sozinha)"""
+    for futuro in (futuros or {}).values():
+        futuro.cancel()
+
+# PRÉVIA DAS SELEÇÕES GRANDES
+# Seleções de regional ou de todas as regionais com muitas linhas no recorte aparecem primeiro a
+# partir do balanço já somado por regional e mês (pré-cálculo), com o selo "prévia"; os valores
+# exatos por localidade são calculados em seguida na mesma execução e substituem a prévia no lugar
+LIMITE_LINHAS_PREVIA = int(os.environ.get('BALANCO_LIMITE_PREVIA', 200000))
+
+def montar_rollup_regional(df):
+    """Balanço somado por regional, mês e item (hierarquia completa de itens)"""
+    return df.groupby(['nome_regional', 'ano_mes', 'id', 'parent', 'nome_info', 'nivel_info'], dropna=False, sort=False)[['valor', 'valor_acum']].sum().reset_index()
+
+def agregar_previa(rollup, regional_sel, data_range):
+    """Itens do balanço somados no período para a regional (ou todas), no formato de df_aggregated"""
+    recorte = rollup[rollup['ano_mes'].between(data_range[0], data_range[1])]
+    if regional_sel != "Todas":
+        recorte = recorte[recorte['nome_regional'] == regional_sel]
+    agregado = recorte.groupby(['id', 'parent', 'nome_info', 'nivel_info'], dropna=False)[['valor', 'valor_acum']].sum().reset_index()
+    agregado['parent'] = agregado['parent'].fillna("").astype(str).replace('nan', '')
+    return agregado
+
+def calcular_ipl_previa(cubo, regional_sel, data_range):
+    """IPL aproximado pelo cubo mensal: ligações somadas no último mês do período com ligações,
+    em vez do último valor não zerado de cada localidade"""
+    recorte = cubo[cubo['ano_mes'].between(data_range[0], data_range[1])]
+    if regional_sel != "Todas":
+        recorte = recorte[recorte['nome_regional'] == regional_sel]
+    ligacoes = recorte[recorte['ligacoes'] > 0].groupby('ano_mes')['ligacoes'].sum()
+    if ligacoes.empty:
+        return 0
+    numerador = (recorte['volume_producao'] + recorte['volume_importado'] - recorte['volume_exportado']
+                 - recorte['volume_operacional'] - recorte['volume_consumido']).sum()
+    return max(0, 1000 * numerador / (ligacoes.iloc[-1] * calcular_dias_periodo(data_range[0], data_range[1])))
+
+# FUNÇÃO PARA CRIAR DADOS DE EXEMPLO
+def create_sample_data():
+    """Cria dados de exemplo para demonstração"""
+    import numpy as np
+    
+    # Dados de exemplo para o balanço hídrico
+    sample_data = []
+    
+    # Estrutura hierárquica de exemplo
+    hierarchy = {
+        '1': {'parent': '', 'nome': 'Volume de Entrada', 'valor': 1000000},
+        '2': {'parent': '1', 'nome': 'Consumo Autorizado', 'valor': 750000},
+        '2.1': {'parent': '2', 'nome': 'Consumo Autorizado Faturado', 'valor': 650000},
+        '2.1.1': {'parent': '2.1', 'nome': 'Volume Medido', 'valor': 600000},
+        '2.2': {'parent': '2', 'nome': 'Autorizado não Faturado', 'valor': 100000},
+        '2.2.1': {'parent': '2.2', 'nome': 'Uso Operacional', 'valor': 60000},
+        '2.2.2': {'parent': '2.2', 'nome': 'Uso Emergencial', 'valor': 20000},
+        '2.2.3': {'parent': '2.2', 'nome': 'Uso Social', 'valor': 20000},
+        '3': {'parent': '1', 'nome': 'Volume de Perdas', 'valor': 250000},
+        '3.1': {'parent': '3', 'nome': 'Perdas Aparentes', 'valor': 100000},
+        '3.1.1': {'parent': '3.1', 'nome': 'Clandestinos', 'valor': 30000},
+        '3.1.2': {'parent': '3.1', 'nome': 'Fraudes', 'valor': 20000},
+        '3.1.3': {'parent': '3.1', 'nome': 'Submedição', 'valor': 50000},
+        '3.2': {'parent': '3', 'nome': 'Perdas Reais', 'valor': 150000},
+        '3.2.1': {'parent': '3.2', 'nome': 'Vazamento em Ramais', 'valor': 80000},
+        '3.2.2': {'parent': '3.2', 'nome': 'Outros Vazamentos', 'valor': 70000}
+    }
+    
+    # Criar dados para 3 localidades e 6 meses
+    localidades = [
+        {'cod': 1001, 'nome': 'Centro', 'municipio': 'Cidade A', 'regional': 'Regional Norte'},
+        {'cod': 1002, 'nome': 'Bairro Sul', 'municipio': 'Cidade A', 'regional': 'Regional Norte'},
+        {'cod': 2001, 'nome': 'Industrial', 'municipio': 'Cidade B', 'regional': 'Regional Sul'}
+    ]
+    
+    meses = [202401, 202402, 202403, 202404, 202405, 202406]
+    
+    for localidade in localidades:
+        for mes in meses:
+            for item_id, item_data in hierarchy.items():
+                # Adicionar variação aleatória nos valores
+                variacao = np.random.uniform(0.8, 1.2)
+                valor = int(item_data['valor'] * variacao / 3)  # Dividir por 3 localidades
+                
+                nivel_info = f"Nível {len(item_id.split('.'))}"
+                
+                sample_data.append({
+                    'cod_regional': localidade['regional'][:3].upper(),
+                    'nome_regional': localidade['regional'],
+                    'cod_municipio': localidade['cod'] // 1000,
+                    'nome_municipio': localidade['municipio'],
+                    'cod_localidade': localidade['cod'],
+                    'nome_localidade': localidade['nome'],
+                    'ano_mes': mes,
+                    'id': item_id,
+                    'parent': item_data['parent'],
+                    'nivel_info': nivel_info,
+                    'nome_info': item_data['nome'],
+                    'valor': valor,
+                    'valor_acum': valor
+                })
+    
+    return pd.DataFrame(sample_data)
+
+def create_sample_sigis_data():
+    """Cria dados de exemplo do SIGIS"""
+    import numpy as np
+    
+    # Códigos SIGIS importantes
+    codigos = [1, 67, 68, 29, 30, 31, 32, 9642, 9603, 33]
+    localidades = [1001, 1002, 2001]
+    meses = [202401, 202402, 202403, 202404, 202405, 202406]
+    
+    sigis_data = []
+    
+    for codigo in codigos:
+        for localidade in localidades:
+            for mes in meses:
+                if codigo == 9603:  # Ligações
+                    valor = np.random.randint(800, 1200)
+                elif codigo == 33:  # Extensão de rede
+                    valor = np.random.uniform(15, 25)
+                elif codigo in [1, 9642]:  # Volumes principais
+                    valor = np.random.uniform(80000, 120000)
+                else:  # Outros volumes
+                    valor = np.random.uniform(1000, 5000)
+                
+                sigis_data.append([
+                    codigo, 'Descrição', localidade, f'Localidade {localidade}',
+                    mes, 'Unidade', 'Tipo', 'Fonte', valor
+                ])
+    
+    columns = ['A', 'B', 'C', 'D', 'ano_mes', 'F', 'G', 'H', 'I']
+    return pd.DataFrame(sigis_data, columns=columns)
+
+# FUNÇÃO PRINCIPAL DE CARREGAMENTO DE DADOS
+COLUNAS_BALANCO = ['cod_regional', 'nome_regional', 'cod_municipio', 'nome_municipio', 'cod_localidade', 'nome_localidade', 'ano_mes', 'id', 'parent', 'nivel_info', 'nome_info', 'valor', 'valor_acum']
+
+def preparar_balanco_lido(df):
+    """Valida e ajusta a planilha 1 (Balanço Hídrico) recém-lida. Retorna (df, mensagem de erro)"""
+    if df.empty:
+        return None, "❌ A planilha de Balanço Hídrico (Planilha 1) está vazia!"
+    
+    if len(df.columns) >= len(COLUNAS_BALANCO):
+        df.columns = COLUNAS_BALANCO[:len(df.columns)]
+    else:
+        return None, f"❌ A planilha de Balanço Hídrico deve ter pelo menos {len(COLUNAS_BALANCO)} colunas."
+    
+    df['parent'] = df['parent'].fillna("").astype(str).replace('nan', '')
+    
+    # Aplicar formatação de data na coluna ano_mes
+    df['ano_mes_formatted'] = df['ano_mes'].apply(format_ano_mes)
+    
+    required_cols = ['nome_info', 'valor', 'id', 'parent', 'nivel_info']
+    missing_cols = [col for col in required_cols if col not in df.columns]
+    if missing_cols:
+        return None, f"❌ Colunas obrigatórias faltando na planilha de Balanço Hídrico: {missing_cols}"
+    return df, None
+
+def preparar_sigis_lido(df_sigis):
+    """Valida e ajusta a planilha 2 (SIGIS) recém-lida. Retorna (df_sigis ou None, aviso)"""
+    if not df_sigis.empty and 'ano_mes' in df_sigis.columns:
+        df_sigis['ano_mes_formatted'] = df_sigis['ano_mes'].apply(format_ano_mes)
+        return df_sigis, None
+    return None, "⚠️ A planilha SIGIS (Planilha 2) está vazia ou não possui a coluna 'ano_mes'."
+
+@st.cache_data
+def load_data(uploaded_file):
+    """Carrega dados do arquivo enviado"""
+    
+    if uploaded_file is not None:
+        try:
+            # Carregar planilha 1 (Balanço Hídrico)
+            df, erro = preparar_balanco_lido(pd.read_excel(uploaded_file, sheet_name=0))  # Primeira planilha
+            if erro:
+                st.error(erro)
                 return None, None
             
             # Carregar planilha 2 (SIGIS)
             df_sigis = None
             try:
-                df_sigis = pd.read_excel(uploaded_file, sheet_name=1)  # Segunda planilha
-                if not df_sigis.empty and 'ano_mes' in df_sigis.columns:
-                    df_sigis['ano_mes_formatted'] = df_sigis['ano_mes'].apply(format_ano_mes)
-                else:
-                    st.warning("⚠️ A planilha SIGIS (Planilha 2) está vazia ou não possui a coluna 'ano_mes'.")
-                    df_sigis = None
+                df_sigis, aviso = preparar_sigis_lido(pd.read_excel(uploaded_file, sheet_name=1))  # Segunda planilha
+                if aviso:
+                    st.warning(aviso)
             except Exception as e:
                 st.warning(f"⚠️ Erro ao carregar planilha SIGIS (Planilha 2): {e}")
                 df_sigis = None
@@ -794,9 +2578,785 @@ def load_data(uploaded_file):
         # Sem arquivo carregado
         return None, None
 
+# LEITURA ASSÍNCRONA DO ARQUIVO ENVIADO
+# O arquivo é lido numa thread, linha a linha (openpyxl somente leitura), com o andamento
+# (planilhas e linhas) exibido na página; enviar outro arquivo cancela a leitura em curso.
+# Assim que o balanço fica pronto, os filtros da barra lateral já podem ser exibidos
+LINHAS_PROGRESSO_LEITURA = 2000
+PLANILHAS_LEITURA = ['Balanço Hídrico', 'SIGIS', 'Parâmetros operacionais']
+LINHAS_AMOSTRA_MEMORIA = 1000  # linhas lidas antes de estimar o tamanho da planilha em memória
+LINHAS_BLOCO_LEITURA = 50000  # acima do orçamento de memória, linhas convertidas em DataFrame por vez
+
+def valor_celula_lida(valor):
+    """Valor da célula como o pandas o entrega na leitura do Excel (inteiros sem ',0')"""
+    if valor is None:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        return int(valor)
+    return valor
+
+def inferir_tipos_planilha(df):
+    """Inferência de tipos sobre a planilha inteira lida em blocos (como a do TextParser):
+    colunas numéricas viram números, datas e booleanos viram seus tipos"""
+    for posicao in range(len(df.columns)):
+        serie = df.iloc[:, posicao]
+        if pd.api.types.infer_dtype(serie, skipna=True) not in ('datetime', 'date', 'boolean'):
+            try:
+                serie = pd.to_numeric(serie)
+            except (ValueError, TypeError):
+                pass
+        df.isetitem(posicao, serie)
+    return df.infer_objects()
+
+def ler_planilha_em_linhas(conteudo, indice, tarefa):
+    """Lê a planilha `indice` linha a linha, atualizando o andamento da tarefa.
+    Pelas primeiras linhas estima o tamanho da planilha em memória; acima do orçamento, converte
+    blocos de linhas em DataFrame à medida que lê, sem guardar todas as linhas como listas.
+    Retorna o DataFrame (mesma inferência de tipos do pd.read_excel) ou None se cancelada."""
+    if not tarefa['nome'].lower().endswith('.xlsx') or load_workbook is None:
+        return pd.read_excel(io.BytesIO(conteudo), sheet_name=indice)
+    
+    livro = load_workbook(io.BytesIO(conteudo), read_only=True, data_only=True)
+    try:
+        planilha = livro.worksheets[indice]
+        tarefa['linhas_planilha'] = planilha.max_row
+        tarefa['linhas_lidas'] = 0
+        cabecalho = None
+        linhas = []
+        blocos = []
+        for linha in planilha.iter_rows(values_only=True):
+            valores = [valor_celula_lida(valor) for valor in linha]
+            if cabecalho is None:
+                cabecalho = valores
+                continue
+            linhas.append(valores)
+            tarefa['linhas_lidas'] += 1
+            if tarefa['linhas_lidas'] == LINHAS_AMOSTRA_MEMORIA and planilha.max_row:
+                registrar_estimativa_memoria(tarefa, indice, TextParser([cabecalho] + linhas, header=0).read(), planilha.max_row - 1)
+            if tarefa['acima_orcamento'] and len(linhas) == LINHAS_BLOCO_LEITURA:
+                blocos.append(TextParser([cabecalho] + linhas, header=0, dtype=object).read())
+                linhas = []
+            if tarefa['linhas_lidas'] % LINHAS_PROGRESSO_LEITURA == 0 and tarefa['cancelar'].is_set():
+                return None
+    finally:
+        livro.close()
+    
+    if cabecalho is None:
+        return pd.DataFrame()
+    while linhas and all(valor == '' for valor in linhas[-1]):
+        linhas.pop()
+    if not blocos:
+        return TextParser([cabecalho] + linhas, header=0).read()
+    if linhas:
+        blocos.append(TextParser([cabecalho] + linhas, header=0, dtype=object).read())
+    return inferir_tipos_planilha(pd.concat(blocos, ignore_index=True))
+
+def registrar_estimativa_memoria(tarefa, indice, amostra, linhas_planilha):
+    """Soma a estimativa da planilha às anteriores e marca a leitura como acima do orçamento se preciso"""
+    tarefa['memoria'][PLANILHAS_LEITURA[indice]] = {'estimada_mb': estimar_memoria_planilha(amostra, linhas_planilha) / 1024 ** 2}
+    estimada_total = sum(registro['estimada_mb'] for registro in tarefa['memoria'].values()) * 1024 ** 2
+    if estimada_total > LIMITE_MEMORIA_DADOS and not tarefa['acima_orcamento']:
+        tarefa['acima_orcamento'] = True
+        tarefa['avisos'].append(
+            f"⚠️ Conjunto de dados estimado em {format_number_br(estimada_total / 1024 ** 2)} MB, acima do orçamento de "
+            f"{format_number_br(LIMITE_MEMORIA_DADOS / 1024 ** 2)} MB: planilhas lidas em blocos e SIGIS mantido em arquivo mapeado em memória."
+        )
+
+def iniciar_leitura(uploaded_file):
+    """Dispara a leitura do arquivo enviado numa thread e retorna o registro de acompanhamento"""
+    tarefa = {
+        'arquivo_id': uploaded_file.file_id,
+        'nome': uploaded_file.name,
+        'cancelar': threading.Event(),
+        'planilhas_lidas': 0,
+        'linhas_lidas': 0,
+        'linhas_planilha': None,
+        'df': None,
+        'particoes': None,
+        'df_sigis': None,
+        'planilha_parametros': None,
+        'erro': None,
+        'avisos': [],
+        'memoria': {},
+        'acima_orcamento': False,
+        'concluida': False
+    }
+    conteudo = uploaded_file.getvalue()
+    tarefa['chave_arquivo'] = hashlib.sha1(conteudo).hexdigest()
+    
+    def executar():
+        try:
+            # Arquivo já lido por este ou outro processo: usa o resultado do cache persistente
+            lido = ler_cache_resultado(chave_cache_resultado('leitura', tarefa['chave_arquivo']))
+            if lido is not None:
+                try:
+                    lido['df_sigis'] = sigis_do_cache(lido['df_sigis'])
+                except Exception as e:
+                    print(f"Erro ao remapear o SIGIS do cache, relendo o arquivo: {e}")
+                    lido = None
+            if lido is not None:
+                tarefa.update(lido, planilhas_lidas=len(PLANILHAS_LEITURA))
+                return
+            
+            df = ler_planilha_em_linhas(conteudo, 0, tarefa)
+            if df is None:
+                return
+            registrar_memoria_lida(tarefa, 0, df)
+            df, tarefa['erro'] = preparar_balanco_lido(df)
+            if df is None:
+                return
+            # Balanço particionado já na leitura: os filtros podem ser exibidos antes do SIGIS
+            tarefa['df'], tarefa['particoes'] = particionar_balanco(df)
+            tarefa['planilhas_lidas'] = 1
+            if tarefa['cancelar'].is_set():
+                return
+            
+            try:
+                df_sigis = ler_planilha_em_linhas(conteudo, 1, tarefa)
+                if df_sigis is None:
+                    return
+                registrar_memoria_lida(tarefa, 1, df_sigis)
+                tarefa['df_sigis'], aviso = preparar_sigis_lido(df_sigis)
+                if aviso:
+                    tarefa['avisos'].append(aviso)
+                # Acima do orçamento, só o SIGIS tipado (mapeado em arquivo) é mantido
+                if tarefa['acima_orcamento'] and tarefa['df_sigis'] is not None:
+                    tarefa['df_sigis'] = preparar_sigis_tipado(tarefa['df_sigis'], mapear_arrow=True)
+            except Exception as e:
+                tarefa['avisos'].append(f"⚠️ Erro ao carregar planilha SIGIS (Planilha 2): {e}")
+            tarefa['planilhas_lidas'] = 2
+            if tarefa['cancelar'].is_set():
+                return
+            
+            # Planilha 3 (opcional): pressão média e TMA por localidade
+            try:
+                df_parametros = ler_planilha_em_linhas(conteudo, 2, tarefa)
+            except Exception:
+                df_parametros = None  # arquivo sem a planilha 3
+            if df_parametros is not None:
+                tarefa['planilha_parametros'], aviso = preparar_parametros_lidos(df_parametros)
+                if aviso:
+                    tarefa['avisos'].append(aviso)
+            if tarefa['cancelar'].is_set():
+                return
+            tarefa['planilhas_lidas'] = 3
+            gravar_cache_resultado(chave_cache_resultado('leitura', tarefa['chave_arquivo']), {
+                **{chave: tarefa[chave] for chave in ['df', 'particoes', 'planilha_parametros', 'avisos', 'memoria']},
+                'df_sigis': sigis_para_cache(tarefa['df_sigis'])
+            })
+        except Exception as e:
+            tarefa['erro'] = f"❌ Erro ao carregar dados: {e}"
+        finally:
+            tarefa['concluida'] = True
+    
+    threading.Thread(target=executar, name='leitura', daemon=True).start()
+    return tarefa
+
+def registrar_memoria_lida(tarefa, indice, df):
+    """Com MEDIR_MEMORIA, registra o tamanho real da planilha lida ao lado da estimativa"""
+    if MEDIR_MEMORIA:
+        registro = tarefa['memoria'].setdefault(PLANILHAS_LEITURA[indice], {'estimada_mb': np.nan})
+        registro['real_mb'] = df.memory_usage(index=False, deep=True).sum() / 1024 ** 2
+
+def cancelar_leitura(tarefa):
+    """Pede o fim da leitura em curso (a thread para no próximo bloco de linhas)"""
+    if tarefa is not None:
+        tarefa['cancelar'].set()
+
+# REPOSITÓRIO COLUNAR INCREMENTAL
+# Partições Parquet por regional e ano: cada nova planilha mensal reescreve só as partições que traz
+# repositorio/
+#   balanco/regional=RRR/ano=AAAA/dados.parquet   (idem para sigis/ e cubo/)
+#   manifesto.json  (partições, meses, revisão e hierarquia regional → município → localidade)
+# O cubo guarda as medidas mensais por localidade de cada partição; ao abrir o repositório, o cubo
+# mensal é montado dessas partições, e só as de balanço ou SIGIS alterados são recalculadas
+COLUNAS_CUBO_REPOSITORIO = ['cod_localidade', 'ano_mes', *ITENS_BALANCO_CUBO, *MEDIDAS_SIGIS_CUBO]
+CHAVES_BALANCO = ['cod_localidade', 'ano_mes', 'id']
+REGIONAL_NAO_IDENTIFICADA = '_sem_regional'
+
+def normalizar_tabela_parquet(df, sigis=False):
+    """Ajusta tipos para Parquet (um tipo por coluna). No SIGIS, o código (coluna A) e o
+    valor (coluna I) viram numéricos; no balanço, o id vira texto. Colunas de texto com
+    tipos misturados são convertidas para texto."""
+    df = df.copy()
+    if sigis:
+        df.isetitem(0, pd.to_numeric(df.iloc[:, 0], errors='coerce'))
+        if len(df.columns) > 8:
+            df.isetitem(8, pd.to_numeric(df.iloc[:, 8], errors='coerce').astype(np.float64))
+    elif 'id' in df.columns:
+        df['id'] = df['id'].astype(str)
+    
+    for posicao, coluna in enumerate(df.columns):
+        serie = df.iloc[:, posicao]
+        if serie.dtype == object and serie.dropna().map(type).nunique() > 1:
+            df.isetitem(posicao, serie.where(serie.isna(), serie.astype(str)))
+    return df
+
+def chaves_sigis(df_sigis):
+    """Chave de deduplicação do SIGIS: (código, localidade, ano_mes)"""
+    coluna_localidade = 'cod_localidade' if 'cod_localidade' in df_sigis.columns else 'nome_localidade'
+    return [df_sigis.columns[0], coluna_localidade, 'ano_mes']
+
+def nome_pasta_regional(cod_regional):
+    """Nome de pasta seguro para o código da regional"""
+    if pd.isna(cod_regional):
+        return REGIONAL_NAO_IDENTIFICADA
+    return str(cod_regional).replace('/', '_').replace('\\', '_')
+
+def gravar_parquet_atomico(caminho, df):
+    """Grava a partição em arquivo temporário e substitui a anterior de uma vez"""
+    caminho.parent.mkdir(parents=True, exist_ok=True)
+    caminho_tmp = caminho.with_suffix(f".{os.getpid()}.tmp")
+    df.to_parquet(caminho_tmp, index=False)
+    os.replace(caminho_tmp, caminho)
+
+def ler_manifesto(raiz):
+    """Lê o manifesto do repositório (partições, linhas e meses de cada uma)"""
+    caminho = Path(raiz) / 'manifesto.json'
+    if caminho.exists():
+        with open(caminho, encoding='utf-8') as arquivo:
+            manifesto = json.load(arquivo)
+        if manifesto.get('versao', 1) < 2:
+            return migrar_repositorio_v1(raiz)
+        return manifesto
+    return {'versao': 2, 'balanco': {}, 'sigis': {}, 'cubo': {}, 'localidades': {}}
+
+def gravar_manifesto(raiz, manifesto):
+    caminho = Path(raiz) / 'manifesto.json'
+    caminho_tmp = caminho.with_suffix(f".{os.getpid()}.tmp")
+    with open(caminho_tmp, 'w', encoding='utf-8') as arquivo:
+        json.dump(manifesto, arquivo, ensure_ascii=False, indent=2)
+    os.replace(caminho_tmp, caminho)
+
+travas_repositorio = threading.local()
+
+@contextmanager
+def travar_repositorio(raiz):
+    """Trava exclusiva do repositório (arquivo .trava na raiz), entre sessões e processos.
+    Reentrante na mesma thread: a migração da versão 1 anexa dentro da própria trava."""
+    raiz = Path(raiz)
+    raiz.mkdir(parents=True, exist_ok=True)
+    chave = str(raiz.resolve())
+    ativas = travas_repositorio.__dict__.setdefault('ativas', set())
+    if chave in ativas:
+        yield
+        return
+    
+    with open(raiz / '.trava', 'a+b') as arquivo:
+        if fcntl is not None:
+            fcntl.flock(arquivo.fileno(), fcntl.LOCK_EX)
+        else:
+            arquivo.seek(0)
+            msvcrt.locking(arquivo.fileno(), msvcrt.LK_LOCK, 1)
+        ativas.add(chave)
+        try:
+            yield
+        finally:
+            ativas.discard(chave)
+            if fcntl is not None:
+                fcntl.flock(arquivo.fileno(), fcntl.LOCK_UN)
+            else:
+                arquivo.seek(0)
+                msvcrt.locking(arquivo.fileno(), msvcrt.LK_UNLCK, 1)
+
+def migrar_repositorio_v1(raiz):
+    """Converte o repositório particionado só por ano (versão 1) para regional/ano"""
+    raiz = Path(raiz)
+    with travar_repositorio(raiz):
+        # Outro processo pode ter migrado enquanto esperávamos a trava
+        with open(raiz / 'manifesto.json', encoding='utf-8') as arquivo:
+            if json.load(arquivo).get('versao', 1) >= 2:
+                return ler_manifesto(raiz)
+        
+        df = ler_particoes(raiz, 'balanco', padrao='ano=*/dados.parquet')
+        df_sigis = ler_particoes(raiz, 'sigis', padrao='ano=*/dados.parquet')
+        
+        for tabela in ['balanco', 'sigis', 'cubo']:
+            for pasta in (raiz / tabela).glob('ano=*'):
+                shutil.rmtree(pasta)
+        
+        gravar_manifesto(raiz, {'versao': 2, 'balanco': {}, 'sigis': {}, 'cubo': {}, 'localidades': {}})
+        if df is not None:
+            anexar_ao_repositorio(raiz, df, df_sigis)
+        return ler_manifesto(raiz)
+
+def anexar_ao_repositorio(raiz, df_novo, df_sigis_novo):
+    """Anexa as planilhas de um novo arquivo ao repositório, deduplicando por
+    (cod_localidade, ano_mes, id) no balanço e (código, localidade, ano_mes) no SIGIS.
+    Linhas novas substituem as existentes. Retorna o resumo por tabela.
+    Leitura do manifesto, partições e gravação ficam sob a trava exclusiva do repositório."""
+    with travar_repositorio(raiz):
+        return anexar_particoes(Path(raiz), df_novo, df_sigis_novo)
+
+def anexar_particoes(raiz, df_novo, df_sigis_novo):
+    """Corpo de anexar_ao_repositorio; deve ser chamado com a trava do repositório"""
+    manifesto = ler_manifesto(raiz)
+    manifesto['revisao'] = manifesto.get('revisao', 0) + 1
+    particoes_afetadas = set()
+    resumo = {}
+    
+    # Hierarquia das localidades: define a regional das linhas do SIGIS
+    hierarquia = df_novo.drop_duplicates('cod_localidade')
+    for _, linha in hierarquia.iterrows():
+        manifesto['localidades'][str(linha['cod_localidade'])] = {
+            'cod_regional': nome_pasta_regional(linha['cod_regional']),
+            'nome_regional': str(linha['nome_regional']),
+            'nome_municipio': str(linha['nome_municipio']),
+            'nome_localidade': str(linha['nome_localidade'])
+        }
+    
+    df_novo = normalizar_tabela_parquet(df_novo)
+    df_novo['_regional'] = df_novo['cod_regional'].map(nome_pasta_regional)
+    tabelas = [('balanco', df_novo, CHAVES_BALANCO)]
+    
+    if df_sigis_novo is not None:
+        df_sigis_novo = normalizar_tabela_parquet(df_sigis_novo, sigis=True)
+        if 'cod_localidade' in df_sigis_novo.columns:
+            regional_por_localidade = {k: v['cod_regional'] for k, v in manifesto['localidades'].items()}
+            codigos = pd.to_numeric(df_sigis_novo['cod_localidade'], errors='coerce')
+            chave = codigos.map(lambda c: str(int(c)) if pd.notna(c) else '').where(codigos.notna(), df_sigis_novo['cod_localidade'].astype(str))
+        else:
+            regional_por_localidade = {v['nome_localidade']: v['cod_regional'] for v in manifesto['localidades'].values()}
+            chave = df_sigis_novo['nome_localidade'].astype(str) if 'nome_localidade' in df_sigis_novo.columns else pd.Series('', index=df_sigis_novo.index)
+        df_sigis_novo['_regional'] = chave.map(regional_por_localidade).fillna(REGIONAL_NAO_IDENTIFICADA)
+        tabelas.append(('sigis', df_sigis_novo, chaves_sigis(df_sigis_novo)))
+    
+    for tabela, df_tabela, chaves in tabelas:
+        if df_tabela.empty:
+            continue
+        linhas_novas = 0
+        
+        for (regional, ano), df_particao in df_tabela.groupby([df_tabela['_regional'], df_tabela['ano_mes'] // 100]):
+            ano = int(ano)
+            df_particao = df_particao.drop(columns='_regional')
+            caminho = raiz / tabela / f"regional={regional}" / f"ano={ano}" / 'dados.parquet'
+            linhas_antes = 0
+            if caminho.exists():
+                df_existente = pd.read_parquet(caminho)
+                linhas_antes = len(df_existente)
+                df_particao = pd.concat([df_existente, df_particao], ignore_index=True)
+            df_particao = df_particao.drop_duplicates(subset=chaves, keep='last').reset_index(drop=True)
+            
+            gravar_parquet_atomico(caminho, df_particao)
+            manifesto[tabela][f"{regional}/{ano}"] = {
+                'regional': regional,
+                'ano': ano,
+                'linhas': len(df_particao),
+                'meses': sorted(int(m) for m in df_particao['ano_mes'].unique()),
+                'revisao': manifesto['revisao']
+            }
+            linhas_novas += len(df_particao) - linhas_antes
+            particoes_afetadas.add((regional, ano))
+        
+        resumo[tabela] = linhas_novas
+    
+    # Rollups: só as partições que receberam dados são recalculadas
+    for regional, ano in sorted(particoes_afetadas):
+        atualizar_cubo_repositorio(raiz, regional, ano, manifesto)
+    
+    manifesto['atualizado_em'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    gravar_manifesto(raiz, manifesto)
+    resumo['particoes_afetadas'] = sorted(f"{r}/{a}" for r, a in particoes_afetadas)
+    return resumo
+
+def ler_particoes(raiz, tabela, regionais=None, anos=None, padrao='regional=*/ano=*/dados.parquet'):
+    """Concatena as partições de uma tabela. Os filtros de regional (código) e ano são
+    aplicados sobre os nomes das pastas, antes de qualquer leitura."""
+    pasta = Path(raiz) / tabela
+    if not pasta.exists():
+        return None
+    
+    arquivos = []
+    for arquivo in sorted(pasta.glob(padrao)):
+        if anos is not None and int(arquivo.parent.name.split('=')[1]) not in anos:
+            continue
+        if regionais is not None and arquivo.parent.parent.name.split('=', 1)[1] not in {nome_pasta_regional(r) for r in regionais}:
+            continue
+        arquivos.append(arquivo)
+    
+    if not arquivos:
+        return None
+    return pd.concat([pd.read_parquet(a) for a in arquivos], ignore_index=True)
+
+def origem_cubo(manifesto, particao):
+    """Revisões do balanço e do SIGIS da partição: o cubo gravado com outras está desatualizado"""
+    return [manifesto[tabela].get(particao, {}).get('revisao') for tabela in ['balanco', 'sigis']]
+
+def atualizar_cubo_repositorio(raiz, regional, ano, manifesto):
+    """Recalcula as medidas do cubo mensal de uma partição (regional, ano), inclusive das que só
+    têm SIGIS (localidades ainda sem regional conhecida)"""
+    df_particao = ler_particoes(raiz, 'balanco', regionais=[regional], anos={ano})
+    df_sigis_particao = ler_particoes(raiz, 'sigis', regionais=[regional], anos={ano})
+    if df_particao is None and df_sigis_particao is None:
+        return
+    if df_particao is None:
+        df_particao = pd.DataFrame(columns=['cod_localidade', 'ano_mes', 'nome_info', 'valor'])
+    
+    cubo = montar_cubo_mensal(df_particao, preparar_sigis_tipado(df_sigis_particao, mapear_arrow=False))
+    gravar_parquet_atomico(Path(raiz) / 'cubo' / f"regional={regional}" / f"ano={ano}" / 'dados.parquet', cubo[COLUNAS_CUBO_REPOSITORIO])
+    particao = f"{regional}/{ano}"
+    manifesto['cubo'][particao] = {'regional': regional, 'ano': ano, 'linhas': len(cubo), 'origem': origem_cubo(manifesto, particao)}
+
+def carregar_cubo_repositorio(raiz):
+    """Medidas do cubo mensal do repositório inteiro, lidas das partições persistidas. Antes,
+    recalcula as partições desatualizadas ou sem cubo (gravadas por versões anteriores).
+    Uma localidade que mudou de regional tem linhas em mais de uma partição: as partes são somadas."""
+    raiz = Path(raiz)
+    with travar_repositorio(raiz):
+        manifesto = ler_manifesto(raiz)
+        pendentes = [
+            particao for particao in sorted(set(manifesto['balanco']) | set(manifesto['sigis']))
+            if manifesto['cubo'].get(particao, {}).get('origem') != origem_cubo(manifesto, particao)
+        ]
+        for particao in pendentes:
+            entrada = manifesto['balanco'].get(particao) or manifesto['sigis'][particao]
+            atualizar_cubo_repositorio(raiz, entrada['regional'], entrada['ano'], manifesto)
+        if pendentes:
+            gravar_manifesto(raiz, manifesto)
+        cubo = ler_particoes(raiz, 'cubo')
+    
+    if cubo is None:
+        return None
+    if cubo.duplicated(['cod_localidade', 'ano_mes']).any():
+        cubo = cubo.groupby(['cod_localidade', 'ano_mes'], as_index=False).sum()
+    return cubo
+
+def carregar_repositorio(raiz, regionais=None, anos=None):
+    """Carrega o balanço e o SIGIS do repositório no formato de load_data,
+    lendo só as partições das regionais (códigos) e anos pedidos"""
+    df = ler_particoes(raiz, 'balanco', regionais, anos)
+    if df is None:
+        return None, None
+    df_sigis = ler_particoes(raiz, 'sigis', regionais, anos)
+    return df, df_sigis
+
+# PACOTE COMPILADO
+# O arquivo mensal oficial é processado uma vez, fora do app, num pacote versionado de tabelas
+# Feather sem compressão; o app abre o pacote mapeado em memória, sem ler o Excel nem pré-calcular
+# pacotes/pacote_<mês inicial>_<mês final>_<chave>/
+#   balanco.feather, sigis.feather (colunas tipadas), cubo_mensal.feather, indicadores_localidades.feather,
+#   series_niveis.feather, qualidade_sigis.feather, hidrometros_mensais.feather, parametros.feather
+#   metadados.json (partições do balanço e índice da hierarquia; chaves tupla em texto JSON)
+#   manifesto.json (versão do formato, chave do conjunto de dados, origem, período e linhas por tabela)
+# Só são listados e abertos pacotes (e a pasta de pacotes) do usuário do processo
+VERSAO_PACOTE = 2
+
+def valor_json(valor):
+    """Tipos numpy e conjuntos em tipos JSON (conjuntos viram listas ordenadas)"""
+    if isinstance(valor, np.generic):
+        return valor.item()
+    if isinstance(valor, (set, frozenset)):
+        return sorted((valor_json(item) if isinstance(item, np.generic) else item for item in valor), key=str)
+    raise TypeError(f"Tipo sem representação JSON: {type(valor).__name__}")
+
+def chave_para_json(chave):
+    """Chave de dicionário (texto, número, NaN ou tupla) como texto JSON"""
+    return json.dumps(list(chave) if isinstance(chave, tuple) else chave, default=valor_json)
+
+def constante_json(constante):
+    """NaN/Infinity lidos do JSON; NaN é sempre o mesmo objeto (np.nan), para valer em conjuntos e dicionários"""
+    return np.nan if constante == 'NaN' else float(constante)
+
+def chave_de_json(texto):
+    """Inverso de chave_para_json (listas voltam a ser tuplas)"""
+    chave = json.loads(texto, parse_constant=constante_json)
+    return tuple(chave) if isinstance(chave, list) else chave
+
+def metadados_para_json(objeto):
+    """Metadados de particionar_balanco em tipos JSON, com as chaves dos dicionários em texto"""
+    if isinstance(objeto, dict):
+        return {chave_para_json(chave): metadados_para_json(valor) for chave, valor in objeto.items()}
+    if isinstance(objeto, (list, tuple)):
+        return [metadados_para_json(valor) for valor in objeto]
+    return objeto
+
+def metadados_de_json(objeto):
+    """Inverso de metadados_para_json: chaves de volta aos tipos originais, períodos em tupla
+    e códigos de regional em conjunto"""
+    if isinstance(objeto, dict):
+        metadados = {chave_de_json(chave): metadados_de_json(valor) for chave, valor in objeto.items()}
+        hierarquia = metadados.get('hierarquia')
+        if hierarquia is not None:
+            hierarquia['periodo'] = {no: tuple(periodo) for no, periodo in hierarquia['periodo'].items()}
+            hierarquia['codigos_regional'] = {nome: set(codigos) for nome, codigos in hierarquia['codigos_regional'].items()}
+        return metadados
+    if isinstance(objeto, list):
+        return [metadados_de_json(valor) for valor in objeto]
+    return objeto
+
+def pertence_ao_processo(caminho):
+    """Verdadeiro se o caminho é do usuário do processo e só ele pode alterá-lo (sem uid, como no Windows, sempre)"""
+    if not hasattr(os, 'getuid'):
+        return True
+    estado = Path(caminho).stat()
+    return estado.st_uid == os.getuid() and not estado.st_mode & 0o022
+
+def gravar_tabela_pacote(caminho, tabela):
+    """Grava a tabela em Feather sem compressão, num único lote (cada coluna contígua no arquivo)"""
+    if isinstance(tabela, pd.DataFrame):
+        tabela = pa.Table.from_pandas(normalizar_tabela_parquet(tabela), preserve_index=False)
+    feather.write_feather(tabela, caminho, compression='uncompressed', chunksize=max(1, tabela.num_rows))
+
+def tabela_arrow_sigis(sigis_tipado):
+    """Colunas tipadas do SIGIS como tabela Arrow (sem converter NaN do valor em nulo)"""
+    colunas = {
+        'codigo': pa.array(sigis_tipado['codigo'], type=pa.int32()),
+        'ano_mes': pa.array(sigis_tipado['ano_mes'], type=pa.int32()),
+        'valor': pa.array(sigis_tipado['valor'], type=pa.float64())
+    }
+    localidade = sigis_tipado['localidade']
+    if localidade is not None:
+        if localidade.dtype != np.int32:
+            localidade = normalizar_tabela_parquet(pd.DataFrame({'localidade': localidade}))['localidade']
+        colunas['localidade'] = pa.array(localidade)
+    return pa.table(colunas)
+
+def compilar_pacote(df, df_sigis, chave, origem='', df_parametros=None, destino=None):
+    """Processa o conjunto de dados (partições, índices, cubo, indicadores, séries, qualidade e
+    hidrômetros) e grava o pacote. Retorna o caminho do pacote."""
+    destino = Path(destino or DIRETORIO_PACOTES)
+    df, particoes = particionar_balanco(df)
+    futuros = iniciar_aquecimento(df, df_sigis, chave)
+    resultados = {etapa: futuro.result() for etapa, futuro in futuros.items()}
+    sigis_tipado = resultados.pop('sigis_tipado')
+    
+    nome = f"pacote_{particoes['meses'][0]}_{particoes['meses'][-1]}_{chave[:10]}"
+    caminho = destino / nome
+    caminho_tmp = destino / f".{nome}.{os.getpid()}.tmp"
+    shutil.rmtree(caminho_tmp, ignore_errors=True)
+    caminho_tmp.mkdir(parents=True)
+    
+    tabelas = {'balanco': df, **resultados, 'parametros': df_parametros}
+    if sigis_tipado is not None:
+        tabelas['sigis'] = tabela_arrow_sigis(sigis_tipado)
+    linhas = {}
+    for nome_tabela, tabela in tabelas.items():
+        if tabela is not None:
+            gravar_tabela_pacote(caminho_tmp / f"{nome_tabela}.feather", tabela)
+            linhas[nome_tabela] = len(tabela)
+    
+    with open(caminho_tmp / 'metadados.json', 'w', encoding='utf-8') as arquivo:
+        json.dump(metadados_para_json(particoes), arquivo, ensure_ascii=False, default=valor_json)
+    with open(caminho_tmp / 'manifesto.json', 'w', encoding='utf-8') as arquivo:
+        json.dump({
+            'versao_formato': VERSAO_PACOTE,
+            'chave': chave,
+            'origem': origem,
+            'periodo': [particoes['meses'][0], particoes['meses'][-1]],
+            'chave_localidade': sigis_tipado['chave_localidade'] if sigis_tipado is not None else None,
+            'tabelas': linhas,
+            'criado_em': time.strftime('%Y-%m-%d %H:%M:%S')
+        }, arquivo, ensure_ascii=False, indent=2)
+    
+    # Mesmo conteúdo compilado de novo: substitui o pacote anterior
+    if caminho.exists():
+        shutil.rmtree(caminho)
+    os.replace(caminho_tmp, caminho)
+    return caminho
+
+def compilar_pacote_arquivo(caminho_arquivo, destino=None):
+    """Compila o pacote a partir do arquivo Excel (mesma chave do arquivo enviado pelo app)"""
+    with open(caminho_arquivo, 'rb') as arquivo:
+        conteudo = arquivo.read()
+    
+    df, erro = preparar_balanco_lido(pd.read_excel(io.BytesIO(conteudo), sheet_name=0))
+    if erro:
+        raise ValueError(erro)
+    try:
+        df_sigis, aviso = preparar_sigis_lido(pd.read_excel(io.BytesIO(conteudo), sheet_name=1))
+    except Exception as e:
+        df_sigis, aviso = None, f"⚠️ Erro ao carregar planilha SIGIS (Planilha 2): {e}"
+    if aviso:
+        print(aviso)
+    df_parametros, aviso = carregar_parametros_operacionais(io.BytesIO(conteudo))
+    if aviso:
+        print(aviso)
+    
+    return compilar_pacote(df, df_sigis, hashlib.sha1(conteudo).hexdigest(), Path(caminho_arquivo).name,
+                           df_parametros, destino)
+
+def ler_manifesto_pacote(caminho):
+    """Manifesto do pacote, ou None se faltar ou for de outra versão do formato"""
+    try:
+        with open(Path(caminho) / 'manifesto.json', encoding='utf-8') as arquivo:
+            manifesto = json.load(arquivo)
+    except (OSError, ValueError):
+        return None
+    return manifesto if manifesto.get('versao_formato') == VERSAO_PACOTE else None
+
+def listar_pacotes(raiz=None):
+    """Pacotes válidos da pasta, do mais recente para o mais antigo: {caminho: manifesto}"""
+    pacotes = {}
+    raiz = Path(raiz or DIRETORIO_PACOTES)
+    if not raiz.is_dir() or not pertence_ao_processo(raiz):
+        return pacotes
+    for caminho in raiz.glob('pacote_*'):
+        if not pertence_ao_processo(caminho):
+            continue
+        manifesto = ler_manifesto_pacote(caminho)
+        if manifesto is not None:
+            pacotes[str(caminho)] = manifesto
+    return dict(sorted(pacotes.items(), key=lambda item: item[1]['criado_em'], reverse=True))
+
+def futuro_resolvido(resultado):
+    """Future já concluído com o resultado (etapas do pré-cálculo lidas do pacote)"""
+    futuro = Future()
+    futuro.set_result(resultado)
+    return futuro
+
+def abrir_pacote(caminho):
+    """Abre o pacote com as tabelas mapeadas em memória. O SIGIS tipado aponta para o arquivo
+    sem cópia; as demais etapas do pré-cálculo voltam como Futures já concluídos.
+    Retorna None se o pacote faltar, for de outra versão ou de outro usuário."""
+    caminho = Path(caminho)
+    if not caminho.is_dir() or not (pertence_ao_processo(caminho.parent) and pertence_ao_processo(caminho)):
+        return None
+    manifesto = ler_manifesto_pacote(caminho)
+    if manifesto is None:
+        return None
+    
+    with open(caminho / 'metadados.json', encoding='utf-8') as arquivo:
+        particoes = metadados_de_json(json.load(arquivo, parse_constant=constante_json))
+    tabelas = {
+        nome: feather.read_table(pa.memory_map(str(caminho / f"{nome}.feather"), 'r'), memory_map=True)
+        for nome in manifesto['tabelas']
+    }
+    
+    sigis_tipado = None
+    if 'sigis' in tabelas:
+        tabelas.pop('sigis')
+        sigis_tipado = montar_indice_sigis(abrir_sigis_arrow(caminho / 'sigis.feather'), manifesto['chave_localidade'])
+    
+    tabelas = {nome: tabela.to_pandas(split_blocks=True) for nome, tabela in tabelas.items()}
+    aquecimento = {etapa: futuro_resolvido(tabelas.get(etapa)) for etapa in ETAPAS_AQUECIMENTO}
+    aquecimento['sigis_tipado'] = futuro_resolvido(sigis_tipado)
+    return {
+        'manifesto': manifesto,
+        'df': tabelas['balanco'],
+        'particoes': particoes,
+        'parametros': tabelas.get('parametros'),
+        'aquecimento': aquecimento
+    }
+
+# PARTIÇÕES EM MEMÓRIA DO BALANÇO (regional × ano)
+# O balanço fica ordenado por (cod_regional, ano): filtros da barra lateral viram seleção de fatias
+def particionar_balanco(df):
+    """Reordena o balanço por (cod_regional, ano), mantendo a ordem original dentro de cada
+    partição, e monta os metadados: posição das partições, meses e hierarquia de nomes.
+    Linhas sem ano_mes numérico não cabem em nenhuma partição: são descartadas e contadas."""
+    ano_mes = pd.to_numeric(df['ano_mes'], errors='coerce')
+    sem_mes = ano_mes.isna()
+    if sem_mes.any() or not pd.api.types.is_integer_dtype(df['ano_mes']):
+        df = df[~sem_mes].copy()
+        df['ano_mes'] = ano_mes[~sem_mes].astype(np.int64)
+    
+    ano = (df['ano_mes'] // 100).to_numpy()
+    codigos_regional = pd.factorize(df['cod_regional'], sort=True)[0]
+    ordem = np.lexsort((ano, codigos_regional))
+    df_ordenado = df.iloc[ordem].reset_index(drop=True)
+    
+    meses_dados = np.unique(df_ordenado['ano_mes'].to_numpy())
+    grupos = df_ordenado.groupby([df_ordenado['cod_regional'], df_ordenado['ano_mes'] // 100], sort=False, dropna=False)
+    ano_mes_ordenado = df_ordenado['ano_mes'].to_numpy()
+    particoes = {}
+    for (cod_regional, ano_particao), posicoes in grupos.indices.items():
+        # Regional NaN vira sempre np.nan (o mesmo objeto dos códigos da hierarquia), e os meses
+        # saem das posições porque a chave NaN não é localizável no resultado do groupby
+        particoes[(np.nan if pd.isna(cod_regional) else cod_regional, int(ano_particao))] = {
+            'inicio': int(posicoes[0]),
+            'fim': int(posicoes[-1]) + 1,
+            'meses': [int(m) for m in np.unique(ano_mes_ordenado[posicoes])]
+        }
+    
+    return df_ordenado, {
+        'particoes': particoes,
+        'hierarquia': montar_indice_hierarquia(df_ordenado),
+        'rotulos': rotular_meses(meses_dados),
+        'meses': [int(m) for m in meses_dados],
+        'linhas_sem_mes': int(sem_mes.sum())
+    }
+
+def particoes_do_recorte(metadados, regional_sel, data_range):
+    """Partições (início, fim, meses) da regional e dos anos do período"""
+    anos = set(range(int(data_range[0]) // 100, int(data_range[1]) // 100 + 1))
+    codigos_regional = None
+    if regional_sel != "Todas":
+        codigos_regional = metadados['hierarquia']['codigos_regional'].get(regional_sel, set())
+    
+    return [
+        p for (cod_regional, ano), p in metadados['particoes'].items()
+        if ano in anos and (codigos_regional is None or cod_regional in codigos_regional)
+    ]
+
+def recortar_particoes(df, metadados, regional_sel, data_range):
+    """Seleciona só as partições da regional e dos anos do período e aplica o período nelas"""
+    fatias = [df.iloc[p['inicio']:p['fim']] for p in particoes_do_recorte(metadados, regional_sel, data_range)]
+    if not fatias:
+        return df.iloc[0:0]
+    
+    recorte = pd.concat(fatias) if len(fatias) > 1 else fatias[0]
+    # Partições inteiramente dentro do período dispensam a cópia do filtro por máscara
+    no_periodo = (recorte['ano_mes'] >= data_range[0]) & (recorte['ano_mes'] <= data_range[1])
+    return recorte if no_periodo.all() else recorte[no_periodo]
+
+def meses_no_periodo(metadados, data_range):
+    """Meses com dados (em qualquer partição) dentro do período"""
+    return [m for m in metadados['meses'] if data_range[0] <= m <= data_range[1]]
+
+def montar_indice_hierarquia(df):
+    """Índice regional → municípios → localidades para os filtros em cascata, com os meses
+    (e o primeiro/último ano_mes) de cada nó. Município e localidade seguem o filtro por nome,
+    que junta todas as regionais com o mesmo nome."""
+    colunas = ['nome_regional', 'nome_municipio', 'nome_localidade']
+    meses_folha = df.groupby(colunas, dropna=False)['ano_mes'].unique()
+    
+    indice = {
+        'regionais': sorted(meses_folha.index.get_level_values('nome_regional').unique()),
+        'municipios': {'Todas': sorted(meses_folha.index.get_level_values('nome_municipio').unique())},
+        'localidades': {('Todas', 'Todos'): sorted(meses_folha.index.get_level_values('nome_localidade').unique())},
+        'meses': {},
+        'periodo': {},
+        'codigos_regional': df.groupby('nome_regional', dropna=False)['cod_regional'].unique()
+            .map(lambda codigos: {np.nan if pd.isna(c) else c for c in codigos}).to_dict()
+    }
+    
+    meses_no = {}
+    for (regional, municipio, localidade), meses in meses_folha.items():
+        indice['municipios'].setdefault(regional, set()).add(municipio)
+        indice['localidades'].setdefault((regional, 'Todos'), set()).add(localidade)
+        indice['localidades'].setdefault(('Todas', municipio), set()).add(localidade)
+        for no in [('geral', None), ('regional', regional), ('municipio', municipio), ('localidade', localidade)]:
+            meses_no.setdefault(no, set()).update(int(m) for m in meses)
+    
+    for chave in ['municipios', 'localidades']:
+        indice[chave] = {no: sorted(itens) for no, itens in indice[chave].items()}
+    for no, meses in meses_no.items():
+        indice['meses'][no] = sorted(meses)
+        indice['periodo'][no] = (indice['meses'][no][0], indice['meses'][no][-1])
+    return indice
+
+def consultar_indice_hierarquia(indice, regional_sel, municipio_sel, localidade_sel=None):
+    """Municípios e localidades disponíveis para a seleção atual e o nó que define o período"""
+    municipios = indice['municipios'].get(regional_sel, [])
+    if municipio_sel != "Todos":
+        localidades = indice['localidades'].get(('Todas', municipio_sel), [])
+    else:
+        localidades = indice['localidades'].get((regional_sel, 'Todos'), [])
+    
+    if localidade_sel not in (None, "Todas"):
+        no = ('localidade', localidade_sel)
+    elif municipio_sel != "Todos":
+        no = ('municipio', municipio_sel)
+    elif regional_sel != "Todas":
+        no = ('regional', regional_sel)
+    else:
+        no = ('geral', None)
+    return municipios, localidades, no
+
 # Restante das funções permanecem iguais...
 def apply_hierarchical_filters(df, regional_sel, municipio_sel, localidade_sel):
-    df_filtered = df.copy()
+    # Os filtros por máscara já devolvem um novo DataFrame; sem filtro, o recorte é usado como está
+    df_filtered = df
     if localidade_sel != "Todas":
         df_filtered = df_filtered[df_filtered['nome_localidade'] == localidade_sel]
         nivel = "localidade"
@@ -823,20 +3383,22 @@ def create_hidrometros_table(df_filtered, df_sigis, data_range, regional_sel, mu
         return pd.DataFrame()
     
     # IDM por ano
-    idm_values = [95.00, 93.50, 92.00, 90.30, 88.50, 86.80, 85.00, 83.00, 80.00, 77.00, 74.00, 71.00, 71.00, 71.00, 71.00, 71.00]
+    idm_values = IDM_POR_IDADE.tolist()
     
     # Códigos SIGIS
-    codigos_hidrometros = list(range(7380, 7441, 4))
-    codigos_volume = list(range(7444, 7505, 4))
+    codigos_hidrometros = CODIGOS_HIDROMETROS
+    codigos_volume = CODIGOS_VOLUME_HIDROMETROS
     
     def buscar_valor_agregado(codigo_sigis):
         """Busca dados reais do SIGIS"""
         if df_sigis is None:
             return 0
         
+        inicio_consulta = time.perf_counter()
+        linhas_varridas = len(df_sigis) if not isinstance(df_sigis, dict) else 0
+        localidades_validas = set()
         try:
             # Obter lista de localidades que passaram pelos filtros
-            localidades_validas = set()
             
             if not df_filtered.empty:
                 if 'cod_localidade' in df_filtered.columns:
@@ -844,9 +3406,16 @@ def create_hidrometros_table(df_filtered, df_sigis, data_range, regional_sel, mu
                 elif 'nome_localidade' in df_filtered.columns:
                     localidades_validas = set(df_filtered['nome_localidade'].unique())
             
+            # SIGIS tipado: recorte pelo índice de códigos
+            if isinstance(df_sigis, dict):
+                localidade, ano_mes, valores, linhas_varridas = selecionar_linhas_sigis(df_sigis, codigo_sigis, data_range, localidades_validas)
+                if localidade is not None and len(localidades_validas) > 0:
+                    return somar_ultimos_valores_por_localidade(localidade, ano_mes, valores)
+                return ultimo_valor_positivo(ano_mes, valores)
+            
             # Filtrar df_sigis pelo código específico primeiro
             mask_codigo = df_sigis.iloc[:, 0] == codigo_sigis
-            resultados = df_sigis[mask_codigo].copy()
+            resultados = df_sigis[mask_codigo]
             
             if resultados.empty:
                 return 0
@@ -917,6 +3486,9 @@ def create_hidrometros_table(df_filtered, df_sigis, data_range, regional_sel, mu
         except Exception as e:
             print(f"Erro ao buscar valor para código {codigo_sigis}: {e}")
             return 0
+        
+        finally:
+            registrar_consulta_sigis(codigo_sigis, 'create_hidrometros_table', linhas_varridas, time.perf_counter() - inicio_consulta, data_range, localidades_validas)
     
     hidrometros_data = []
     
@@ -1031,22 +3603,124 @@ def calculate_parent_percentage(df):
     return df_copy
 
 def create_hierarchical_display(df):
-    df_copy = df.copy().sort_values('id').reset_index(drop=True)
-    df_copy = calculate_parent_percentage(df_copy)
+    df_copy = calculate_parent_percentage(df.sort_values('id').reset_index(drop=True))
     hierarchy_info = df_copy.apply(format_hierarchical_name, axis=1)
     df_copy['nome_display'] = [info[0] for info in hierarchy_info]
     df_copy['style_type'] = [info[1] for info in hierarchy_info]
     df_copy['indent_level'] = [info[2] for info in hierarchy_info]
     return df_copy
 
+def criar_grafico_sunburst(df_aggregated, volume_total):
+    """Sunburst da hierarquia do balanço, com percentuais do total e relativos ao item pai"""
+    NOMES_ABREVIADOS = {'Volume de Entrada': 'Vol. Entrada', 'Consumo Autorizado': 'Consumo Autor.', 'Consumo Autorizado Faturado': 'Consumo Fatur.', 'Volume Medido': 'Vol. Medido', 'Autorizado não Faturado': 'Não Faturado', 'Uso Operacional': 'Operacional', 'Uso Emergencial': 'Emergencial', 'Uso Social': 'Social', 'Volume de Perdas': 'Vol. Perdas', 'Perdas Aparentes': 'Perdas Apar.', 'Clandestinos': 'Clandestinos', 'Fraudes': 'Fraudes', 'Submedição': 'Submedição', 'Perdas Reais': 'Perdas Reais', 'Vazamento em Ramais': 'Vaz. Ramais', 'Outros Vazamentos': 'Outros Vaz.'}
+
+    sunburst_data = []
+    colors_list = []
+
+    for _, row in df_aggregated.iterrows():
+        # Converter valores para float
+        try:
+            valor_row = float(row['valor']) if row['valor'] != '' else 0
+            volume_total_float = float(volume_total) if volume_total != '' else 0
+        except (ValueError, TypeError):
+            valor_row = 0
+            volume_total_float = 0
+
+        percentual = (valor_row / volume_total_float * 100) if volume_total_float > 0 else 0
+        nome_abrev = NOMES_ABREVIADOS.get(row['nome_info'], row['nome_info'])
+        percentual_formatted = f"{percentual:.1f}%".replace(".", ",")
+
+        sunburst_data.append({
+            'ids': row['id'], 'labels': f"{nome_abrev}<br>{percentual_formatted}",
+            'parents': row['parent'], 'values': row['valor'], 'customdata': row['nome_info']
+        })
+        colors_list.append(CORES_PERSONALIZADAS.get(row['nome_info'], 'rgba(128, 128, 128, 0.7)'))
+
+    sunburst_df = pd.DataFrame(sunburst_data)
+
+    # Calcular percentuais relativos para cada item
+    df_hierarchical_calc = calculate_parent_percentage(df_aggregated)
+
+    # Criar dados customizados com percentuais relativos
+    custom_data_enhanced = []
+    for _, row in df_aggregated.iterrows():
+        # Buscar percentual relativo correspondente
+        percentual_relativo = df_hierarchical_calc[df_hierarchical_calc['id'] == row['id']]['percentual_pai'].iloc[0]
+        custom_data_enhanced.append([
+            row['nome_info'],
+            row['valor'],
+            (row['valor'] / volume_total * 100) if volume_total > 0 else 0,
+            percentual_relativo
+        ])
+
+    fig_sunburst = go.Figure(go.Sunburst(
+        ids=sunburst_df['ids'], 
+        labels=sunburst_df['labels'], 
+        parents=sunburst_df['parents'],
+        values=sunburst_df['values'], 
+        customdata=custom_data_enhanced, 
+        branchvalues="total",
+        hovertemplate=(
+            '<b>%{customdata[0]}</b><br>' +
+            'Valor: %{customdata[1]:,.0f} m³<br>' +
+            'Percentual do Total: %{customdata[2]:.1f}%<br>' +
+            'Percentual Relativo: %{customdata[3]:.1f}%<br>' +
+            '<extra></extra>'
+        ),
+        maxdepth=4, 
+        insidetextorientation='horizontal',
+        marker=dict(colors=colors_list, line=dict(color="white", width=1)),
+        textfont=dict(size=16, color="black", family="Arial")
+    ))
+
+    fig_sunburst.update_layout(font_size=16, height=800, margin=dict(t=20, l=20, r=20, b=20))
+    return fig_sunburst
+
+def montar_tabela_hierarquica_html(df_aggregated, volume_total):
+    """Tabela HTML da hierarquia do balanço (valor, % do total e % relativo ao item pai)"""
+    df_display = create_hierarchical_display(df_aggregated)
+    df_display['Valor (m³)'] = df_display['valor'].apply(lambda x: format_number_br(x))
+    df_display['Percentual'] = df_display['valor'].apply(lambda x: f"{(x/volume_total)*100:.1f}%".replace(".", ",") if volume_total > 0 else "0,0%")
+    df_display['Percentual Pai'] = df_display['percentual_pai'].apply(lambda x: f"{x:.1f}%".replace(".", ","))
+
+    num_rows = len(df_display)
+    dynamic_height = min(100, max(400, (num_rows * 40) + 90))
+
+    html_table = f"<div style='height: {dynamic_height}px; border: none; padding: 15px; font-family: Arial, sans-serif; overflow: visible;'>"
+    html_table += "<table style='width: 100%; border-collapse: collapse;'>"
+    html_table += "<thead style='background-color: #f0f2f6;'><tr>"
+    html_table += "<th style='padding: 15px; text-align: left; border-bottom: 2px solid #ddd; font-weight: bold; font-size: 14px;'>Informação</th>"
+    html_table += "<th style='padding: 15px; text-align: right; border-bottom: 2px solid #ddd; font-weight: bold; font-size: 14px;'>Valor (m³)</th>"
+    html_table += "<th style='padding: 15px; text-align: right; border-bottom: 2px solid #ddd; font-weight: bold; font-size: 14px;'>% Total</th>"
+    html_table += "<th style='padding: 15px; text-align: right; border-bottom: 2px solid #ddd; font-weight: bold; font-size: 14px;'>% Relativo</th></tr></thead><tbody>"
+
+    for _, row in df_display.iterrows():
+        indent = "&nbsp;" * (row['indent_level'] * 6)
+    
+        if row['style_type'] == "bold":
+            nome_formatado = f"{indent}<strong>{row['nome_display']}</strong>"
+            style_extra = "font-weight: bold; background-color: #f8f9fa; font-size: 13px;"
+        elif row['style_type'] == "subtle":
+            nome_formatado = f"{indent}{row['nome_display']}"
+            style_extra = "background-color: #fafbfc; color: #495057; font-weight: 500; font-size: 13px;"
+        else:
+            nome_formatado = f"{indent}{row['nome_display']}"
+            style_extra = "font-size: 12px;"
+    
+        html_table += f"<tr style='border-bottom: 1px solid #eee; {style_extra}'>"
+        html_table += f"<td style='padding: 12px; vertical-align: middle;'>{nome_formatado}</td>"
+        html_table += f"<td style='padding: 12px; text-align: right; vertical-align: middle;'>{row['Valor (m³)']}</td>"
+        html_table += f"<td style='padding: 12px; text-align: right; vertical-align: middle;'>{row['Percentual']}</td>"
+        html_table += f"<td style='padding: 12px; text-align: right; vertical-align: middle;'>{row['Percentual Pai']}</td></tr>"
+
+    html_table += "</tbody></table></div>"
+    return html_table
+
 def create_sortable_analysis_table(df_analysis):
     """Cria uma tabela de análise com opções de classificação"""
     if df_analysis.empty:
         return None, None
     
-    # Preparar dados para classificação
-    df_sort = df_analysis.copy()
-    
     # Opções de classificação
     sort_options = {
         'Regional': 'Regional',
@@ -1083,31 +3757,116 @@ def create_sortable_analysis_table(df_analysis):
     column_to_sort = sort_options[sort_column]
     ascending = sort_order == "Crescente"
     
-    # Tratamento especial para categoria (ordem lógica A, B, C, D)
-    if column_to_sort == 'Categoria':
-        categoria_order = {'A': 1, 'B': 2, 'C': 3, 'D': 4}
-        df_sort['categoria_num'] = df_sort['Categoria'].map(categoria_order)
-        df_sort = df_sort.sort_values('categoria_num', ascending=ascending)
-        df_sort = df_sort.drop('categoria_num', axis=1)
-    else:
-        df_sort = df_sort.sort_values(column_to_sort, ascending=ascending)
+    # Tratamento especial para categoria (ordem lógica A, B, C, D)
+    # (sort_values devolve um novo DataFrame: df_analysis não é alterado)
+    if column_to_sort == 'Categoria':
+        categoria_order = {'A': 1, 'B': 2, 'C': 3, 'D': 4}
+        df_sort = df_analysis.sort_values('Categoria', key=lambda categorias: categorias.map(categoria_order), ascending=ascending)
+    else:
+        df_sort = df_analysis.sort_values(column_to_sort, ascending=ascending)
+    
+    # Preparar dados formatados para exibição
+    df_display = df_sort.copy()
+    df_display.insert(0, '#', range(1, len(df_display) + 1))
+    
+    # Aplicar formatação brasileira nas colunas numéricas
+    df_display['Volume Total de entrada'] = df_display['Volume Total de entrada'].apply(lambda x: format_number_br(x, 2))
+    df_display['% de Impacto'] = df_display['% de Impacto'].apply(lambda x: f"{x:.2f}%".replace(".", ","))
+    df_display['% de perdas'] = df_display['% de perdas'].apply(lambda x: f"{x:.2f}%".replace(".", ","))
+    df_display['IPL'] = df_display['IPL'].apply(lambda x: f"{x:.2f}".replace(".", ",") if x > 0 else "N/A")
+    df_display['IVI'] = df_display['IVI'].apply(lambda x: f"{x:.2f}".replace(".", ",") if isinstance(x, (int, float)) and not pd.isna(x) and x > 0 else "N/A")
+    
+    return df_display, df_sort
+
+def desenhar_filtros(particoes_balanco):
+    """Filtros da barra lateral (regional, município, localidade e período); os valores
+    escolhidos ficam no session_state, nas chaves sidebar_*"""
+    st.header("🔍 Filtros")
+    indice_hierarquia = particoes_balanco['hierarquia']
+    
+    # Regional
+    regional_selecionada = st.selectbox(
+        "Regional:",
+        ["Todas"] + indice_hierarquia['regionais'],
+        index=0,
+        key="sidebar_regional"
+    )
+    
+    # Município
+    municipios_filtrados, _, _ = consultar_indice_hierarquia(indice_hierarquia, regional_selecionada, "Todos")
+    municipio_selecionado = st.selectbox(
+        "Município:",
+        ["Todos"] + municipios_filtrados,
+        index=0,
+        key="sidebar_municipio"
+    )
+    
+    # Localidade
+    _, localidades_filtradas, _ = consultar_indice_hierarquia(indice_hierarquia, regional_selecionada, municipio_selecionado)
+    localidade_selecionada = st.selectbox(
+        "Localidade:",
+        ["Todas"] + localidades_filtradas,
+        index=0,
+        key="sidebar_localidade"
+    )
+    
+    # Período: limitado aos meses com dados no nó selecionado
+    _, _, no_selecionado = consultar_indice_hierarquia(indice_hierarquia, regional_selecionada, municipio_selecionado, localidade_selecionada)
+    min_data, max_data = indice_hierarquia['periodo'][no_selecionado]
+    rotulos_meses = particoes_balanco['rotulos']
     
-    # Preparar dados formatados para exibição
-    df_display = df_sort.copy()
-    df_display.insert(0, '#', range(1, len(df_display) + 1))
+    # Mostrar slider só com os meses existentes, com rótulos já formatados
+    st.select_slider(
+        "Período:",
+        options=indice_hierarquia['meses'][no_selecionado],
+        value=(min_data, max_data),
+        format_func=lambda x: rotulos_meses[x],
+        key="sidebar_periodo"
+    )
+
+def desenhar_previa(df_previa, ipl_previa):
+    """Indicadores, sunburst e tabela hierárquica da prévia, com o selo de valores ainda em refinamento"""
+    st.markdown(
+        "<span style='background-color: #FFE07D; color: #495057; padding: 4px 12px; border-radius: 12px; font-weight: bold;'>⏳ PRÉVIA</span>"
+        "<span style='color: #6c757d; margin-left: 10px;'>Totais por regional e mês; calculando os valores exatos por localidade...</span>",
+        unsafe_allow_html=True
+    )
+    volume_total = df_previa[df_previa['nome_info'] == 'Volume de Entrada']['valor'].sum()
+    perdas_agua = df_previa[df_previa['nome_info'] == 'Volume de Perdas']['valor'].sum()
     
-    # Aplicar formatação brasileira nas colunas numéricas
-    df_display['Volume Total de entrada'] = df_display['Volume Total de entrada'].apply(lambda x: format_number_br(x, 2))
-    df_display['% de Impacto'] = df_display['% de Impacto'].apply(lambda x: f"{x:.2f}%".replace(".", ","))
-    df_display['% de perdas'] = df_display['% de perdas'].apply(lambda x: f"{x:.2f}%".replace(".", ","))
-    df_display['IPL'] = df_display['IPL'].apply(lambda x: f"{x:.2f}".replace(".", ",") if x > 0 else "N/A")
-    df_display['IVI'] = df_display['IVI'].apply(lambda x: f"{x:.2f}".replace(".", ",") if isinstance(x, (int, float)) and not pd.isna(x) and x > 0 else "N/A")
+    st.subheader("Indicadores Principais")
+    col_ind1, col_ind2, col_ind3, _ = st.columns([1, 1, 1, 4])
+    with col_ind1:
+        st.metric("Volume de Entrada", format_number_br(volume_total))
+    with col_ind2:
+        percentual_perdas = (perdas_agua / volume_total) * 100 if volume_total > 0 else 0
+        st.metric("% de Perdas", f"{percentual_perdas:.1f}%".replace(".", ","))
+    with col_ind3:
+        if ipl_previa:
+            st.metric("IPL", f"{ipl_previa:.2f}".replace(".", ","), help="Aproximado: ligações do último mês do período")
+        else:
+            st.metric("IPL", "...", help="Aguardando o cubo mensal")
     
-    return df_display, df_sort
+    if not df_previa.empty:
+        col1, col2 = st.columns([1, 1])
+        with col1:
+            st.subheader("Visão Hierárquica")
+            st.plotly_chart(criar_grafico_sunburst(df_previa, volume_total), use_container_width=True)
+        with col2:
+            st.subheader(" ")
+            st.markdown(montar_tabela_hierarquica_html(df_previa, volume_total), unsafe_allow_html=True)
+
+# Compilação do pacote pela linha de comando: python main.py compilar arquivo.xlsx [pasta de destino]
+if __name__ == '__main__' and len(sys.argv) > 2 and sys.argv[1] == 'compilar':
+    if pa is None:
+        sys.exit("A compilação do pacote requer pyarrow")
+    print(f"Pacote compilado em {compilar_pacote_arquivo(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)}")
+    sys.exit(0)
 
 # Interface principal
 st.title("💧 Dashboard de Balanço Hídrico")
 
+marcar_etapa_memoria('carregamento')
 with st.sidebar:
     st.markdown("#### 📁 Carregamento de Dados")
     if 'file_loaded' not in st.session_state:
@@ -1115,38 +3874,195 @@ with st.sidebar:
     
     # Só mostrar carregamento se não há arquivo carregado
     if not st.session_state.file_loaded:        
+        modo_carga = "Arquivo único"
+        if pa is not None:
+            modo_carga = st.radio(
+                "Modo de carga:",
+                ["Arquivo único", "Repositório incremental", "Pacote compilado"],
+                horizontal=True,
+                key="modo_carga",
+                help="Repositório incremental: cada arquivo mensal é anexado ao repositório colunar, sem reprocessar o histórico\n\n"
+                     "Pacote compilado: arquivo já processado com `python main.py compilar arquivo.xlsx`, aberto sem ler o Excel"
+            )
+        
+        if modo_carga == "Pacote compilado":
+            pacotes = listar_pacotes()
+            if not pacotes:
+                st.info(f"💡 **Nenhum pacote compilado** em {DIRETORIO_PACOTES}\n\nCompile o arquivo mensal com `python main.py compilar arquivo.xlsx`.")
+                st.stop()
+            
+            caminho_pacote = st.selectbox(
+                "Pacote:", list(pacotes),
+                format_func=lambda c: f"{pacotes[c]['origem'] or Path(c).name} ({format_ano_mes(pacotes[c]['periodo'][0])} a {format_ano_mes(pacotes[c]['periodo'][1])})"
+            )
+            st.caption(f"Compilado em {pacotes[caminho_pacote]['criado_em']}")
+            if not st.button("📦 Abrir pacote"):
+                st.stop()
+            
+            pacote = abrir_pacote(caminho_pacote)
+            if pacote is None:
+                st.error("❌ **Pacote inválido, de outra versão ou de outro usuário**\n\nCompile o arquivo novamente.")
+                st.stop()
+            
+            # Balanço já particionado e pré-cálculo concluído: nada a recalcular após o rerun
+            st.session_state.file_loaded = True
+            st.session_state.df = pacote['df']
+            st.session_state.particoes_balanco = pacote['particoes']
+            st.session_state.chave_dados = pacote['manifesto']['chave']
+            st.session_state.aquecimento = pacote['aquecimento']
+            st.session_state.planilha_parametros = pacote['parametros']
+            st.rerun()
+        
+        if modo_carga == "Repositório incremental":
+            manifesto = ler_manifesto(DIRETORIO_REPOSITORIO)
+            arquivos_novos = st.file_uploader(
+                "📊 **Arquivos Excel a anexar**",
+                type=['xlsx', 'xls'],
+                accept_multiple_files=True,
+                help="Arquivos com as mesmas duas planilhas. Linhas repetidas (localidade, mês, item) substituem as existentes."
+            )
+            
+            if manifesto['balanco']:
+                anos_repositorio = ", ".join(sorted(manifesto['balanco']))
+                st.caption(f"Repositório: {anos_repositorio} | Atualizado em {manifesto.get('atualizado_em', '-')}")
+            abrir_repositorio = st.button("📂 Abrir repositório", disabled=not manifesto['balanco'])
+            
+            if not arquivos_novos and not abrir_repositorio:
+                st.info("💡 **Anexe os arquivos do mês** ou abra o repositório existente para começar a análise.")
+                st.stop()
+            
+            anexos = []
+            for arquivo_novo in arquivos_novos or []:
+                df_novo, df_sigis_novo = load_data(arquivo_novo)
+                if df_novo is None:
+                    st.error(f"❌ **Erro ao processar o arquivo {arquivo_novo.name}**")
+                    st.stop()
+                anexos.append((arquivo_novo.name, anexar_ao_repositorio(DIRETORIO_REPOSITORIO, df_novo, df_sigis_novo)))
+            
+            # Balanço, SIGIS e cubo lidos sob a trava: um anexo de outra sessão não entra no meio
+            with travar_repositorio(DIRETORIO_REPOSITORIO):
+                df, df_sigis = carregar_repositorio(DIRETORIO_REPOSITORIO)
+                cubo_repositorio = carregar_cubo_repositorio(DIRETORIO_REPOSITORIO) if df is not None else None
+            if df is None:
+                st.error("❌ **Repositório vazio ou inválido**")
+                st.stop()
+            
+            st.session_state.file_loaded = True
+            st.session_state.df = df
+            st.session_state.df_sigis = df_sigis
+            st.session_state.cubo_repositorio = cubo_repositorio
+            st.session_state.anexos_repositorio = anexos
+            st.rerun()
+        
         uploaded_file = st.file_uploader(
             "📊 **Arquivo Excel**",
             type=['xlsx', 'xls'],
-            help="Arquivo Excel com duas planilhas:\n- Planilha 1: Dados do Balanço Hídrico\n- Planilha 2: Dados do SIGIS"
+            help="Arquivo Excel com duas planilhas:\n- Planilha 1: Dados do Balanço Hídrico\n- Planilha 2: Dados do SIGIS\n- Planilha 3 (opcional): pressão média e TMA por localidade"
         )
         
         if uploaded_file is None:
+            cancelar_leitura(st.session_state.pop('leitura', None))
             st.info("💡 **Nenhum arquivo carregado**\n\nFaça upload do seu arquivo Excel para começar a análise.")
             st.stop()  # Para a execução aqui se não há arquivo
         
-        # Carregar dados
-        df, df_sigis = load_data(uploaded_file)
+        # Carregar dados em segundo plano; outro arquivo enviado cancela a leitura anterior
+        leitura = st.session_state.get('leitura')
+        if leitura is None or leitura['arquivo_id'] != uploaded_file.file_id:
+            cancelar_leitura(leitura)
+            leitura = st.session_state.leitura = iniciar_leitura(uploaded_file)
         
-        if df is None:
+        # Acompanhar o andamento; uma interação do usuário interrompe a espera e reexecuta a página
+        barra_leitura = st.progress(0.0)
+        filtros_exibidos = False
+        while not leitura['concluida']:
+            planilha_atual = PLANILHAS_LEITURA[min(leitura['planilhas_lidas'], len(PLANILHAS_LEITURA) - 1)]
+            total_linhas = leitura['linhas_planilha']
+            fracao_planilha = min(leitura['linhas_lidas'] / total_linhas, 1.0) if total_linhas else 0.0
+            barra_leitura.progress(
+                (leitura['planilhas_lidas'] + fracao_planilha) / len(PLANILHAS_LEITURA),
+                text=f"Lendo planilha {planilha_atual}: {format_number_br(leitura['linhas_lidas'])} linhas"
+            )
+            if leitura['particoes'] is not None and not filtros_exibidos:
+                desenhar_filtros(leitura['particoes'])
+                filtros_exibidos = True
+            time.sleep(0.25)
+        barra_leitura.empty()
+        
+        for aviso in leitura['avisos']:
+            st.warning(aviso)
+        if leitura['erro']:
+            st.error(leitura['erro'])
+        if leitura['df'] is None:
             st.error("❌ **Erro ao processar o arquivo**\n\nVerifique se o arquivo está no formato correto.")
             st.stop()
         
-        # Marcar como carregado e salvar no session_state
+        # Marcar como carregado e salvar no session_state (balanço já particionado na leitura)
         st.session_state.file_loaded = True
-        st.session_state.df = df
-        st.session_state.df_sigis = df_sigis
+        st.session_state.df = leitura['df']
+        st.session_state.particoes_balanco = leitura['particoes']
+        st.session_state.df_sigis = leitura['df_sigis']
+        st.session_state.chave_dados = leitura['chave_arquivo']
+        st.session_state.memoria_leitura = leitura['memoria']
+        del st.session_state.leitura
+        # Filtros escolhidos durante a leitura (numa execução anterior) continuam valendo após o rerun
+        if not filtros_exibidos:
+            for chave_filtro in ['sidebar_regional', 'sidebar_municipio', 'sidebar_localidade', 'sidebar_periodo']:
+                if chave_filtro in st.session_state:
+                    st.session_state[chave_filtro] = st.session_state[chave_filtro]
+        st.session_state.planilha_parametros = leitura['planilha_parametros']
         st.session_state.uploaded_file = uploaded_file
         st.rerun()  # Recarregar a página para esconder o carregamento
     
     else:
         # Arquivo já carregado - recuperar do session_state
+        # Balanço particionado por (regional, ano), montado uma vez por arquivo carregado
+        if 'particoes_balanco' not in st.session_state:
+            st.session_state.df, st.session_state.particoes_balanco = particionar_balanco(st.session_state.df)
         df = st.session_state.df
-        df_sigis = st.session_state.df_sigis
+        particoes_balanco = st.session_state.particoes_balanco
+        if particoes_balanco.get('linhas_sem_mes'):
+            st.sidebar.warning(f"⚠️ {particoes_balanco['linhas_sem_mes']} linha(s) do Balanço Hídrico sem ano_mes numérico foram desconsideradas.")
+        for nome_anexo, resumo_anexo in st.session_state.get('anexos_repositorio', []):
+            st.sidebar.success(
+                f"✅ {nome_anexo} anexado: {format_number_br(resumo_anexo.get('balanco', 0))} linha(s) novas no balanço e "
+                f"{format_number_br(resumo_anexo.get('sigis', 0))} no SIGIS | Partições: {', '.join(resumo_anexo['particoes_afetadas']) or '-'}"
+            )
+        
+        # Chave do conjunto de dados (conteúdo do arquivo enviado ou hash dos dados carregados)
+        if 'chave_dados' not in st.session_state:
+            st.session_state.chave_dados = calcular_chave_dados(df, st.session_state.df_sigis)
+        
+        # Pré-cálculo dos caches em segundo plano (índice do SIGIS, cubo, indicadores, séries)
+        if 'aquecimento' not in st.session_state:
+            st.session_state.aquecimento = iniciar_aquecimento(
+                df, st.session_state.df_sigis, st.session_state.chave_dados, st.session_state.get('cubo_repositorio')
+            )
+        
+        # SIGIS tipado e indexado por código, montado uma vez por arquivo carregado
+        if 'sigis_tipado' not in st.session_state:
+            st.session_state.sigis_tipado = resultado_aquecimento('sigis_tipado', lambda: preparar_sigis_tipado(st.session_state.df_sigis))
+        df_sigis = st.session_state.sigis_tipado
+        
+        # Pressão média e TMA por localidade (planilha 3 e/ou SIGIS), juntados uma vez
+        if 'parametros_operacionais' not in st.session_state:
+            st.session_state.parametros_operacionais = montar_parametros_operacionais(st.session_state.get('planilha_parametros'), df_sigis)
+        definir_parametros_operacionais(st.session_state.parametros_operacionais)
         
         # Mostrar apenas um pequeno indicador de que há arquivo carregado
         with st.expander("📊 Arquivo Carregado", expanded=False):
             st.success("✅ Arquivo Excel carregado com sucesso!")
+            etapas_prontas = [etapa for etapa, futuro in st.session_state.aquecimento.items() if futuro.done()]
+            if len(etapas_prontas) < len(ETAPAS_AQUECIMENTO):
+                etapa_atual = next(etapa for etapa in ETAPAS_AQUECIMENTO if etapa not in etapas_prontas)
+                st.progress(len(etapas_prontas) / len(ETAPAS_AQUECIMENTO),
+                            text=f"Pré-cálculo em andamento: {ETAPAS_AQUECIMENTO[etapa_atual]}")
+            if 'df_sigis' in st.session_state and pa is not None and st.button("📦 Compilar pacote", help=f"Grava o conjunto de dados processado em {DIRETORIO_PACOTES}, para abrir depois sem ler o Excel"):
+                with st.spinner("Compilando pacote..."):
+                    caminho_pacote = compilar_pacote(
+                        df, st.session_state.df_sigis, st.session_state.chave_dados,
+                        getattr(st.session_state.get('uploaded_file'), 'name', ''), st.session_state.get('planilha_parametros')
+                    )
+                st.success(f"✅ Pacote compilado em {caminho_pacote}")
             if st.button("Carregar Novo Arquivo"):
                 # Limpar session_state para permitir novo carregamento
                 st.session_state.file_loaded = False
@@ -1154,65 +4070,41 @@ with st.sidebar:
                     del st.session_state.df
                 if 'df_sigis' in st.session_state:
                     del st.session_state.df_sigis
+                if 'aquecimento' in st.session_state:
+                    cancelar_aquecimento(st.session_state.aquecimento)
+                    del st.session_state.aquecimento
+                if 'sigis_tipado' in st.session_state:
+                    del st.session_state.sigis_tipado
+                if 'chave_dados' in st.session_state:
+                    del st.session_state.chave_dados
+                if 'particoes_balanco' in st.session_state:
+                    del st.session_state.particoes_balanco
+                if 'cubo_mensal' in st.session_state:
+                    del st.session_state.cubo_mensal
+                if 'cubo_repositorio' in st.session_state:
+                    del st.session_state.cubo_repositorio
+                if 'anexos_repositorio' in st.session_state:
+                    del st.session_state.anexos_repositorio
+                if 'qualidade_sigis' in st.session_state:
+                    del st.session_state.qualidade_sigis
+                if 'bases_cenarios' in st.session_state:
+                    del st.session_state.bases_cenarios
+                if 'planilha_parametros' in st.session_state:
+                    del st.session_state.planilha_parametros
+                if 'parametros_operacionais' in st.session_state:
+                    del st.session_state.parametros_operacionais
+                if 'figuras' in st.session_state:
+                    del st.session_state.figuras
+                if 'exportacao' in st.session_state:
+                    descartar_exportacao(st.session_state.exportacao)
+                    del st.session_state.exportacao
                 if 'uploaded_file' in st.session_state:
                     del st.session_state.uploaded_file
+                if 'memoria_leitura' in st.session_state:
+                    del st.session_state.memoria_leitura
                 st.rerun()
     
-    st.header("🔍 Filtros")
-    
-    # Regional
-    regional_selecionada = st.selectbox(
-        "Regional:",
-        ["Todas"] + sorted(df['nome_regional'].unique()),
-        index=0,
-        key="sidebar_regional"
-    )
-    
-    # Município
-    municipios_filtrados = sorted(df[df['nome_regional'] == regional_selecionada]['nome_municipio'].unique()) if regional_selecionada != "Todas" else sorted(df['nome_municipio'].unique())
-    municipio_selecionado = st.selectbox(
-        "Município:",
-        ["Todos"] + municipios_filtrados,
-        index=0,
-        key="sidebar_municipio"
-    )
-    
-    # Localidade
-    if municipio_selecionado != "Todos":
-        localidades_filtradas = sorted(df[df['nome_municipio'] == municipio_selecionado]['nome_localidade'].unique())
-    elif regional_selecionada != "Todas":
-        localidades_filtradas = sorted(df[df['nome_regional'] == regional_selecionada]['nome_localidade'].unique())
-    else:
-        localidades_filtradas = sorted(df['nome_localidade'].unique())
-    localidade_selecionada = st.selectbox(
-        "Localidade:",
-        ["Todas"] + localidades_filtradas,
-        index=0,
-        key="sidebar_localidade"
-    )
-    
-    # Período
-    min_data, max_data = int(df['ano_mes'].min()), int(df['ano_mes'].max())
-    
-    # Criar opções formatadas para o slider
-    periodo_options = []
-    for ano_mes in range(min_data, max_data + 1):
-        periodo_options.append((ano_mes, format_ano_mes(ano_mes)))
-    
-    # Mostrar slider com valores formatados
-    data_range_indices = st.select_slider(
-        "Período:",
-        options=[opt[0] for opt in periodo_options],
-        value=(min_data, max_data),
-        format_func=lambda x: format_ano_mes(x),
-        key="sidebar_periodo"
-    )
-    
-    # Se o retorno for um único valor, converter para tupla
-    if isinstance(data_range_indices, int):
-        data_range = (data_range_indices, data_range_indices)
-    else:
-        data_range = data_range_indices
+    desenhar_filtros(particoes_balanco)
 
 # ==========================================
 # DEFINIR VARIÁVEIS GLOBAIS APÓS SIDEBAR
@@ -1231,8 +4123,26 @@ localidade_selecionada = st.session_state.sidebar_localidade
         
 st.markdown("---")
 
-# Aplicar filtros
-df_data_filtered = df[(df['ano_mes'] >= data_range[0]) & (df['ano_mes'] <= data_range[1])]
+marcar_etapa_memoria('previa')
+# Prévia das seleções grandes (regional ou todas), desenhada antes do recorte exato e removida
+# quando os indicadores exatos ficam prontos
+previa = st.empty()
+if municipio_selecionado == "Todos" and localidade_selecionada == "Todas":
+    linhas_recorte = sum(p['fim'] - p['inicio'] for p in particoes_do_recorte(particoes_balanco, regional_selecionada, data_range))
+    rollup_regional = resultado_aquecimento_pronto('rollup_regional') if linhas_recorte > LIMITE_LINHAS_PREVIA else None
+    if rollup_regional is not None:
+        cubo_previa = resultado_aquecimento_pronto('cubo_mensal')
+        with previa.container():
+            desenhar_previa(
+                agregar_previa(rollup_regional, regional_selecionada, data_range),
+                calcular_ipl_previa(cubo_previa, regional_selecionada, data_range) if cubo_previa is not None else 0
+            )
+
+marcar_etapa_memoria('recorte')
+# Aplicar filtros: só as partições (regional, ano) do filtro são lidas. A regional só é usada
+# no recorte quando é o nível de filtro; município e localidade são filtrados pelo nome
+regional_particoes = regional_selecionada if municipio_selecionado == "Todos" and localidade_selecionada == "Todas" else "Todas"
+df_data_filtered = recortar_particoes(df, particoes_balanco, regional_particoes, data_range)
 df_filtered, nivel_agregacao = apply_hierarchical_filters(df_data_filtered, regional_selecionada, municipio_selecionado, localidade_selecionada)
 
 if df_filtered.empty:
@@ -1268,18 +4178,25 @@ perdas_reais = df_aggregated[df_aggregated['nome_info'] == 'Perdas Reais']['valo
 # Obter localidades filtradas para busca no SIGIS
 localidades_filtradas_sigis = set(df_filtered['cod_localidade'].unique()) if 'cod_localidade' in df_filtered.columns else None
 
+definir_secao_telemetria('indicadores_principais')
+# PRAI por parâmetros calculado uma vez: entra no IVI e na pressão exibida
+prai_parametros = calcular_prai_parametros(df_sigis, data_range, localidades_filtradas_sigis)
 categoria_perdas, ivi_calculado, prac_calculado, prai_calculado = calcular_ivi(
     perdas_reais, 
     volume_total, 
     df_sigis, 
     data_range, 
-    localidades_filtradas_sigis
+    localidades_filtradas_sigis,
+    prai_parametros
 )
 
 ipl_calculado = calcular_ipl(df_sigis, data_range, localidades_filtradas_sigis)
 matriz_dados = get_matriz_banco_mundial()
+pressao_exibida = prai_parametros['pressao_media'] if prai_parametros is not None else PRESSAO_MEDIA_PADRAO
+pressao_formatada = format_number_br(pressao_exibida, 0 if float(pressao_exibida).is_integer() else 1)
 
-# Indicadores Principais
+# Indicadores Principais (substituem a prévia, se houver)
+previa.empty()
 st.subheader("Indicadores Principais")
 
 if categoria_perdas != 'N/A':
@@ -1313,7 +4230,7 @@ if categoria_perdas != 'N/A':
                 <h1 style='margin: 0; font-size: 1.8em; font-weight: bold; color: {cor_fonte}; line-height: 0.5;'>Categoria {categoria_perdas}</h1>
                 <div style='margin-top: 2px; font-size: 0.85em; opacity: 0.9; color: {cor_fonte}; display: flex; justify-content: space-between;'>
                     <span>IVI: {ivi_formatado}</span>
-                    <span>Pressão: 30m</span>
+                    <span>Pressão: {pressao_formatada}m</span>
                 </div>
             </div>
             <div style='background-color: #f8f9fa; padding: 15px; border-radius: 12px; flex: 1; 
@@ -1397,123 +4314,33 @@ with col1:
     st.subheader("Visão Hierárquica")
     
     if not df_aggregated.empty:
-        NOMES_ABREVIADOS = {'Volume de Entrada': 'Vol. Entrada', 'Consumo Autorizado': 'Consumo Autor.', 'Consumo Autorizado Faturado': 'Consumo Fatur.', 'Volume Medido': 'Vol. Medido', 'Autorizado não Faturado': 'Não Faturado', 'Uso Operacional': 'Operacional', 'Uso Emergencial': 'Emergencial', 'Uso Social': 'Social', 'Volume de Perdas': 'Vol. Perdas', 'Perdas Aparentes': 'Perdas Apar.', 'Clandestinos': 'Clandestinos', 'Fraudes': 'Fraudes', 'Submedição': 'Submedição', 'Perdas Reais': 'Perdas Reais', 'Vazamento em Ramais': 'Vaz. Ramais', 'Outros Vazamentos': 'Outros Vaz.'}
-        
-        sunburst_data = []
-        colors_list = []
-        
-        for _, row in df_aggregated.iterrows():
-            # Converter valores para float
-            try:
-                valor_row = float(row['valor']) if row['valor'] != '' else 0
-                volume_total_float = float(volume_total) if volume_total != '' else 0
-            except (ValueError, TypeError):
-                valor_row = 0
-                volume_total_float = 0
-            
-            percentual = (valor_row / volume_total_float * 100) if volume_total_float > 0 else 0
-            nome_abrev = NOMES_ABREVIADOS.get(row['nome_info'], row['nome_info'])
-            percentual_formatted = f"{percentual:.1f}%".replace(".", ",")
-            
-            sunburst_data.append({
-                'ids': row['id'], 'labels': f"{nome_abrev}<br>{percentual_formatted}",
-                'parents': row['parent'], 'values': row['valor'], 'customdata': row['nome_info']
-            })
-            colors_list.append(CORES_PERSONALIZADAS.get(row['nome_info'], 'rgba(128, 128, 128, 0.7)'))
-        
-        sunburst_df = pd.DataFrame(sunburst_data)
-        
-        # Calcular percentuais relativos para cada item
-        df_hierarchical_calc = df_aggregated.copy()
-        df_hierarchical_calc = calculate_parent_percentage(df_hierarchical_calc)
-        
-        # Criar dados customizados com percentuais relativos
-        custom_data_enhanced = []
-        for _, row in df_aggregated.iterrows():
-            # Buscar percentual relativo correspondente
-            percentual_relativo = df_hierarchical_calc[df_hierarchical_calc['id'] == row['id']]['percentual_pai'].iloc[0]
-            custom_data_enhanced.append([
-                row['nome_info'],
-                row['valor'],
-                (row['valor'] / volume_total * 100) if volume_total > 0 else 0,
-                percentual_relativo
-            ])
-        
-        fig_sunburst = go.Figure(go.Sunburst(
-            ids=sunburst_df['ids'], 
-            labels=sunburst_df['labels'], 
-            parents=sunburst_df['parents'],
-            values=sunburst_df['values'], 
-            customdata=custom_data_enhanced, 
-            branchvalues="total",
-            hovertemplate=(
-                '<b>%{customdata[0]}</b><br>' +
-                'Valor: %{customdata[1]:,.0f} m³<br>' +
-                'Percentual do Total: %{customdata[2]:.1f}%<br>' +
-                'Percentual Relativo: %{customdata[3]:.1f}%<br>' +
-                '<extra></extra>'
-            ),
-            maxdepth=4, 
-            insidetextorientation='horizontal',
-            marker=dict(colors=colors_list, line=dict(color="white", width=1)),
-            textfont=dict(size=16, color="black", family="Arial")
-        ))
-        
-        fig_sunburst.update_layout(font_size=16, height=800, margin=dict(t=20, l=20, r=20, b=20))
+        chave_sunburst = calcular_hash_entradas(df_aggregated, volume_total)
+        fig_sunburst = obter_figura_cache('sunburst', chave_sunburst)
+        if fig_sunburst is None:
+            fig_sunburst = criar_grafico_sunburst(df_aggregated, volume_total)
+            guardar_figura_cache('sunburst', chave_sunburst, fig_sunburst)
         st.plotly_chart(fig_sunburst, use_container_width=True)
 
 with col2:
     st.subheader(" ")
     
     if not df_aggregated.empty:
-        df_hierarchical = create_hierarchical_display(df_aggregated)
-        df_display = df_hierarchical.copy()
-        df_display['Valor (m³)'] = df_display['valor'].apply(lambda x: format_number_br(x))
-        df_display['Percentual'] = df_display['valor'].apply(lambda x: f"{(x/volume_total)*100:.1f}%".replace(".", ",") if volume_total > 0 else "0,0%")
-        df_display['Percentual Pai'] = df_display['percentual_pai'].apply(lambda x: f"{x:.1f}%".replace(".", ","))
-        
-        num_rows = len(df_display)
-        dynamic_height = min(100, max(400, (num_rows * 40) + 90))
-        
-        html_table = f"<div style='height: {dynamic_height}px; border: none; padding: 15px; font-family: Arial, sans-serif; overflow: visible;'>"
-        html_table += "<table style='width: 100%; border-collapse: collapse;'>"
-        html_table += "<thead style='background-color: #f0f2f6;'><tr>"
-        html_table += "<th style='padding: 15px; text-align: left; border-bottom: 2px solid #ddd; font-weight: bold; font-size: 14px;'>Informação</th>"
-        html_table += "<th style='padding: 15px; text-align: right; border-bottom: 2px solid #ddd; font-weight: bold; font-size: 14px;'>Valor (m³)</th>"
-        html_table += "<th style='padding: 15px; text-align: right; border-bottom: 2px solid #ddd; font-weight: bold; font-size: 14px;'>% Total</th>"
-        html_table += "<th style='padding: 15px; text-align: right; border-bottom: 2px solid #ddd; font-weight: bold; font-size: 14px;'>% Relativo</th></tr></thead><tbody>"
-        
-        for _, row in df_display.iterrows():
-            indent = "&nbsp;" * (row['indent_level'] * 6)
-            
-            if row['style_type'] == "bold":
-                nome_formatado = f"{indent}<strong>{row['nome_display']}</strong>"
-                style_extra = "font-weight: bold; background-color: #f8f9fa; font-size: 13px;"
-            elif row['style_type'] == "subtle":
-                nome_formatado = f"{indent}{row['nome_display']}"
-                style_extra = "background-color: #fafbfc; color: #495057; font-weight: 500; font-size: 13px;"
-            else:
-                nome_formatado = f"{indent}{row['nome_display']}"
-                style_extra = "font-size: 12px;"
-            
-            html_table += f"<tr style='border-bottom: 1px solid #eee; {style_extra}'>"
-            html_table += f"<td style='padding: 12px; vertical-align: middle;'>{nome_formatado}</td>"
-            html_table += f"<td style='padding: 12px; text-align: right; vertical-align: middle;'>{row['Valor (m³)']}</td>"
-            html_table += f"<td style='padding: 12px; text-align: right; vertical-align: middle;'>{row['Percentual']}</td>"
-            html_table += f"<td style='padding: 12px; text-align: right; vertical-align: middle;'>{row['Percentual Pai']}</td></tr>"
-        
-        html_table += "</tbody></table></div>"
-        st.markdown(html_table, unsafe_allow_html=True)
+        st.markdown(montar_tabela_hierarquica_html(df_aggregated, volume_total), unsafe_allow_html=True)
 
 st.markdown("---")
 
+# Tabelas oferecidas na exportação, registradas à medida que cada seção as monta
+tabelas_exportacao = {}
+
 # Análise de Hidrômetros e Submedição
 with st.expander("🔧 Análise de Hidrômetros e Submedição", expanded=False):
     st.markdown("### Análise por Idade dos Hidrômetros")
     st.caption(f"Dados baseados nos filtros aplicados - {contextos[nivel_agregacao]}")
     st.caption("IDM*: Índice de Desempenho da Medição")
     
+    definir_secao_telemetria('hidrometros')
     df_hidrometros = create_hidrometros_table(df_filtered, df_sigis, data_range, regional_selecionada, municipio_selecionado, localidade_selecionada)
+    tabelas_exportacao['hidrometros'] = df_hidrometros
     
     if not df_hidrometros.empty:
         # Preparar dados formatados para exibição
@@ -1627,85 +4454,212 @@ with st.expander("🔧 Análise de Hidrômetros e Submedição", expanded=False)
             economia_potencial = vol_sub_5_anos * 0.7  # Assumindo 70% de redução na submedição
             st.metric("Economia Potencial", f"{format_number_br(economia_potencial)} m³")
 
-                # Criar escala de cores compatível com a paleta do sunburst
-        cores_personalizadas_grafico = [
-            'rgba(16, 72, 97, 1)',      # Ano 0 - Azul escuro (similar ao Consumo Autorizado)
-            'rgba(70, 130, 180, 1)',    # Ano 1 - Azul médio (similar ao Autorizado não Faturado)
-            'rgba(131, 204, 235, 1)',   # Ano 2 - Azul claro (similar ao Consumo Autorizado Faturado)
-            'rgba(192, 230, 245, 1)',   # Ano 3 - Azul muito claro (similar ao Volume Medido)
-            'rgba(220, 240, 250, 1)',   # Ano 4 - Azul claríssimo
-            'rgba(255, 235, 235, 1)',   # Ano 5 - Transição para vermelho muito claro
-            'rgba(255, 217, 217, 1)',   # Ano 6 - Vermelho muito claro (similar aos usos)
-            'rgba(255, 200, 200, 1)',   # Ano 7 - Vermelho claro
-            'rgba(255, 180, 180, 1)',   # Ano 8 - Vermelho claro médio
-            'rgba(255, 160, 160, 1)',   # Ano 9 - Vermelho médio claro
-            'rgba(255, 140, 140, 1)',   # Ano 10 - Vermelho médio
-            'rgba(200, 100, 100, 1)',   # Ano 11 - Vermelho médio escuro
-            'rgba(165, 42, 42, 1)',     # Ano 12 - Vermelho escuro (similar às Perdas)
-            'rgba(140, 30, 30, 1)',     # Ano 13 - Vermelho muito escuro
-            'rgba(120, 0, 0, 1)',       # Ano 14 - Vermelho escuríssimo (similar ao Volume de Perdas)
-            'rgba(100, 0, 0, 1)'        # Ano 15 - Vermelho final
-        ]
+        chave_hidrometros = calcular_hash_entradas(df_hidrometros)
+        fig_hidro_qtd = obter_figura_cache('hidrometros', chave_hidrometros)
+        if fig_hidro_qtd is None:
+            # Criar escala de cores compatível com a paleta do sunburst
+            cores_personalizadas_grafico = [
+                'rgba(16, 72, 97, 1)',      # Ano 0 - Azul escuro (similar ao Consumo Autorizado)
+                'rgba(70, 130, 180, 1)',    # Ano 1 - Azul médio (similar ao Autorizado não Faturado)
+                'rgba(131, 204, 235, 1)',   # Ano 2 - Azul claro (similar ao Consumo Autorizado Faturado)
+                'rgba(192, 230, 245, 1)',   # Ano 3 - Azul muito claro (similar ao Volume Medido)
+                'rgba(220, 240, 250, 1)',   # Ano 4 - Azul claríssimo
+                'rgba(255, 235, 235, 1)',   # Ano 5 - Transição para vermelho muito claro
+                'rgba(255, 217, 217, 1)',   # Ano 6 - Vermelho muito claro (similar aos usos)
+                'rgba(255, 200, 200, 1)',   # Ano 7 - Vermelho claro
+                'rgba(255, 180, 180, 1)',   # Ano 8 - Vermelho claro médio
+                'rgba(255, 160, 160, 1)',   # Ano 9 - Vermelho médio claro
+                'rgba(255, 140, 140, 1)',   # Ano 10 - Vermelho médio
+                'rgba(200, 100, 100, 1)',   # Ano 11 - Vermelho médio escuro
+                'rgba(165, 42, 42, 1)',     # Ano 12 - Vermelho escuro (similar às Perdas)
+                'rgba(140, 30, 30, 1)',     # Ano 13 - Vermelho muito escuro
+                'rgba(120, 0, 0, 1)',       # Ano 14 - Vermelho escuríssimo (similar ao Volume de Perdas)
+                'rgba(100, 0, 0, 1)'        # Ano 15 - Vermelho final
+            ]
         
-        # Preparar dados para o gráfico com informações complementares
-        df_grafico = df_hidrometros.copy()
-        
-        # Calcular percentuais em relação ao total
-        total_hidrometros_graf = df_grafico['Quantidade de Hidrômetros'].sum()
-        df_grafico['Percentual_Quantidade'] = (df_grafico['Quantidade de Hidrômetros'] / total_hidrometros_graf * 100).round(2)
-        
-        # Mapear cores aos anos
-        df_grafico['Cor'] = df_grafico['Ano'].map(lambda x: cores_personalizadas_grafico[x])
-        
-        # Criar gráfico melhorado
-        fig_hidro_qtd = go.Figure()
-        
-        fig_hidro_qtd.add_trace(go.Bar(
-            x=df_grafico['Ano'],
-            y=df_grafico['Quantidade de Hidrômetros'],
-            marker_color=df_grafico['Cor'],
-            hovertemplate=(
-                '<b>Idade:</b> %{x} anos<br>' +
-                '<b>Quantidade:</b> %{customdata[0]:,.0f} hidrômetros<br>' +
-                '<b>Volume Micromedido:</b> %{customdata[1]:,.2f} m³<br>' +
-                '<b>% em relação ao todo:</b> %{customdata[2]:.2f}%<br>' +
-                '<extra></extra>'
-            ),
-            customdata=list(zip(
-                df_grafico['Quantidade de Hidrômetros'],
-                df_grafico['Volume Micromedido Período (m³)'],
-                df_grafico['Percentual_Quantidade']
-            )),
-            showlegend=False
-        ))
+            # Preparar dados para o gráfico com informações complementares
+            df_grafico = df_hidrometros.copy()
         
-        fig_hidro_qtd.update_layout(
-            title="Quantidade de Hidrômetros por Idade",
-            xaxis_title="Idade (Anos)",
-            yaxis_title="Quantidade de Hidrômetros",
-            height=400,
-            xaxis=dict(
-                tickmode='linear',
-                tick0=0,
-                dtick=1,
-                range=[-0.5, 15.5]
-            ),
-            yaxis=dict(
-                tickformat=',',
-                separatethousands=True
-            ),
-            hovermode='x'
-        )
+            # Calcular percentuais em relação ao total
+            total_hidrometros_graf = df_grafico['Quantidade de Hidrômetros'].sum()
+            df_grafico['Percentual_Quantidade'] = (df_grafico['Quantidade de Hidrômetros'] / total_hidrometros_graf * 100).round(2)
+        
+            # Mapear cores aos anos
+            df_grafico['Cor'] = df_grafico['Ano'].map(lambda x: cores_personalizadas_grafico[x])
+        
+            # Criar gráfico melhorado
+            fig_hidro_qtd = go.Figure()
+        
+            fig_hidro_qtd.add_trace(go.Bar(
+                x=df_grafico['Ano'],
+                y=df_grafico['Quantidade de Hidrômetros'],
+                marker_color=df_grafico['Cor'],
+                hovertemplate=(
+                    '<b>Idade:</b> %{x} anos<br>' +
+                    '<b>Quantidade:</b> %{customdata[0]:,.0f} hidrômetros<br>' +
+                    '<b>Volume Micromedido:</b> %{customdata[1]:,.2f} m³<br>' +
+                    '<b>% em relação ao todo:</b> %{customdata[2]:.2f}%<br>' +
+                    '<extra></extra>'
+                ),
+                customdata=list(zip(
+                    df_grafico['Quantidade de Hidrômetros'],
+                    df_grafico['Volume Micromedido Período (m³)'],
+                    df_grafico['Percentual_Quantidade']
+                )),
+                showlegend=False
+            ))
+        
+            fig_hidro_qtd.update_layout(
+                title="Quantidade de Hidrômetros por Idade",
+                xaxis_title="Idade (Anos)",
+                yaxis_title="Quantidade de Hidrômetros",
+                height=400,
+                xaxis=dict(
+                    tickmode='linear',
+                    tick0=0,
+                    dtick=1,
+                    range=[-0.5, 15.5]
+                ),
+                yaxis=dict(
+                    tickformat=',',
+                    separatethousands=True
+                ),
+                hovermode='x'
+            )
+            guardar_figura_cache('hidrometros', chave_hidrometros, fig_hidro_qtd)
         
         st.plotly_chart(fig_hidro_qtd, use_container_width=True)
     else:
         st.warning("⚠️ Não há dados de hidrômetros disponíveis no SIGIS para os filtros selecionados.")
 
+# Base por localidade do recorte atual: montada uma vez e reutilizada pelo simulador e pelo otimizador
+base_cenarios = None
+if isinstance(df_sigis, dict) and df_sigis['chave_localidade'] == 'cod_localidade' and df_sigis['localidade'].dtype == np.int32:
+    chave_base = (tuple(sorted(df_filtered['cod_localidade'].unique())), tuple(data_range))
+    bases_cenarios = st.session_state.setdefault('bases_cenarios', {})
+    if chave_base not in bases_cenarios:
+        bases_cenarios.clear()
+        bases_cenarios[chave_base] = montar_base_cenarios(df_filtered, df_sigis, data_range, parametros_operacionais_ativos['tabela'])
+    base_cenarios = bases_cenarios[chave_base]
+
+# Simulador de cenários: deltas sobre a base
+if base_cenarios is not None:
+    with st.expander("🧪 Simulador de Cenários", expanded=False):
+        st.caption(f"E se reduzirmos as perdas reais ou trocarmos hidrômetros antigos? - {contextos[nivel_agregacao]}")
+        
+        nomes_alvo = dict(zip(base_cenarios['localidades'].tolist(), base_cenarios['nomes']))
+        col_cen1, col_cen2, col_cen3 = st.columns([2, 2, 3])
+        with col_cen1:
+            faixa_reducao = st.slider("Redução de perdas reais (%)", 0, 100, (0, 30), step=5, key="cenario_reducao")
+            passo_reducao = st.select_slider("Passo (%)", options=[1, 5, 10], value=5, key="cenario_passo")
+        with col_cen2:
+            idades_troca = st.multiselect(
+                "Trocar hidrômetros com idade ≥", options=list(range(SEM_TROCA + 1)), default=[SEM_TROCA, 10, 5],
+                format_func=lambda x: "Sem troca" if x == SEM_TROCA else f"{x} anos", key="cenario_idades"
+            )
+        with col_cen3:
+            alvo_cenario = st.multiselect(
+                "Localidades alvo (vazio = todas)", options=list(nomes_alvo), format_func=lambda x: nomes_alvo[x],
+                key="cenario_alvo"
+            )
+        
+        reducoes = np.arange(faixa_reducao[0], faixa_reducao[1] + 1, passo_reducao)
+        idades = np.array(idades_troca or [SEM_TROCA])
+        cenarios = avaliar_cenarios(
+            base_cenarios, np.repeat(reducoes, len(idades)), np.tile(idades, len(reducoes)),
+            alvo_cenario or None
+        )
+        atual = avaliar_cenarios(base_cenarios).iloc[0]
+        
+        fig_cenarios = go.Figure()
+        for idade in idades:
+            serie = cenarios[cenarios['idade_minima_troca'] == idade]
+            fig_cenarios.add_trace(go.Scatter(
+                x=serie['reducao_perdas_reais'], y=serie['ipl'], mode='lines+markers',
+                name="Sem troca" if idade == SEM_TROCA else f"Troca ≥ {idade} anos",
+                customdata=serie[['ivi', 'categoria']],
+                hovertemplate='Redução: %{x}%<br>IPL: %{y:.1f}<br>IVI: %{customdata[0]:.2f}<br>Categoria: %{customdata[1]}<extra></extra>'
+            ))
+        fig_cenarios.add_hline(y=atual['ipl'], line_dash="dot", line_color="#4b5563", annotation_text="Atual")
+        fig_cenarios.update_layout(height=380, xaxis_title="Redução de perdas reais (%)", yaxis_title="IPL (L/lig/dia)",
+                                   margin=dict(t=10, b=40, l=50, r=20))
+        st.plotly_chart(fig_cenarios, use_container_width=True)
+        
+        tabela_cenarios = cenarios.assign(
+            idade_minima_troca=cenarios['idade_minima_troca'].map(lambda x: "Sem troca" if x == SEM_TROCA else f"≥ {x} anos"),
+            variacao_ipl=cenarios['ipl'] - atual['ipl']
+        ).rename(columns={
+            'reducao_perdas_reais': 'Redução (%)', 'idade_minima_troca': 'Troca', 'volume_entrada': 'Volume de Entrada',
+            'perdas_totais': 'Perdas Totais', 'perc_perdas': '% de Perdas', 'volume_recuperado': 'Vol. Recuperado',
+            'ipl': 'IPL', 'ivi': 'IVI', 'categoria': 'Categoria', 'variacao_ipl': 'Δ IPL'
+        })
+        st.dataframe(tabela_cenarios.round(2), use_container_width=True, hide_index=True)
+
+# Otimização da troca de hidrômetros: orçamento × custo unitário sobre as faixas de idade de todas as localidades
+if base_cenarios is not None and base_cenarios['hidrometros'].sum() > 0:
+    with st.expander("💰 Otimização da Troca de Hidrômetros", expanded=False):
+        st.caption(f"Faixas de idade e localidades que mais recuperam volume submedido por real investido - {contextos[nivel_agregacao]}")
+        
+        col_otim1, col_otim2, col_otim3 = st.columns(3)
+        with col_otim1:
+            custo_unitario = st.number_input("Custo por hidrômetro (R$)", min_value=1.0, value=150.0, step=10.0, key="otim_custo")
+        with col_otim2:
+            idade_minima_otim = st.select_slider("Idade mínima para troca", options=list(range(SEM_TROCA)), value=0, key="otim_idade")
+        with col_otim3:
+            modo_otim = st.radio("Troca", ['fracionado', 'lotes'], horizontal=True, key="otim_modo",
+                                 format_func=lambda x: {'fracionado': 'Por hidrômetro', 'lotes': 'Faixa inteira'}[x])
+        
+        custo_total = float(base_cenarios['hidrometros'][:, idade_minima_otim:].sum() * custo_unitario)
+        orcamento = st.slider("Orçamento (R$)", 0.0, max(custo_total, 1.0), min(custo_total, 1_000_000.0),
+                              step=max(custo_total / 200, 1.0), key="otim_orcamento")
+        
+        trocas = otimizar_troca_hidrometros(base_cenarios, orcamento, custo_unitario, modo_otim, idade_minima_otim)
+        
+        col_otim4, col_otim5, col_otim6, col_otim7 = st.columns(4)
+        with col_otim4:
+            st.metric("Hidrômetros Trocados", format_number_br(trocas['hidrometros_trocados'].sum()))
+        with col_otim5:
+            st.metric("Custo", f"R$ {format_number_br(trocas['custo'].sum())}")
+        with col_otim6:
+            st.metric("Volume Recuperado", f"{format_number_br(trocas['volume_recuperado'].sum())} m³")
+        with col_otim7:
+            volume_por_mil = trocas['volume_recuperado'].sum() / trocas['custo'].sum() * 1000 if trocas['custo'].sum() > 0 else 0
+            st.metric("m³ por R$ 1.000", format_number_br(volume_por_mil, 1))
+        
+        if not trocas.empty:
+            por_idade = trocas.groupby('idade', as_index=False)[['hidrometros_trocados', 'volume_recuperado']].sum()
+            fig_otim = go.Figure(go.Bar(
+                x=por_idade['idade'], y=por_idade['volume_recuperado'], marker_color='#1e3a8a',
+                customdata=por_idade['hidrometros_trocados'],
+                hovertemplate='Idade %{x}<br>Volume: %{y:,.0f} m³<br>Hidrômetros: %{customdata:,.0f}<extra></extra>'
+            ))
+            fig_otim.update_layout(height=320, xaxis_title="Idade (Anos)", yaxis_title="Volume Recuperado (m³)",
+                                   xaxis=dict(tickmode='linear', dtick=1), margin=dict(t=10, b=40, l=50, r=20))
+            st.plotly_chart(fig_otim, use_container_width=True)
+            
+            st.dataframe(trocas.rename(columns={
+                'cod_localidade': 'Código', 'nome_localidade': 'Localidade', 'idade': 'Idade',
+                'hidrometros_trocados': 'Trocar', 'hidrometros_faixa': 'Na Faixa', 'custo': 'Custo (R$)',
+                'volume_recuperado': 'Vol. Recuperado (m³)', 'recuperado_por_hidrometro': 'm³/Hidrômetro'
+            }).round(2), use_container_width=True, hide_index=True)
+        else:
+            st.info("ℹ️ Orçamento insuficiente para trocar ao menos um hidrômetro.")
+
 st.markdown("---") 
 
 # Tabela de Análise Detalhada com Classificação
 st.subheader("📊 Tabela de Análise Detalhada")
-df_analysis = create_analysis_table(df_filtered, df_sigis, data_range)
+definir_secao_telemetria('tabela_analise')
+
+# Motor SQL opcional (DuckDB) sobre o SIGIS tipado e o balanço
+conexao_sql = obter_conexao_sql(st.session_state.chave_dados, df_sigis, df) if duckdb is not None else None
+
+# O motor SQL calcula o PRAI com 30 m e 24 h: com parâmetros por localidade, usa a versão pandas
+if USAR_MOTOR_SQL and conexao_sql is not None and parametros_operacionais_ativos['tabela'] is None:
+    df_analysis = create_analysis_table_sql(conexao_sql, df_filtered, data_range)
+else:
+    df_analysis = create_analysis_table(df_filtered, df_sigis, data_range)
+tabelas_exportacao['analise_localidades'] = df_analysis
 
 if not df_analysis.empty:
     st.markdown("### Dados por Localidade")
@@ -1773,78 +4727,29 @@ if not df_analysis.empty:
                 col_chart1, col_chart2 = st.columns(2)
                 
                 with col_chart1:
-                    categoria_dist = df_analysis['Categoria'].value_counts()
-                    fig_categoria = go.Figure(data=[go.Pie(
-                        labels=list(categoria_dist.index),
-                        values=list(categoria_dist.values),
-                        marker_colors=[cores_classificacao.get(cat, "rgba(128, 128, 128, 0.5)") for cat in categoria_dist.index],
-                        textposition='inside', 
-                        textinfo='percent+label',
-                        textfont=dict(size=16, color='black', family='Arial'),
-                        hovertemplate='<b>Categoria %{label}</b><br>Localidades: %{value}<br>Percentual: %{percent}<extra></extra>'
-                    )])
-                    fig_categoria.update_layout(title="Distribuição por Categoria", height=350, showlegend=False)
+                    chave_categorias = calcular_hash_entradas(df_analysis['Categoria'])
+                    fig_categoria = obter_figura_cache('categorias', chave_categorias)
+                    if fig_categoria is None:
+                        categoria_dist = df_analysis['Categoria'].value_counts()
+                        fig_categoria = go.Figure(data=[go.Pie(
+                            labels=list(categoria_dist.index),
+                            values=list(categoria_dist.values),
+                            marker_colors=[cores_classificacao.get(cat, "rgba(128, 128, 128, 0.5)") for cat in categoria_dist.index],
+                            textposition='inside', 
+                            textinfo='percent+label',
+                            textfont=dict(size=16, color='black', family='Arial'),
+                            hovertemplate='<b>Categoria %{label}</b><br>Localidades: %{value}<br>Percentual: %{percent}<extra></extra>'
+                        )])
+                        fig_categoria.update_layout(title="Distribuição por Categoria", height=350, showlegend=False)
+                        guardar_figura_cache('categorias', chave_categorias, fig_categoria)
                     st.plotly_chart(fig_categoria, use_container_width=True)
                 
                 with col_chart2:
-                    df_analysis_scatter = df_analysis.copy()
-                    df_analysis_scatter['IPL_size'] = df_analysis_scatter['IPL'].apply(lambda x: max(8, min(50, abs(x)/10)) if x > 0 else 8)
-                    
-                    fig_scatter = go.Figure()
-                    
-                    for categoria in df_analysis_scatter['Categoria'].unique():
-                        df_cat = df_analysis_scatter[df_analysis_scatter['Categoria'] == categoria]
-                        
-                        fig_scatter.add_trace(go.Scatter(
-                            x=df_cat['Volume Total de entrada'],
-                            y=df_cat['% de perdas'],
-                            mode='markers+text',
-                            name=f'Categoria {categoria}',
-                            marker=dict(
-                                size=df_cat['IPL_size'],
-                                color=cores_classificacao.get(categoria, "rgba(128, 128, 128, 0.5)"),
-                                line=dict(width=1, color='white'),
-                                sizemode='diameter'
-                            ),
-                            text=df_cat['Localidade'],
-                            textposition='top center',
-                            textfont=dict(size=10, color='black'),
-                            hovertemplate=(
-                                '<b>%{text}</b><br>' +
-                                'Regional: %{customdata[0]}<br>' +
-                                'Município: %{customdata[1]}<br>' +
-                                'Volume Total: %{x:,.0f} m³<br>' +
-                                '% Perdas: %{y:.1f}%<br>' +
-                                'IPL: %{customdata[2]:.0f}<br>' +
-                                'IVI: %{customdata[3]}<br>' +
-                                'Categoria: %{customdata[4]}<br>' +
-                                '<extra></extra>'
-                            ),
-                            customdata=list(zip(
-                                df_cat['Regional'],
-                                df_cat['Municipio'],
-                                df_cat['IPL'],
-                                df_cat['IVI'],
-                                df_cat['Categoria']
-                            ))
-                        ))
-                    
-                    fig_scatter.update_layout(
-                        title="Volume vs % Perdas",
-                        xaxis_title="Volume Total de Entrada (m³)",
-                        yaxis_title="% de Perdas",
-                        height=350,
-                        showlegend=True,
-                        legend=dict(
-                            orientation="h",
-                            yanchor="bottom",
-                            y=1.02,
-                            xanchor="right",
-                            x=1
-                        ),
-                        xaxis=dict(tickformat=','),
-                        yaxis=dict(tickformat='.1f')
-                    )
+                    chave_volume_perdas = calcular_hash_entradas(df_analysis)
+                    fig_scatter = obter_figura_cache('volume_perdas', chave_volume_perdas)
+                    if fig_scatter is None:
+                        fig_scatter = criar_grafico_volume_perdas(df_analysis)
+                        guardar_figura_cache('volume_perdas', chave_volume_perdas, fig_scatter)
                     
                     st.plotly_chart(fig_scatter, use_container_width=True)      
 
@@ -1854,11 +4759,86 @@ else:
 # Nova seção: Evolução Temporal
 st.write("---")
 
+definir_secao_telemetria('evolucao_temporal')
+
+# Cubo mensal (localidade × mês): montado uma vez por conjunto de dados
+cubo_mensal = None
+if isinstance(df_sigis, dict):
+    if 'cubo_mensal' not in st.session_state:
+        st.session_state.cubo_mensal = resultado_aquecimento(
+            'cubo_mensal', lambda: montar_cubo_carregado(df, df_sigis, st.session_state.get('cubo_repositorio'))
+        )
+    cubo_mensal = st.session_state.cubo_mensal
+
+# Varredura de qualidade do SIGIS: uma vez por conjunto de dados; cada rerun só filtra o recorte
+ocorrencias_ipl = None
+if isinstance(df_sigis, dict):
+    if 'qualidade_sigis' not in st.session_state:
+        st.session_state.qualidade_sigis = resultado_aquecimento('qualidade_sigis', lambda: varrer_qualidade_sigis(df_sigis, df))
+    ocorrencias_recorte = filtrar_ocorrencias(st.session_state.qualidade_sigis, data_range,
+                                              localidades_filtradas_sigis if df_sigis['localidade'] is not None else None)
+    ocorrencias_ipl = ocorrencias_recorte[ocorrencias_recorte['codigo'].isin(CODIGOS_SIGIS_IPL)]
+    
+    with st.expander(f"🩺 Qualidade dos Dados do SIGIS ({len(ocorrencias_recorte)} ocorrências no recorte)", expanded=False):
+        if ocorrencias_recorte.empty:
+            st.success("✅ Nenhuma ocorrência nos dados do SIGIS para os filtros e período selecionados.")
+        else:
+            contagem_tipos = ocorrencias_recorte['tipo'].value_counts()
+            colunas_qualidade = st.columns(len(contagem_tipos))
+            for coluna_qualidade, (tipo, quantidade) in zip(colunas_qualidade, contagem_tipos.items()):
+                with coluna_qualidade:
+                    st.metric(TIPOS_OCORRENCIA[tipo], format_number_br(quantidade))
+            st.caption("Ocorrências nos códigos do IPL aparecem marcadas no gráfico de evolução do IPL.")
+            st.dataframe(
+                ocorrencias_recorte.assign(
+                    tipo=ocorrencias_recorte['tipo'].map(TIPOS_OCORRENCIA),
+                    ano_mes=ocorrencias_recorte['ano_mes'].map(format_ano_mes)
+                ).rename(columns={'codigo': 'Código', 'localidade': 'Localidade', 'ano_mes': 'Mês',
+                                  'tipo': 'Ocorrência', 'valor': 'Valor', 'detalhe': 'Detalhe'}),
+                use_container_width=True, hide_index=True
+            )
+
+# Conciliação balanço × SIGIS por localidade × mês (precisa do SIGIS por código de localidade)
+if cubo_mensal is not None and df_sigis['chave_localidade'] == 'cod_localidade' and df_sigis['localidade'].dtype == np.int32:
+    cubo_recorte = cubo_mensal[
+        cubo_mensal['cod_localidade'].isin(df_filtered['cod_localidade'].unique())
+        & cubo_mensal['ano_mes'].between(data_range[0], data_range[1])
+    ]
+    with st.expander("⚖️ Conciliação Balanço × SIGIS", expanded=False):
+        limite_conciliacao = st.slider("Diferença tolerada (%)", 1, 50, int(LIMITE_CONCILIACAO * 100), key="limite_conciliacao") / 100
+        meses_conciliacao, localidades_conciliacao = conciliar_balanco_sigis(cubo_recorte, limite_conciliacao)
+        
+        col_conc1, col_conc2, col_conc3 = st.columns(3)
+        with col_conc1:
+            st.metric("Localidades Divergentes", f"{int(localidades_conciliacao['divergente'].sum())} de {len(localidades_conciliacao)}")
+        with col_conc2:
+            st.metric("Meses Divergentes", f"{int(meses_conciliacao['divergente'].sum())} de {len(meses_conciliacao)}")
+        with col_conc3:
+            entrada_sigis_total = localidades_conciliacao['entrada_sigis'].sum()
+            razao_total = localidades_conciliacao['volume_entrada'].sum() / entrada_sigis_total if entrada_sigis_total else 0
+            st.metric("Entrada Balanço / SIGIS", f"{razao_total:.3f}".replace(".", ","))
+        
+        st.caption("Entrada SIGIS = produção + importado − exportado; Perdas SIGIS = entrada − operacional − consumido.")
+        st.dataframe(
+            localidades_conciliacao.assign(
+                dif_rel_entrada=localidades_conciliacao['dif_rel_entrada'] * 100,
+                dif_rel_perdas=localidades_conciliacao['dif_rel_perdas'] * 100,
+                divergente=localidades_conciliacao['divergente'].map({True: '⚠️', False: '✅'})
+            ).rename(columns={
+                'cod_localidade': 'Código', 'nome_localidade': 'Localidade', 'volume_entrada': 'Entrada Balanço',
+                'entrada_sigis': 'Entrada SIGIS', 'perdas_totais': 'Perdas Balanço', 'perdas_sigis': 'Perdas SIGIS',
+                'meses': 'Meses', 'meses_divergentes': 'Meses Divergentes', 'razao_entrada': 'Razão Entrada',
+                'razao_perdas': 'Razão Perdas', 'dif_rel_entrada': 'Dif. Entrada (%)', 'dif_rel_perdas': 'Dif. Perdas (%)',
+                'divergente': 'Situação'
+            }).round(2),
+            use_container_width=True, hide_index=True
+        )
+
 # Verificar se há dados suficientes para análise temporal
-if df_sigis is not None and len(df['ano_mes'].unique()) > 1:
+if df_sigis is not None and len(particoes_balanco['meses']) > 1:
     
     # Obter todos os meses disponíveis no período filtrado
-    meses_disponiveis = sorted(df_data_filtered['ano_mes'].unique())
+    meses_disponiveis = meses_no_periodo(particoes_balanco, data_range)
     
     if len(meses_disponiveis) >= 3:  # Mínimo 3 meses para análise temporal
         
@@ -1888,9 +4868,6 @@ if df_sigis is not None and len(df['ano_mes'].unique()) > 1:
             # CALCULAR IPL USANDO VALORES ACUMULADOS
             # Replicar exatamente a função calcular_ipl com debug
             try:
-                from datetime import datetime
-                import calendar
-                
                 # Códigos SIGIS conforme documentação oficial
                 codigo_producao = 1      # Volume Produzido de Água
                 codigo_importado = 67    # Volume Importado
@@ -1903,43 +4880,20 @@ if df_sigis is not None and len(df['ano_mes'].unique()) > 1:
                 codigo_ligacoes = 9603   # Ligações reais de água faturadas
                 
                 # Buscar volumes do período ACUMULADO (soma)
-                volume_producao = buscar_dados_sigis(df_sigis, codigo_producao, data_range_acumulado, localidades_filtradas)
-                volume_importado = buscar_dados_sigis(df_sigis, codigo_importado, data_range_acumulado, localidades_filtradas)
-                volume_exportado = buscar_dados_sigis(df_sigis, codigo_exportado, data_range_acumulado, localidades_filtradas)
-                volume_uso_op_1 = buscar_dados_sigis(df_sigis, codigo_uso_op_1, data_range_acumulado, localidades_filtradas)
-                volume_uso_op_2 = buscar_dados_sigis(df_sigis, codigo_uso_op_2, data_range_acumulado, localidades_filtradas)
-                volume_uso_op_3 = buscar_dados_sigis(df_sigis, codigo_uso_op_3, data_range_acumulado, localidades_filtradas)
-                volume_uso_op_4 = buscar_dados_sigis(df_sigis, codigo_uso_op_4, data_range_acumulado, localidades_filtradas)
-                volume_consumido = buscar_dados_sigis(df_sigis, codigo_consumido, data_range_acumulado, localidades_filtradas)
+                volume_producao = buscar_dados_sigis(df_sigis, codigo_producao, data_range_acumulado, localidades_filtradas, origem='evolucao_temporal')
+                volume_importado = buscar_dados_sigis(df_sigis, codigo_importado, data_range_acumulado, localidades_filtradas, origem='evolucao_temporal')
+                volume_exportado = buscar_dados_sigis(df_sigis, codigo_exportado, data_range_acumulado, localidades_filtradas, origem='evolucao_temporal')
+                volume_uso_op_1 = buscar_dados_sigis(df_sigis, codigo_uso_op_1, data_range_acumulado, localidades_filtradas, origem='evolucao_temporal')
+                volume_uso_op_2 = buscar_dados_sigis(df_sigis, codigo_uso_op_2, data_range_acumulado, localidades_filtradas, origem='evolucao_temporal')
+                volume_uso_op_3 = buscar_dados_sigis(df_sigis, codigo_uso_op_3, data_range_acumulado, localidades_filtradas, origem='evolucao_temporal')
+                volume_uso_op_4 = buscar_dados_sigis(df_sigis, codigo_uso_op_4, data_range_acumulado, localidades_filtradas, origem='evolucao_temporal')
+                volume_consumido = buscar_dados_sigis(df_sigis, codigo_consumido, data_range_acumulado, localidades_filtradas, origem='evolucao_temporal')
                 
                 # Buscar ligações (último valor não zerado do período)
-                ligacoes_reais = buscar_ultimo_valor_nao_zerado_simples(df_sigis, codigo_ligacoes, data_range_acumulado, localidades_filtradas)
+                ligacoes_reais = buscar_ultimo_valor_nao_zerado_simples(df_sigis, codigo_ligacoes, data_range_acumulado, localidades_filtradas, origem='evolucao_temporal')
                 
                 # Calcular número real de dias do período ACUMULADO
-                data_inicio, data_fim = data_range_acumulado
-                
-                if data_inicio == data_fim:
-                    # Mesmo mês - calcular dias do mês
-                    ano = data_inicio // 100
-                    mes = data_inicio % 100
-                    dias_periodo = calendar.monthrange(ano, mes)[1]
-                else:
-                    # Períodos diferentes - calcular dias totais
-                    ano_inicio = data_inicio // 100
-                    mes_inicio = data_inicio % 100
-                    ano_fim = data_fim // 100
-                    mes_fim = data_fim % 100
-                    
-                    # Data de início (primeiro dia do mês inicial)
-                    dt_inicio = datetime(ano_inicio, mes_inicio, 1)
-                    
-                    # Data de fim (último dia do mês final)
-                    ultimo_dia_mes_fim = calendar.monthrange(ano_fim, mes_fim)[1]
-                    dt_fim = datetime(ano_fim, mes_fim, ultimo_dia_mes_fim)
-                    
-                    # Calcular diferença em dias
-                    diferenca = dt_fim - dt_inicio
-                    dias_periodo = diferenca.days + 1  # +1 para incluir o último dia
+                dias_periodo = calcular_dias_periodo(*data_range_acumulado)
                 
                 # Somar volumes operacionais
                 volume_operacional_total = volume_uso_op_1 + volume_uso_op_2 + volume_uso_op_3 + volume_uso_op_4
@@ -1967,7 +4921,7 @@ if df_sigis is not None and len(df['ano_mes'].unique()) > 1:
                 
                 dados_evolucao.append({
                     'ano_mes': mes_atual,
-                    'ano_mes_formatted': format_ano_mes(mes_atual),
+                    'ano_mes_formatted': particoes_balanco['rotulos'][mes_atual],
                     'periodo_acumulado': f"{format_ano_mes(data_range_acumulado[0])} a {format_ano_mes(data_range_acumulado[1])}",
                     'dias_periodo': dias_periodo,
                     'volume_producao': volume_producao,
@@ -1993,249 +4947,346 @@ if df_sigis is not None and len(df['ano_mes'].unique()) > 1:
         
         if len(dados_evolucao) >= 3:
             df_evolucao = pd.DataFrame(dados_evolucao)
-            
-            # Função para calcular tendência
-            def calcular_tendencia(x, y, periodos_futuros):
-                import numpy as np
-                mask = ~(pd.isna(y) | (y == 0))
-                if mask.sum() < 2:
-                    return []
-                
-                x_valid = np.array(range(len(y)))[mask]
-                y_valid = np.array(y)[mask]
-                
-                n = len(x_valid)
-                sum_x = np.sum(x_valid)
-                sum_y = np.sum(y_valid)
-                sum_xy = np.sum(x_valid * y_valid)
-                sum_x2 = np.sum(x_valid ** 2)
-                
-                denominador = n * sum_x2 - sum_x ** 2
-                if denominador == 0:
-                    return []
-                
-                a = (n * sum_xy - sum_x * sum_y) / denominador
-                b = (sum_y - a * sum_x) / n
-                
-                tendencia = []
-                for i in range(len(y), len(y) + periodos_futuros):
-                    valor_projetado = a * i + b
-                    tendencia.append(max(0, valor_projetado))
-                
-                return tendencia
+            tabelas_exportacao['evolucao_temporal'] = df_evolucao
             
             # Calcular tendências
-            tendencia_ipl_6m = calcular_tendencia(range(len(df_evolucao)), df_evolucao['ipl'].tolist(), 6)
-            tendencia_perdas_6m = calcular_tendencia(range(len(df_evolucao)), df_evolucao['perc_perdas'].tolist(), 6)
+            tendencia_ipl_6m = calcular_tendencia(df_evolucao['ipl'].to_numpy(), 6)
+            tendencia_perdas_6m = calcular_tendencia(df_evolucao['perc_perdas'].to_numpy(), 6)
             
             # Gerar meses futuros
             ultimo_mes = df_evolucao['ano_mes'].iloc[-1]
-            def gerar_meses_futuros(mes_base, qtd_meses):
-                meses_futuros = []
-                ano = mes_base // 100
-                mes = mes_base % 100
-                
-                for i in range(1, qtd_meses + 1):
-                    mes += 1
-                    if mes > 12:
-                        mes = 1
-                        ano += 1
-                    meses_futuros.append(ano * 100 + mes)
-                
-                return meses_futuros
-            
             meses_futuros_6m = gerar_meses_futuros(ultimo_mes, 6)
 
             # Gráfico IPL
             st.markdown("<h4 style='margin-bottom: -10px;'>Evolução do IPL (Índice de Perdas por Ligação)</h4>", unsafe_allow_html=True)
             
-            fig_ipl = go.Figure()
+            chave_ipl = calcular_hash_entradas(df_evolucao[['ano_mes', 'ano_mes_formatted', 'ipl']], ocorrencias_ipl, tendencia_ipl_6m, meses_futuros_6m)
+            fig_ipl = obter_figura_cache('evolucao_ipl', chave_ipl)
+            if fig_ipl is None:
+                # Linhas de referência e layout vêm do modelo; só os traços mudam
+                fig_ipl = go.Figure(modelo_grafico_ipl())
             
-            # Filtrar apenas valores IPL > 0
-            df_ipl_grafico = df_evolucao[df_evolucao['ipl'] > 0].copy()
+                # Filtrar apenas valores IPL > 0
+                df_ipl_grafico = df_evolucao[df_evolucao['ipl'] > 0].copy()
             
-            if not df_ipl_grafico.empty:
-                fig_ipl.add_trace(go.Scatter(
-                    x=df_ipl_grafico['ano_mes_formatted'],
-                    y=df_ipl_grafico['ipl'],
+                if not df_ipl_grafico.empty:
+                    fig_ipl.add_trace(go.Scatter(
+                        x=df_ipl_grafico['ano_mes_formatted'],
+                        y=df_ipl_grafico['ipl'],
+                        mode='lines+markers+text',
+                        name='IPL Real',
+                        line=dict(color='#1e3a8a', width=4),
+                        marker=dict(size=10, color='#1e3a8a', symbol='circle', 
+                                   line=dict(color='white', width=2)),
+                        text=[f"{val:.1f}".replace(".", ",") for val in df_ipl_grafico['ipl']],
+                        textposition="top center",
+                        textfont=dict(size=16, color='#1e3a8a', family="Arial"),
+                        hovertemplate='<b>%{x}</b><br>IPL: %{y:.2f} L/lig/dia<br><extra></extra>',
+                        showlegend=True
+                    ))
+                
+                    # Sobreposição: meses com ocorrências de qualidade nos códigos do IPL
+                    if ocorrencias_ipl is not None and not ocorrencias_ipl.empty:
+                        resumo_ocorrencias = ocorrencias_ipl.groupby('ano_mes')['tipo'].agg(
+                            lambda tipos: "<br>".join(f"{TIPOS_OCORRENCIA[t]}: {n}" for t, n in tipos.value_counts().items())
+                        )
+                        df_ocorrencias_grafico = df_ipl_grafico[df_ipl_grafico['ano_mes'].isin(resumo_ocorrencias.index)]
+                        if not df_ocorrencias_grafico.empty:
+                            fig_ipl.add_trace(go.Scatter(
+                                x=df_ocorrencias_grafico['ano_mes_formatted'],
+                                y=df_ocorrencias_grafico['ipl'],
+                                mode='markers',
+                                name='Qualidade dos dados',
+                                marker=dict(size=18, color='rgba(0,0,0,0)', symbol='circle-open',
+                                            line=dict(color='#dc2626', width=3)),
+                                text=df_ocorrencias_grafico['ano_mes'].map(resumo_ocorrencias),
+                                hovertemplate='<b>%{x}</b><br>%{text}<extra>Qualidade</extra>',
+                                showlegend=True
+                            ))
+                
+                    # Tendência
+                    if tendencia_ipl_6m:
+                        meses_6m_formatted = [format_ano_mes(mes) for mes in meses_futuros_6m[:len(tendencia_ipl_6m)]]
+                        fig_ipl.add_trace(go.Scatter(
+                            x=meses_6m_formatted,
+                            y=tendencia_ipl_6m,
+                            mode='lines+markers+text',
+                            name='Tendência',
+                            line=dict(color='#4b5563', width=3, dash='dash'),
+                            marker=dict(size=8, color='#4b5563', symbol='square'),
+                            text=[f"{val:.1f}".replace(".", ",") for val in tendencia_ipl_6m],
+                            textposition="top center",
+                            textfont=dict(size=16, color='#4b5563', family="Arial"),
+                            showlegend=True
+                        ))
+                guardar_figura_cache('evolucao_ipl', chave_ipl, fig_ipl)
+
+            st.plotly_chart(fig_ipl, use_container_width=True)
+
+            # Gráfico % Perdas
+            st.markdown("<h4 style='margin-bottom: -10px;'>Evolução das Perdas (Percentual)</h4>", unsafe_allow_html=True)
+
+            chave_perdas = calcular_hash_entradas(df_evolucao[['ano_mes_formatted', 'perc_perdas']], tendencia_perdas_6m, meses_futuros_6m)
+            fig_perdas = obter_figura_cache('evolucao_perdas', chave_perdas)
+            if fig_perdas is None:
+                # Faixas e linhas de referência vêm do modelo; só os traços mudam
+                fig_perdas = go.Figure(modelo_grafico_perdas())
+
+                # Dados principais
+                fig_perdas.add_trace(go.Scatter(
+                    x=df_evolucao['ano_mes_formatted'],
+                    y=df_evolucao['perc_perdas'],
                     mode='lines+markers+text',
-                    name='IPL Real',
+                    name='% Perdas Real',
                     line=dict(color='#1e3a8a', width=4),
-                    marker=dict(size=10, color='#1e3a8a', symbol='circle', 
-                               line=dict(color='white', width=2)),
-                    text=[f"{val:.1f}".replace(".", ",") for val in df_ipl_grafico['ipl']],
+                    marker=dict(size=10, color='#1e3a8a', symbol='circle'),
+                    text=[f"{val:.1f}%".replace(".", ",") for val in df_evolucao['perc_perdas']],
                     textposition="top center",
                     textfont=dict(size=16, color='#1e3a8a', family="Arial"),
-                    hovertemplate='<b>%{x}</b><br>IPL: %{y:.2f} L/lig/dia<br><extra></extra>',
                     showlegend=True
                 ))
-                
+
                 # Tendência
-                if tendencia_ipl_6m:
-                    meses_6m_formatted = [format_ano_mes(mes) for mes in meses_futuros_6m[:len(tendencia_ipl_6m)]]
-                    fig_ipl.add_trace(go.Scatter(
+                if tendencia_perdas_6m:
+                    meses_6m_formatted = [format_ano_mes(mes) for mes in meses_futuros_6m[:len(tendencia_perdas_6m)]]
+                    fig_perdas.add_trace(go.Scatter(
                         x=meses_6m_formatted,
-                        y=tendencia_ipl_6m,
+                        y=tendencia_perdas_6m,
                         mode='lines+markers+text',
                         name='Tendência',
                         line=dict(color='#4b5563', width=3, dash='dash'),
                         marker=dict(size=8, color='#4b5563', symbol='square'),
-                        text=[f"{val:.1f}".replace(".", ",") for val in tendencia_ipl_6m],
+                        text=[f"{val:.1f}%".replace(".", ",") for val in tendencia_perdas_6m],
                         textposition="top center",
                         textfont=dict(size=16, color='#4b5563', family="Arial"),
                         showlegend=True
                     ))
-            
-            # Linhas de referência
-            fig_ipl.add_hline(y=150, line_dash="dot", line_color="#83CCEB", annotation_text="Cat. A (150)")
-            fig_ipl.add_hline(y=300, line_dash="dot", line_color="#FFE07D", annotation_text="Cat. B (300)")
-            fig_ipl.add_hline(y=600, line_dash="dot", line_color="#ED9283", annotation_text="Cat. C (600)")
-            
-            fig_ipl.update_layout(
-                height=450,
-                xaxis_title="Período",
-                yaxis_title="IPL (Litros/ligação/dia)",
-                hovermode='x unified',
-                margin=dict(t=10, b=40, l=50, r=20)
-            )
-            
-            st.plotly_chart(fig_ipl, use_container_width=True)
-
-            # Gráfico % Perdas
-            st.markdown("<h4 style='margin-bottom: -10px;'>Evolução das Perdas (Percentual)</h4>", unsafe_allow_html=True)
 
-            # Criar a figura primeiro
-            fig_perdas = go.Figure()
+                fig_perdas.update_layout(yaxis_range=[0, max(100, df_evolucao['perc_perdas'].max() * 1.3)])
+                guardar_figura_cache('evolucao_perdas', chave_perdas, fig_perdas)
 
-            # 1. PRIMEIRO: Adicionar faixas coloridas de fundo
-            fig_perdas.add_hrect(
-                y0=0, y1=15,
-                fillcolor="rgba(131, 204, 235, 0.05)",
-                layer="below",
-                line_width=0
-            )
+            st.plotly_chart(fig_perdas, use_container_width=True)
+        
+        else:
+            st.warning("⚠️ Dados insuficientes para análise temporal (mínimo 3 meses).")
+    else:
+        st.warning("⚠️ Período selecionado muito curto para análise temporal.")
+else:
+    st.warning("⚠️ Não há dados SIGIS disponíveis ou período insuficiente para análise temporal.")
 
-            fig_perdas.add_hrect(
-                y0=15, y1=25,
-                fillcolor="rgba(255, 224, 125, 0.1)",
-                layer="below",
-                line_width=0
-            )
+marcar_etapa_memoria('analises_cubo')
+# Indicadores mensais por localidade do recorte (base do ranking e do mapa de calor)
+indicadores_periodo = None
+if cubo_mensal is not None:
+    indicadores_localidades = resultado_aquecimento('indicadores_localidades', lambda: indicadores_mensais_cubo(cubo_mensal))
+    indicadores_periodo = indicadores_localidades[
+        indicadores_localidades['cod_localidade'].isin(df_filtered['cod_localidade'].unique())
+        & indicadores_localidades['ano_mes'].between(data_range[0], data_range[1])
+    ]
+    tabelas_exportacao['indicadores_mensais'] = indicadores_periodo
+    
+    series_niveis = resultado_aquecimento('series_niveis', lambda: series_mensais_niveis(cubo_mensal))
+    tabelas_exportacao['series_mensais'] = series_niveis[series_niveis['ano_mes'].between(data_range[0], data_range[1])]
+    
+    hidrometros_mensais = resultado_aquecimento('hidrometros_mensais', lambda: montar_tabela_hidrometros(df_sigis))
+    if hidrometros_mensais is not None:
+        tabelas_exportacao['hidrometros_mensais'] = hidrometros_mensais[
+            hidrometros_mensais['cod_localidade'].isin(df_filtered['cod_localidade'].unique())
+            & hidrometros_mensais['ano_mes'].between(data_range[0], data_range[1])
+        ]
 
-            fig_perdas.add_hrect(
-                y0=25, y1=50,
-                fillcolor="rgba(237, 146, 131, 0.05)",
-                layer="below",
-                line_width=0
+# Ranking de localidades pela piora projetada (todas as séries ajustadas de uma vez)
+if indicadores_periodo is not None:
+    with st.expander("📉 Localidades com Maior Deterioração Projetada", expanded=False):
+        col1, col2 = st.columns(2)
+        with col1:
+            indicador_ranking = st.selectbox(
+                "Indicador:", ['ipl', 'perc_perdas'],
+                format_func=lambda x: {'ipl': 'IPL (L/lig/dia)', 'perc_perdas': '% de Perdas'}[x],
+                key="indicador_ranking"
             )
-
-            # NOVA FAIXA: Crítico (acima de 50%)
-            fig_perdas.add_hrect(
-                y0=50, y1=100,
-                fillcolor="rgba(139, 0, 0, 0.07)",
-                layer="below",
-                line_width=0
+        with col2:
+            metodo_ranking = st.selectbox(
+                "Método:", ['linear', 'robusto', 'sazonal'],
+                format_func=lambda x: {'linear': 'Linear', 'robusto': 'Robusto (Theil-Sen)', 'sazonal': 'Linear + sazonal'}[x],
+                key="metodo_ranking"
             )
-
-            # 2. SEGUNDO: Adicionar linhas de referência
-            fig_perdas.add_hline(
-                y=15, 
-                line_dash="dot", 
-                line_color="rgba(131, 204, 235, 0.8)", 
-                line_width=2,
-                annotation_text="Desejável (≤15%)",
-                annotation_position="right",
-                annotation_font_color="#104861",  
-                annotation_font_size=12,                           
-                annotation_font_family="Arial"                     
+        
+        ranking = ranquear_deterioracao(indicadores_periodo, indicador_ranking, 6, metodo_ranking)
+        
+        if ranking.empty:
+            st.info("ℹ️ Não há séries mensais suficientes no SIGIS para projetar as localidades.")
+        else:
+            st.caption("Variação = valor projetado em 6 meses menos o último valor observado no período.")
+            st.dataframe(
+                ranking.head(50).rename(columns={
+                    'cod_localidade': 'Código', 'nome_localidade': 'Localidade', 'ultimo_valor': 'Último Valor',
+                    'valor_projetado': 'Projeção 6m', 'inclinacao': 'Inclinação/mês', 'variacao': 'Variação'
+                }).round(2),
+                use_container_width=True, hide_index=True
             )
 
-            fig_perdas.add_hline(
-                y=25, 
-                line_dash="dot", 
-                line_color="rgba(255, 224, 125, 0.8)", 
-                line_width=2,
-                annotation_text="Aceitável (15-25%)",
-                annotation_position="right",
-                annotation_font_color="#B8860B",  
-                annotation_font_size=12,                           
-                annotation_font_family="Arial"   
+# Mapa de calor localidade × mês do recorte
+if indicadores_periodo is not None:
+    titulo_regional = regional_selecionada if regional_selecionada != "Todas" else "Todas as regionais"
+    with st.expander(f"🗺️ Mapa de Calor por Localidade e Mês ({titulo_regional})", expanded=False):
+        col1, col2 = st.columns(2)
+        with col1:
+            indicador_calor = st.selectbox(
+                "Indicador:", ['ipl', 'perc_perdas'],
+                format_func=lambda x: {'ipl': 'IPL (L/lig/dia)', 'perc_perdas': '% de Perdas'}[x],
+                key="indicador_calor"
             )
-
-            fig_perdas.add_hline(
-                y=35,
-                line_dash="dot", 
-                line_color="rgba(237, 146, 131, 0.0)",
-                line_width=0,
-                annotation_text="Não Aceitável (25-50%)",
-                annotation_position="right",
-                annotation_font_color="#8B0000",  
-                annotation_font_size=12,                           
-                annotation_font_family="Arial"   
+        
+        chave_calor = calcular_hash_entradas(indicadores_periodo, indicador_calor)
+        fig_calor = obter_figura_cache('mapa_calor', chave_calor)
+        if fig_calor is None:
+            matriz_calor = montar_matriz_calor(indicadores_periodo, indicador_calor)
+            if not matriz_calor.empty:
+                nomes_calor = indicadores_periodo.drop_duplicates('cod_localidade').set_index('cod_localidade')['nome_localidade'].to_dict()
+                fig_calor = criar_mapa_calor(matriz_calor, nomes_calor, indicador_calor)
+                guardar_figura_cache('mapa_calor', chave_calor, fig_calor)
+        
+        if fig_calor is None:
+            st.info("ℹ️ Não há indicadores mensais no SIGIS para as localidades do recorte.")
+        else:
+            num_linhas_calor = len(fig_calor.data[0].y)
+            linhas_visiveis = min(num_linhas_calor, LINHAS_JANELA_CALOR)
+            primeira_linha = 0
+            if num_linhas_calor > LINHAS_JANELA_CALOR:
+                with col2:
+                    primeira_linha = st.slider(
+                        "Primeira localidade exibida:", 1, num_linhas_calor - LINHAS_JANELA_CALOR + 1, 1,
+                        key="primeira_linha_calor"
+                    ) - 1
+                st.caption(f"{num_linhas_calor} localidades, da pior para a melhor média; "
+                           f"arraste o gráfico ou use o zoom para percorrer as demais.")
+            
+            # A janela só muda o trecho visível: a matriz inteira já está no navegador
+            fig_calor.update_layout(
+                height=max(300, linhas_visiveis * 16 + 80),
+                yaxis_range=[primeira_linha + linhas_visiveis - 0.5, primeira_linha - 0.5]
             )
+            st.plotly_chart(fig_calor, use_container_width=True)
 
-            fig_perdas.add_hline(
-                y=50, 
-                line_dash="dot", 
-                line_color="rgba(139, 0, 0, 0.8)",
-                line_width=2,
-                annotation_text="Crítico (>50%)",
-                annotation_position="right",
-                annotation_font_color="#720505",  
-                annotation_font_size=12,                           
-                annotation_font_family="Arial"   
+# Exportação das tabelas do recorte (arquivo gerado em segundo plano)
+st.markdown("---")
+with st.expander("📤 Exportar Tabelas", expanded=False):
+    NOMES_TABELAS_EXPORTACAO = {
+        'analise_localidades': 'Análise por localidade', 'hidrometros': 'Hidrômetros por idade',
+        'evolucao_temporal': 'Evolução temporal', 'indicadores_mensais': 'Indicadores mensais por localidade',
+        'series_mensais': 'Séries mensais por regional, município e total',
+        'hidrometros_mensais': 'Hidrômetros por idade, localidade e mês'
+    }
+    tarefa_exportacao = st.session_state.get('exportacao')
+    exportacao_em_andamento = tarefa_exportacao is not None and not tarefa_exportacao['concluida']
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        tabelas_selecionadas = st.multiselect(
+            "Tabelas:", [nome for nome, df_tabela in tabelas_exportacao.items() if not df_tabela.empty],
+            default=[nome for nome, df_tabela in tabelas_exportacao.items() if not df_tabela.empty],
+            format_func=lambda x: NOMES_TABELAS_EXPORTACAO.get(x, x), key="tabelas_exportacao"
+        )
+    with col2:
+        formato_exportacao = st.selectbox(
+            "Formato:", formatos_exportacao_disponiveis(),
+            format_func=lambda x: FORMATOS_EXPORTACAO[x][0], key="formato_exportacao"
+        )
+    
+    if st.button("⚙️ Gerar arquivo", disabled=exportacao_em_andamento or not tabelas_selecionadas, key="gerar_exportacao"):
+        descartar_exportacao(tarefa_exportacao)
+        tarefa_exportacao = iniciar_exportacao(
+            {nome: tabelas_exportacao[nome] for nome in tabelas_selecionadas}, formato_exportacao,
+            f"{contextos[nivel_agregacao]} | {format_ano_mes(data_range[0])} a {format_ano_mes(data_range[1])}"
+        )
+        st.session_state.exportacao = tarefa_exportacao
+        exportacao_em_andamento = True
+    
+    if tarefa_exportacao is not None:
+        if not tarefa_exportacao['concluida']:
+            st.progress(
+                min(tarefa_exportacao['linhas_escritas'] / max(tarefa_exportacao['total_linhas'], 1), 1.0),
+                text=f"Gerando arquivo: {format_number_br(tarefa_exportacao['linhas_escritas'])} de "
+                     f"{format_number_br(tarefa_exportacao['total_linhas'])} linhas"
             )
+            st.button("🔄 Atualizar andamento", key="atualizar_exportacao")
+        elif tarefa_exportacao['erro']:
+            st.error(f"❌ Erro ao gerar o arquivo: {tarefa_exportacao['erro']}")
+        elif tarefa_exportacao['caminho'].exists():
+            st.caption(f"Arquivo gerado para: {tarefa_exportacao['descricao']}")
+            with open(tarefa_exportacao['caminho'], 'rb') as arquivo_exportacao:
+                st.download_button(
+                    f"📥 Baixar {FORMATOS_EXPORTACAO[tarefa_exportacao['formato']][0]}",
+                    data=arquivo_exportacao,
+                    file_name=tarefa_exportacao['nome_arquivo'],
+                    mime=tarefa_exportacao['mime'],
+                    key="baixar_exportacao"
+                )
 
-            # 3. TERCEIRO: Adicionar os dados principais
-            fig_perdas.add_trace(go.Scatter(
-                x=df_evolucao['ano_mes_formatted'],
-                y=df_evolucao['perc_perdas'],
-                mode='lines+markers+text',
-                name='% Perdas Real',
-                line=dict(color='#1e3a8a', width=4),
-                marker=dict(size=10, color='#1e3a8a', symbol='circle'),
-                text=[f"{val:.1f}%".replace(".", ",") for val in df_evolucao['perc_perdas']],
-                textposition="top center",
-                textfont=dict(size=16, color='#1e3a8a', family="Arial"),
-                showlegend=True
-            ))
-
-            # 4. QUARTO: Adicionar tendência
-            if tendencia_perdas_6m:
-                meses_6m_formatted = [format_ano_mes(mes) for mes in meses_futuros_6m[:len(tendencia_perdas_6m)]]
-                fig_perdas.add_trace(go.Scatter(
-                    x=meses_6m_formatted,
-                    y=tendencia_perdas_6m,
-                    mode='lines+markers+text',
-                    name='Tendência',
-                    line=dict(color='#4b5563', width=3, dash='dash'),
-                    marker=dict(size=8, color='#4b5563', symbol='square'),
-                    text=[f"{val:.1f}%".replace(".", ",") for val in tendencia_perdas_6m],
-                    textposition="top center",
-                    textfont=dict(size=16, color='#4b5563', family="Arial"),
-                    showlegend=True
-                ))
+# Consultas SQL ad hoc sobre os dados carregados (diagnóstico)
+if MODO_DEBUG and conexao_sql is not None:
+    st.markdown("---")
+    with st.expander("🦆 Consultas SQL (DuckDB)", expanded=False):
+        st.caption(
+            "Tabelas: `sigis` (codigo, cod_localidade, ano_mes, valor), `balanco`, `localidades`. "
+            "Visões e macros: `indicadores_localidade(inicio, fim)`, `ipl_municipio_12m`, "
+            "`formula_ipl`, `formula_ivi`, `categoria_ipl`, `dias_periodo`."
+        )
+        consulta_sql = st.text_area(
+            "Consulta:",
+            value=f"SELECT nome_municipio, sum(volume_entrada) AS volume_entrada,\n"
+                  f"       formula_ipl(sum(numerador_ipl), sum(ligacoes), any_value(dias)) AS ipl\n"
+                  f"FROM indicadores_localidade({data_range[0]}, {data_range[1]})\n"
+                  f"GROUP BY nome_municipio ORDER BY ipl DESC",
+            height=140,
+            key="consulta_sql"
+        )
+        if st.button("▶️ Executar consulta", key="executar_consulta_sql"):
+            try:
+                st.dataframe(consultar_sql_isolada(df_sigis, df, consulta_sql), use_container_width=True, hide_index=True)
+            except Exception as e:
+                st.error(f"❌ Erro na consulta: {e}")
 
-            fig_perdas.update_layout(
-                height=450,
-                xaxis_title="Período",
-                yaxis_title="Percentual de Perdas (%)",
-                hovermode='x unified',
-                margin=dict(t=10, b=40, l=50, r=20),
-                yaxis=dict(
-                    range=[0, max(100, df_evolucao['perc_perdas'].max() * 1.3)],
-                    tickformat='.1f'
-                )
-            )
+# Pico de memória por etapa deste rerun (no log do servidor; na página, no modo de diagnóstico)
+if MEDIR_MEMORIA:
+    marcar_etapa_memoria(None)
+    df_memoria = resumir_memoria_etapas()
+    print("Memória por etapa: " + ", ".join(f"{r.etapa} pico {r.pico_mb:.1f} MB" for r in df_memoria.itertuples()))
 
-            st.plotly_chart(fig_perdas, use_container_width=True)
+# Diagnóstico: telemetria das consultas ao SIGIS neste rerun
+if MODO_DEBUG:
+    st.markdown("---")
+    with st.expander("🧠 Memória por Etapa", expanded=False):
+        st.caption(f"Orçamento do conjunto de dados: {format_number_br(LIMITE_MEMORIA_DADOS / 1024 ** 2)} MB | "
+                   "pico = memória alocada além do início da etapa (inclui threads em segundo plano)")
+        st.dataframe(df_memoria, use_container_width=True, hide_index=True)
+        if st.session_state.get('memoria_leitura'):
+            st.markdown("**Leitura do arquivo (MB)**")
+            st.dataframe(pd.DataFrame(st.session_state.memoria_leitura).T, use_container_width=True)
+    with st.expander("🛠️ Telemetria de Consultas ao SIGIS", expanded=False):
+        df_telemetria = resumir_telemetria_sigis()
         
+        if not df_telemetria.empty:
+            col_tel1, col_tel2, col_tel3, col_tel4 = st.columns(4)
+            with col_tel1:
+                st.metric("Consultas", format_number_br(df_telemetria['chamadas'].sum()))
+            with col_tel2:
+                st.metric("Linhas Varridas", format_number_br(df_telemetria['linhas_varridas'].sum()))
+            with col_tel3:
+                st.metric("Tempo Total", f"{df_telemetria['tempo_s'].sum():.2f} s".replace(".", ","))
+            with col_tel4:
+                st.metric("Consultas Repetidas", format_number_br(df_telemetria['repetidas'].sum()))
+            
+            st.dataframe(df_telemetria, use_container_width=True, hide_index=True)
+            st.download_button(
+                "📥 Exportar telemetria (CSV)",
+                data=df_telemetria.to_csv(index=False, sep=';', decimal=',').encode('utf-8-sig'),
+                file_name="telemetria_sigis.csv",
+                mime="text/csv"
+            )
         else:
-            st.warning("⚠️ Dados insuficientes para análise temporal (mínimo 3 meses).")
-    else:
-        st.warning("⚠️ Período selecionado muito curto para análise temporal.")
-else:
-    st.warning("⚠️ Não há dados SIGIS disponíveis ou período insuficiente para análise temporal.")
+            st.info("Nenhuma consulta ao SIGIS registrada neste rerun.")
 
 st.markdown("---")
 st.markdown("<div style='text-align: center; color: #665;'>Dashboard de Balanço Hídrico | CODEO/GEDES </div>", unsafe_allow_html=True)
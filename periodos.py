@@ -0,0 +1,52 @@
+"""Funções de período do Balanço Hídrico (ano_mes no formato YYYYMM).
+
+Ficam fora de main.py porque o Streamlit reexecuta o script a cada interação: aqui o
+lru_cache vale para o processo inteiro, não só para um rerun.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+def calcular_dias_periodos(inicios, fins):
+    """Calcula, para arrays de janelas (YYYYMM inicial, YYYYMM final), o número de dias
+    do 1º dia do mês inicial ao último dia do mês final (considera anos bissextos)"""
+    inicios = np.asarray(inicios, dtype=np.int64)
+    fins = np.asarray(fins, dtype=np.int64)
+    
+    # Meses desde 1970-01 (unidade nativa do datetime64[M])
+    mes_inicio = (inicios // 100 - 1970) * 12 + (inicios % 100 - 1)
+    mes_seguinte_fim = (fins // 100 - 1970) * 12 + (fins % 100)
+    
+    dia_inicio = mes_inicio.astype('datetime64[M]').astype('datetime64[D]')
+    dia_seguinte_fim = mes_seguinte_fim.astype('datetime64[M]').astype('datetime64[D]')
+    return (dia_seguinte_fim - dia_inicio).astype(np.int64)
+
+@lru_cache(maxsize=4096)
+def calcular_dias_periodo(data_inicio, data_fim):
+    """Número de dias de um período YYYYMM a YYYYMM (memoizado por processo)"""
+    return int(calcular_dias_periodos([data_inicio], [data_fim])[0])
+
+# Função para formatar ano_mes no padrão mmm/aa
+@lru_cache(maxsize=4096)
+def format_ano_mes(ano_mes):
+    """Converte ano_mes (formato YYYYMM) para mmm/aa (formato brasileiro), memoizado por processo"""
+    try:
+        ano_mes_str = str(int(ano_mes))
+        if len(ano_mes_str) != 6:
+            return ano_mes_str
+        
+        ano = ano_mes_str[:4]
+        mes = ano_mes_str[4:6]
+        
+        meses_pt = {
+            '01': 'Jan', '02': 'Fev', '03': 'Mar', '04': 'Abr',
+            '05': 'Mai', '06': 'Jun', '07': 'Jul', '08': 'Ago',
+            '09': 'Set', '10': 'Out', '11': 'Nov', '12': 'Dez'
+        }
+        
+        mes_abrev = meses_pt.get(mes, mes)
+        ano_abrev = ano[-2:]  # Últimos 2 dígitos do ano
+        
+        return f"{mes_abrev}/{ano_abrev}"
+    except:
+        return str(ano_mes)
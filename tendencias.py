@@ -0,0 +1,67 @@
+"""Tendências e projeções do Balanço Hídrico.
+
+Ajuste de muitas séries de uma vez (linhas = séries, colunas = meses), sem dependência
+do Streamlit: usado por main.py e testado em tests/test_tendencias.py.
+"""
+import numpy as np
+
+def ajustar_tendencias(valores, periodos_futuros=6, metodo='linear', periodo_sazonal=12, ignorar_zeros=True):
+    """Ajusta uma tendência por linha de `valores` e projeta `periodos_futuros` meses.
+    NaN é ignorado; zeros também, salvo com ignorar_zeros=False. Métodos: 'linear' (mínimos
+    quadrados), 'robusto' (Theil-Sen: mediana das inclinações entre pares de meses) e 'sazonal'
+    (linear mais a média dos resíduos por mês do ciclo, quando há ao menos dois ciclos).
+    Retorna inclinação, intercepto, projeção (séries × períodos, sem negativos) e as séries válidas."""
+    valores = np.atleast_2d(np.asarray(valores, dtype=np.float64))
+    num_meses = valores.shape[1]
+    x = np.arange(num_meses, dtype=np.float64)
+    valido = ~np.isnan(valores)
+    if ignorar_zeros:
+        valido &= valores != 0
+    n = valido.sum(axis=1)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if metodo == 'robusto':
+            i, j = np.triu_indices(num_meses, k=1)
+            pares_validos = valido[:, i] & valido[:, j]
+            inclinacoes = np.where(pares_validos, (valores[:, j] - valores[:, i]) / (j - i), np.nan)
+            ok = pares_validos.any(axis=1)
+            inclinacao = np.full(len(valores), np.nan)
+            intercepto = np.full(len(valores), np.nan)
+            if ok.any():
+                inclinacao[ok] = np.nanmedian(inclinacoes[ok], axis=1)
+                intercepto[ok] = np.nanmedian(np.where(valido[ok], valores[ok] - inclinacao[ok, None] * x, np.nan), axis=1)
+        else:
+            y = np.where(valido, valores, 0.0)
+            xv = np.where(valido, x, 0.0)
+            soma_x, soma_y = xv.sum(axis=1), y.sum(axis=1)
+            soma_xy, soma_x2 = (xv * y).sum(axis=1), (xv ** 2).sum(axis=1)
+            denominador = n * soma_x2 - soma_x ** 2
+            ok = (n >= 2) & (denominador != 0)
+            inclinacao = np.where(ok, (n * soma_xy - soma_x * soma_y) / denominador, np.nan)
+            intercepto = np.where(ok, (soma_y - inclinacao * soma_x) / n, np.nan)
+        
+        x_futuro = np.arange(num_meses, num_meses + periodos_futuros, dtype=np.float64)
+        projecao = inclinacao[:, None] * x_futuro + intercepto[:, None]
+        
+        if metodo == 'sazonal' and num_meses >= 2 * periodo_sazonal:
+            residuos = np.where(valido, valores - (inclinacao[:, None] * x + intercepto[:, None]), np.nan)
+            fase = np.arange(num_meses) % periodo_sazonal
+            componente = np.zeros((len(valores), periodo_sazonal))
+            for posicao in range(periodo_sazonal):
+                colunas = residuos[:, fase == posicao]
+                contagem = (~np.isnan(colunas)).sum(axis=1)
+                componente[:, posicao] = np.where(contagem > 0, np.nansum(colunas, axis=1) / np.maximum(contagem, 1), 0.0)
+            projecao = projecao + componente[:, np.arange(num_meses, num_meses + periodos_futuros) % periodo_sazonal]
+    
+    return {
+        'inclinacao': inclinacao,
+        'intercepto': intercepto,
+        'projecao': np.where(ok[:, None], np.maximum(projecao, 0), np.nan),
+        'valido': ok
+    }
+
+def calcular_tendencia(y, periodos_futuros=6, metodo='linear'):
+    """Tendência de uma única série: lista com a projeção ou [] sem dados suficientes.
+    Como na projeção original da evolução mensal, meses com zero entram no ajuste."""
+    ajuste = ajustar_tendencias([y], periodos_futuros, metodo, ignorar_zeros=False)
+    return ajuste['projecao'][0].tolist() if ajuste['valido'][0] else []
@@ -0,0 +1,75 @@
+"""Testes do ajuste de tendências (linear, Theil-Sen e sazonal)"""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from tendencias import ajustar_tendencias, calcular_tendencia
+
+MESES = np.arange(24, dtype=np.float64)
+FUTURO = np.arange(24, 30, dtype=np.float64)
+
+def test_linear_recupera_reta_e_projeta():
+    ajuste = ajustar_tendencias([2 * MESES + 5], periodos_futuros=6)
+    assert ajuste['valido'].tolist() == [True]
+    assert ajuste['inclinacao'][0] == pytest.approx(2)
+    assert ajuste['intercepto'][0] == pytest.approx(5)
+    np.testing.assert_allclose(ajuste['projecao'][0], 2 * FUTURO + 5)
+
+def test_linear_ignora_nan_e_zeros():
+    serie = 2 * MESES + 5
+    serie[[3, 10]] = np.nan
+    serie[[7, 15]] = 0
+    ajuste = ajustar_tendencias([serie], periodos_futuros=6)
+    np.testing.assert_allclose(ajuste['projecao'][0], 2 * FUTURO + 5)
+
+def test_linear_varias_series_de_uma_vez():
+    valores = np.vstack([2 * MESES + 5, -MESES + 100, np.full(24, np.nan)])
+    ajuste = ajustar_tendencias(valores, periodos_futuros=6)
+    assert ajuste['valido'].tolist() == [True, True, False]
+    np.testing.assert_allclose(ajuste['inclinacao'][:2], [2, -1])
+    assert np.isnan(ajuste['projecao'][2]).all()
+
+def test_projecao_sem_negativos():
+    ajuste = ajustar_tendencias([100 - 10 * MESES[:10]], periodos_futuros=6)
+    assert (ajuste['projecao'][0] >= 0).all()
+    assert ajuste['projecao'][0][-1] == 0
+
+def test_robusto_resiste_a_valor_atipico():
+    serie = 3 * MESES[:12] + 1
+    serie[5] = 1000
+    robusto = ajustar_tendencias([serie], metodo='robusto')
+    assert robusto['inclinacao'][0] == pytest.approx(3)
+    assert robusto['intercepto'][0] == pytest.approx(1)
+    linear = ajustar_tendencias([serie], metodo='linear')
+    assert abs(linear['inclinacao'][0] - 3) > 1
+
+def test_sazonal_reproduz_ciclo():
+    # Componente sazonal de soma zero e sem correlação com o tempo em dois ciclos completos
+    ciclo = np.array([10, -10, -10, 10, 0, 0, 0, 0, 0, 0, 0, 0], dtype=np.float64)
+    serie = 2 * MESES + 50 + ciclo[MESES.astype(int) % 12]
+    sazonal = ajustar_tendencias([serie], periodos_futuros=6, metodo='sazonal')
+    np.testing.assert_allclose(sazonal['projecao'][0], 2 * FUTURO + 50 + ciclo[FUTURO.astype(int) % 12])
+    linear = ajustar_tendencias([serie], periodos_futuros=6)
+    np.testing.assert_allclose(linear['projecao'][0], 2 * FUTURO + 50)
+
+def test_sazonal_com_menos_de_dois_ciclos_e_linear():
+    serie = 2 * MESES[:20] + 50 + np.where(MESES[:20] % 12 == 0, 10, 0)
+    sazonal = ajustar_tendencias([serie], metodo='sazonal')
+    linear = ajustar_tendencias([serie], metodo='linear')
+    np.testing.assert_allclose(sazonal['projecao'], linear['projecao'])
+
+def test_calcular_tendencia_ajusta_meses_com_zero():
+    # Projeção da evolução mensal: zeros entram no ajuste, NaN não
+    serie = np.array([10, 0, 30, np.nan, 50])
+    x = np.array([0, 1, 2, 4])
+    inclinacao, intercepto = np.polyfit(x, serie[x], 1)
+    esperado = np.maximum(inclinacao * np.arange(5, 8) + intercepto, 0)
+    np.testing.assert_allclose(calcular_tendencia(serie, 3), esperado)
+
+def test_calcular_tendencia_sem_dados_suficientes():
+    assert calcular_tendencia(np.array([np.nan, 7.0, np.nan]), 6) == []
+    assert calcular_tendencia(np.array([]), 6) == []